@@ -0,0 +1,312 @@
+"""Розбір і форматування графіків відключень.
+
+Відрізки доби розбираються один раз у DaySchedule (однаковий графік — один
+об'єкт), назви днів тижня та рядки тривалості кешуються, тексти збираються
+через join. Модуль не залежить від бота і бази, тож його використовують і
+інструменти з tools/.
+"""
+import bisect
+import functools
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+KYIV_TZ = ZoneInfo("Europe/Kyiv")
+
+DAYS_NAMES = ("Понеділок", "Вівторок", "Середа", "Четвер", "П'ятниця", "Субота", "Неділя")
+NO_OUTAGES = "✅ Відключень не заплановано"
+
+# Ліміт тексту повідомлення Telegram (UTF-16 одиниці) із запасом під позначку часу кешу
+TELEGRAM_TEXT_LIMIT = 4096
+PACK_RESERVE = 120
+TELEGRAM_CAPTION_LIMIT = 1024
+
+
+# --- РОЗБІР ЧАСУ ---
+def parse_hhmm(text) -> int | None:
+    """'HH:MM' → хвилини від початку доби або None"""
+    try:
+        hours, minutes = map(int, text.split(':'))
+    except Exception:
+        return None
+    return hours * 60 + minutes
+
+
+def hhmm(minutes: int) -> str:
+    """Хвилини від початку доби → 'HH:MM' (кінець доби — '00:00')"""
+    return f"{minutes // 60 % 24:02d}:{minutes % 60:02d}"
+
+
+@functools.lru_cache(maxsize=2048)
+def format_duration(minutes: int) -> str:
+    hours, mins = divmod(minutes, 60)
+    return f"{hours} год" if mins == 0 else f"{hours} год {mins} хв"
+
+
+@functools.lru_cache(maxsize=512)
+def weekday_name(date_str: str) -> str:
+    """'dd.mm.YYYY' → назва дня тижня або порожній рядок"""
+    try:
+        day, month, year = date_str.split('.')
+        return DAYS_NAMES[datetime(int(year), int(month), int(day)).weekday()]
+    except Exception:
+        return ""
+
+
+# --- ГРАФІК ДОБИ (ІНТЕРВАЛИ) ---
+class DaySchedule:
+    """Відключення черги за одну добу, розібрані один раз.
+    slots — відрізки як у джерелі: (from, to, тривалість у хвилинах або None);
+    spans — розібрані відрізки (початок, кінець) у хвилинах доби, у порядку джерела;
+    events — межі злитих відключень: (хвилина, "HH:MM", "off"|"on") за зростанням."""
+    __slots__ = ("slots", "spans", "total_minutes", "events", "_event_minutes", "_rendered")
+
+    def __init__(self, slots):
+        self.slots = []
+        self.spans = []
+        self.total_minutes = 0
+        self._rendered = {}
+        for slot in slots or ():
+            start, end = (slot.get('from', '??'), slot.get('to', '??')) if isinstance(slot, dict) else slot
+            start_minutes, end_minutes = parse_hhmm(start), parse_hhmm(end)
+            duration = None
+            if start_minutes is not None and end_minutes is not None:
+                if end_minutes == 0:
+                    end_minutes = 24 * 60
+                if end_minutes > start_minutes:
+                    duration = end_minutes - start_minutes
+                    self.total_minutes += duration
+                    self.spans.append((start_minutes, end_minutes))
+            self.slots.append((start, end, duration))
+
+        # Суміжні та перекриті відключення — одна подія вимкнення і одна увімкнення
+        self.events = []
+        for start_minutes, end_minutes in sorted(self.spans):
+            if self.events and start_minutes <= self.events[-1][0]:
+                if end_minutes > self.events[-1][0]:
+                    self.events[-1] = (end_minutes, hhmm(end_minutes), "on")
+                continue
+            self.events.append((start_minutes, hhmm(start_minutes), "off"))
+            self.events.append((end_minutes, hhmm(end_minutes), "on"))
+        self._event_minutes = [event[0] for event in self.events]
+
+    def lines(self, indent: str = "") -> list[str]:
+        """Рядки відключень для повідомлень: '🔴 08:00 - 12:00 (4 год)'"""
+        return [
+            f"{indent}🔴 {start} - {end} ({format_duration(duration)})" if duration else f"{indent}🔴 {start} - {end}"
+            for start, end, duration in self.slots
+        ]
+
+    def render(self, indent: str = "") -> str:
+        """Блок відключень доби для повідомлення; обчислюється один раз на відступ"""
+        text = self._rendered.get(indent)
+        if text is None:
+            text = "\n".join(self.lines(indent)) if self.slots else indent + NO_OUTAGES
+            self._rendered[indent] = text
+        return text
+
+    @property
+    def total_label(self) -> str:
+        """'4 год 30 хв' або порожній рядок, якщо відключень немає"""
+        return format_duration(self.total_minutes) if self.total_minutes > 0 else ""
+
+    @property
+    def outage_minutes(self) -> int:
+        """Сумарна тривалість відключень без урахування перекриттів"""
+        return sum(end - start for start, end in self.intervals)
+
+    def events_between(self, start: float, end: float) -> list[tuple[int, str, str]]:
+        """Події в проміжку [start, end] хвилин доби"""
+        low = bisect.bisect_left(self._event_minutes, start)
+        high = bisect.bisect_right(self._event_minutes, end)
+        return self.events[low:high]
+
+    @property
+    def intervals(self) -> list[tuple[int, int]]:
+        """Злиті відключення (початок, кінець) у хвилинах доби"""
+        return [(self.events[i][0], self.events[i + 1][0]) for i in range(0, len(self.events), 2)]
+
+    def same_outages(self, other: "DaySchedule") -> bool:
+        """Чи однакові відключення для користувача (без службових полів і формату часу)"""
+        return self.events == other.events and self.unparsed() == other.unparsed()
+
+    def unparsed(self) -> list[tuple[str, str]]:
+        return [(start, end) for start, end, duration in self.slots if duration is None]
+
+
+def diff_days(old: DaySchedule, new: DaySchedule) -> dict:
+    """Що змінилось між двома версіями доби: added / removed — нові та скасовані
+    відключення, shifted — пари (було, стало) для відключень, що перекриваються"""
+    old_only = [interval for interval in old.intervals if interval not in new.intervals]
+    new_only = [interval for interval in new.intervals if interval not in old.intervals]
+    shifted = []
+    for before in list(old_only):
+        for after in new_only:
+            if before[0] < after[1] and after[0] < before[1]:
+                shifted.append((before, after))
+                old_only.remove(before)
+                new_only.remove(after)
+                break
+    return {"added": new_only, "removed": old_only, "shifted": shifted}
+
+
+@functools.lru_cache(maxsize=4096)
+def _day_schedule_cached(key: tuple) -> DaySchedule:
+    return DaySchedule(key)
+
+
+def day_schedule(slots) -> DaySchedule:
+    """DaySchedule для списку відрізків ({"from","to",...} або (from, to));
+    однаковий графік розбирається лише раз"""
+    key = tuple(
+        (slot.get('from', '??'), slot.get('to', '??')) if isinstance(slot, dict) else tuple(slot)
+        for slot in slots or ()
+    )
+    return _day_schedule_cached(key)
+
+
+# --- ФОРМАТУВАННЯ ПОВІДОМЛЕНЬ ---
+def format_lviv_notification(queue_id: str, slots: list[tuple[str, str]], is_update: bool = False, address: str = None, date_str: str = None) -> str:
+    """Форматує графік Львівської області для однієї групи"""
+    if not date_str:
+        date_str = datetime.now(KYIV_TZ).strftime("%d.%m.%Y")
+
+    header = "⚡️ *Оновлення ГПВ!*" if is_update else "📊 *Поточний графік*"
+    address_line = f"📍 *Адреса:* {address}\n" if address else ""
+    day = day_schedule(slots)
+    total = day.total_label
+    total_str = f" ({total})" if total else ""
+
+    return (
+        f"{header}\n\n"
+        f"{address_line}"
+        f"🔢 *Група:* {queue_id}\n"
+        f"📅 *{date_str}* _{weekday_name(date_str)}_ {total_str}\n\n"
+        f"{day.render('  ')}"
+    )
+
+
+def format_lviv_check(queue_id: str, all_schedules: dict, address: str = None) -> str:
+    """Форматує зведений графік групи ЛОЕ на всі доступні дати"""
+    address_line = f"📍 *Адреса:* {address}\n" if address else ""
+    parts = [f"📊 *Поточний графік*\n\n{address_line}🔢 *Група:* {queue_id}\n"]
+    for date_str in sorted(all_schedules.keys()):
+        day = day_schedule(all_schedules[date_str].get(queue_id, []))
+        total = day.total_label
+        total_str = f" ({total})" if total else ""
+        parts.append(f"\n📅 {date_str} _{weekday_name(date_str)}_ {total_str}\n{day.render('  ')}\n")
+    return "".join(parts)
+
+
+def format_notification(queue_id, data, is_update=True, address=None):
+    """Форматує повідомлення з графіками на ВСІ доступні дати"""
+    if not data or not isinstance(data, list):
+        return f"⚠️ Отримано некоректні дані для черги {queue_id}"
+
+    header = "⚡️ *Оновлення ГПВ!*" if is_update else "📊 *Поточний графік*"
+    address_line = f"📍 *Адреса:* {address}\n" if address else ""
+    parts = [f"{header}\n\n{address_line}🔢 *Черга:* {queue_id}\n"]
+
+    # Позначка затвердження (з останнього запису) повторюється після кожної дати
+    last_approved = data[-1].get("scheduleApprovedSince", "")
+    approved_line = f"\n🕒 _Затверджено: {last_approved}_" if last_approved else ""
+
+    for record in data:
+        event_date = record.get("eventDate", "Невідомо")
+        day = day_schedule(record.get("queues", {}).get(queue_id, []))
+        total = day.total_label
+        total_str = f"({total})" if total else ""
+        parts.append(f"\n📅 *{event_date}* _{weekday_name(event_date)}_ {total_str}\n{day.render('  ')}\n{approved_line}")
+
+    return "".join(parts)
+
+
+def format_schedule_notification(queue_id: str, date: str, hours: list, change_type: str, address: str = None) -> str:
+    """
+    Форматує сповіщення про зміну графіку.
+    change_type: "new" | "updated"
+    """
+    day = day_schedule(hours)
+    total = day.total_label
+    total_str = f" ({total})" if total else ""
+    if change_type == "new":
+        header = f"📅 *Додано новий графік на {date}{total_str}*"
+    else:
+        header = f"🔄 *Оновлено графік на {date}{total_str}*"
+
+    address_line = f"📍 {address}\n" if address else ""
+
+    return (
+        f"{header}\n"
+        f"_{weekday_name(date)}_\n\n"
+        f"{address_line}"
+        f"🔢 Черга: *{queue_id}*\n\n"
+        f"{day.render()}"
+    )
+
+
+def _format_interval(interval: tuple[int, int]) -> str:
+    start, end = interval
+    return f"{hhmm(start)} - {hhmm(end)} ({format_duration(end - start)})"
+
+
+def format_schedule_delta(queue_id: str, date: str, previous: list, hours: list, address: str = None) -> str | None:
+    """Коротке сповіщення лише про змінені відключення; None, якщо змін не видно"""
+    old_day, new_day = day_schedule(previous), day_schedule(hours)
+    delta = diff_days(old_day, new_day)
+    if not any(delta.values()):
+        return None
+
+    lines = [f"➕ Додано: {_format_interval(interval)}" for interval in delta["added"]]
+    lines += [f"➖ Скасовано: {_format_interval(interval)}" for interval in delta["removed"]]
+    lines += [f"🔀 Зсунуто: {_format_interval(before)} → {_format_interval(after)}" for before, after in delta["shifted"]]
+
+    total = new_day.total_label or "0 год"
+    was = old_day.total_label or "0 год"
+    address_line = f"📍 {address}\n" if address else ""
+
+    return (
+        f"🔄 *Змінено графік на {date}*\n"
+        f"_{weekday_name(date)}_\n\n"
+        f"{address_line}"
+        f"🔢 Черга: *{queue_id}*\n\n"
+        + "\n".join(lines) +
+        f"\n\n⏱ Загалом без світла: {total} (було {was})"
+    )
+
+
+# --- РОЗБИТТЯ НА ПОВІДОМЛЕННЯ ---
+def _tg_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def fits_caption(text: str) -> bool:
+    """Чи вміститься текст у підпис до фото"""
+    return _tg_len(text) <= TELEGRAM_CAPTION_LIMIT
+
+
+def pack_messages(sections: list[str], limit: int = TELEGRAM_TEXT_LIMIT - PACK_RESERVE) -> list[str]:
+    """Об'єднує секції в якомога менше повідомлень до limit символів.
+    Задовгу секцію ділить по рядках, щоб не розірвати розмітку."""
+    messages = []
+    current = ""
+    separator = "\n\n"
+    for section in sections:
+        parts = [section]
+        if _tg_len(section) > limit:
+            parts, chunk = [], ""
+            for line in section.split("\n"):
+                candidate = f"{chunk}\n{line}" if chunk else line
+                if chunk and _tg_len(candidate) > limit:
+                    parts.append(chunk)
+                    candidate = line
+                chunk = candidate
+            parts.append(chunk)
+        for part in parts:
+            candidate = f"{current}{separator}{part}" if current else part
+            if current and _tg_len(candidate) > limit:
+                messages.append(current)
+                candidate = part
+            current = candidate
+    if current:
+        messages.append(current)
+    return messages
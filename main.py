@@ -1,32 +1,57 @@
 import asyncio
+import bisect
+import contextvars
+import hashlib
 import logging
 import json
 import ssl
 import os
 import re
+import random
+import socket
+import sys
+import threading
+import time
 import requests
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from bs4 import BeautifulSoup
 from pathlib import Path
 from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, F
+from collections import OrderedDict
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
 from aiogram.types import (
     Message, CallbackQuery, 
     InlineKeyboardMarkup, InlineKeyboardButton,
-    ReplyKeyboardMarkup, KeyboardButton
+    ReplyKeyboardMarkup, KeyboardButton,
+    BufferedInputFile, InputMediaPhoto
 )
 from aiogram.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.dispatcher.flags import get_flag
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 import aiohttp
 from aiohttp import web
 import aiohttp
 import aiohttp_socks
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import DuplicateKeyError
 from curl_cffi.requests import AsyncSession
 from zoneinfo import ZoneInfo
+from formatting import (
+    DaySchedule, NO_OUTAGES, day_schedule, format_duration, hhmm,
+    format_lviv_notification, format_lviv_check, format_notification,
+    format_schedule_notification, format_schedule_delta, pack_messages, fits_caption,
+)
+from timeline import render_timeline
 
 # --- КОНФІГУРАЦІЯ ---
 load_dotenv()
@@ -35,6 +60,13 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
 DB_NAME = os.getenv("DB_NAME", "lumos_bot")
 CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", "45"))
+
+# Адаптивне опитування: межі інтервалу та вікно прискорення після зміни (секунди)
+ADAPTIVE_POLLING = os.getenv("ADAPTIVE_POLLING", "1") == "1"
+POLL_MIN_INTERVAL = int(os.getenv("POLL_MIN_INTERVAL", "20"))
+POLL_MAX_INTERVAL = int(os.getenv("POLL_MAX_INTERVAL", "600"))
+POLL_BOOST_WINDOW = int(os.getenv("POLL_BOOST_WINDOW", "1800"))
+POLL_HISTORY_DAYS = int(os.getenv("POLL_HISTORY_DAYS", "14"))
 PORT = int(os.getenv("PORT", "8080"))
 BASE_DIR = Path(__file__).resolve().parent
 
@@ -43,6 +75,77 @@ APSRC_PFRTY = os.getenv("APSRC_PFRTY")
 
 PROXY_URL = os.getenv("PROXY_URL")
 
+# Захист від збоїв API: таймаут запиту, повтори з jitter, запобіжник
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "15"))
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_BACKOFF_BASE = 0.5
+UPSTREAM_BACKOFF_MAX = 5.0
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET = int(os.getenv("BREAKER_RESET", "60"))
+# Кеш старший за це (секунди) віддається одразу, але оновлюється у фоні
+SWR_FRESH_SECONDS = int(os.getenv("SWR_FRESH_SECONDS", "60"))
+# Каталог для запису сирих відповідей API (відтворює tools/upstream_stub.py)
+UPSTREAM_RECORD_DIR = os.getenv("UPSTREAM_RECORD_DIR")
+
+# Захист від флуду: ліміт натискань на користувача для кожного виду хендлера.
+# THROTTLE_RULES="check=3/20,toggle=10/1" — до 3 натискань підряд, далі одне на 20 с
+THROTTLE = os.getenv("THROTTLE", "1") == "1"
+THROTTLE_RULES = os.getenv("THROTTLE_RULES", "")
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", "50000"))
+
+# Журнал повільних апдейтів: поріг (мс) і частка таких апдейтів, що потрапляє в лог
+SLOW_UPDATE_MS = int(os.getenv("SLOW_UPDATE_MS", "2000"))
+SLOW_UPDATE_SAMPLE = float(os.getenv("SLOW_UPDATE_SAMPLE", "0.2"))
+
+# Outbox розсилки: розмір пакета підписників, оренда задачі (секунди), спроби
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_LEASE = int(os.getenv("OUTBOX_LEASE", "120"))
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RECIPIENT_ATTEMPTS = 3
+
+# Згладжування змін: зміна дати надсилається, коли версія простоїть COALESCE_WINDOW
+# секунд (0 — одразу), але не пізніше ніж через COALESCE_MAX_HOLD від першої появи
+COALESCE_WINDOW = int(os.getenv("COALESCE_WINDOW", "120"))
+COALESCE_MAX_HOLD = int(os.getenv("COALESCE_MAX_HOLD", "600"))
+
+# Розсилка кількома процесами: FANOUT_WORKERS > 1 запускає стільки воркерів,
+# задачі розподіляються між ними за user_id; спільний ліміт повідомлень/сек
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", "0"))
+SEND_RATE_LIMIT = int(os.getenv("SEND_RATE_LIMIT", "25"))
+OUTBOX_POLL_INTERVAL = 30
+# Процеси-воркери не отримують сигнал від детектора, тому опитують outbox частіше
+OUTBOX_SHARD_POLL_INTERVAL = 1
+# Як часто воркер перевіряє, що батьківський процес живий (секунди)
+FANOUT_PARENT_CHECK = 5
+
+# Альтернативна адреса Bot API (локальний сервер або тестовий стенд)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# Вибір лідера між репліками: ідентифікатор процесу та тривалість оренди (секунди)
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+LEADER_LEASE = int(os.getenv("LEADER_LEASE", "30"))
+
+# Webhook: якщо задано WEBHOOK_URL (публічна адреса перед репліками), апдейти
+# приходять на WEBHOOK_PATH кожної репліки. Без нього getUpdates опитує лише
+# лідер — два процеси з одним токеном отримали б від Telegram 409 Conflict.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# FSM-стани: "mongo" (спільні для реплік, переживають перезапуск) або "memory"
+FSM_STORAGE = os.getenv("FSM_STORAGE", "mongo")
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "86400"))
+
+# Кеш адреса → черга (ІФ): скільки тримати знайдені та ненайдені адреси (секунди)
+ADDRESS_CACHE_TTL = int(os.getenv("ADDRESS_CACHE_TTL", str(30 * 86400)))
+ADDRESS_NEGATIVE_TTL = int(os.getenv("ADDRESS_NEGATIVE_TTL", "86400"))
+
+# Довідник адрес ЛОЕ: як часто оновлювати його повністю (секунди)
+GAZETTEER_REFRESH = int(os.getenv("GAZETTEER_REFRESH", "86400"))
+
+# Графік картинкою: PNG рендериться раз на версію графіка, далі надсилається за file_id
+TIMELINE_IMAGES = os.getenv("TIMELINE_IMAGES", "1") == "1"
+
 LVIV_API_URL = os.getenv("APQE_LOE")
 LVIV_POWER_API_URL = os.getenv("APWR_LOE")
 
@@ -79,8 +182,309 @@ DONATE_TEXT = "[💛 Підтримай розвиток проєкту]({url})"
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+# --- FSM-СХОВИЩЕ (MongoDB) ---
+class MongoStorage(BaseStorage):
+    """FSM-сховище в MongoDB: стани переживають перезапуск і спільні для всіх реплік.
+    Один документ на ключ (бот, чат, користувач, гілка, destiny); покинуті стани
+    видаляє TTL-індекс за updated_at."""
+
+    def __init__(self, get_collection):
+        # Колекція береться ліниво: db створюється лише в init_db()
+        self._get_collection = get_collection
+
+    @staticmethod
+    def _doc_id(key: StorageKey) -> str:
+        parts = (key.bot_id, key.chat_id, key.user_id, key.thread_id or "", key.business_connection_id or "", key.destiny)
+        return ":".join(map(str, parts))
+
+    async def _write(self, key: StorageKey, field: str, value):
+        collection = self._get_collection()
+        doc_id = self._doc_id(key)
+        if value:
+            await collection.update_one(
+                {"_id": doc_id},
+                {"$set": {field: value, "chat_id": key.chat_id, "user_id": key.user_id, "updated_at": datetime.now(KYIV_TZ)}},
+                upsert=True,
+            )
+        else:
+            await collection.update_one({"_id": doc_id}, {"$unset": {field: ""}})
+            # Порожній документ (без стану і даних) не зберігаємо
+            await collection.delete_one({"_id": doc_id, "state": {"$exists": False}, "data": {"$exists": False}})
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._write(key, "state", state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        doc = await self._get_collection().find_one({"_id": self._doc_id(key)}, {"state": 1})
+        return doc.get("state") if doc else None
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        await self._write(key, "data", data)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        doc = await self._get_collection().find_one({"_id": self._doc_id(key)}, {"data": 1})
+        return dict(doc.get("data") or {}) if doc else {}
+
+    async def close(self) -> None:
+        # З'єднанням керує init_db()/close_db()
+        pass
+
+
+if TELEGRAM_API_URL:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=BOT_TOKEN)
+dp = Dispatcher(storage=MongoStorage(lambda: db.fsm_states) if FSM_STORAGE == "mongo" else MemoryStorage())
+
+
+# --- ЗАТРИМКИ ХЕНДЛЕРІВ ---
+# Кожен апдейт міряється від входу в диспетчер до кінця обробки. Поки він
+# обробляється, контекстна змінна тримає лічильники часу в MongoDB, зовнішніх
+# API та Bot API: їх поповнюють слухач команд pymongo (Motor переносить контекст
+# у свої потоки), call_upstream і middleware сесії бота.
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+LATENCY_PARTS = ("mongo", "upstream", "telegram")
+
+_update_timings: contextvars.ContextVar[dict | None] = contextvars.ContextVar("update_timings", default=None)
+
+
+def add_update_time(part: str, seconds: float):
+    """Додає час виклику до апдейту, що зараз обробляється (якщо такий є)"""
+    timings = _update_timings.get()
+    if timings is not None:
+        timings[part] += seconds
+        timings[f"{part}_calls"] += 1
+
+
+class LatencyHistogram:
+    """Гістограма з фіксованими межами (мс) і сумами часу за складовими"""
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.parts_ms = dict.fromkeys(LATENCY_PARTS, 0.0)
+
+    def observe(self, elapsed_ms: float, timings: dict):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+        self.count += 1
+        self.total_ms += elapsed_ms
+        for part in LATENCY_PARTS:
+            self.parts_ms[part] += timings[part] * 1000
+
+    def quantile(self, q: float) -> int | str | None:
+        """Верхня межа кошика, в який потрапляє квантиль q"""
+        if not self.count:
+            return None
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= q * self.count:
+                return LATENCY_BUCKETS_MS[index] if index < len(LATENCY_BUCKETS_MS) else f">{LATENCY_BUCKETS_MS[-1]}"
+        return None
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 1) if self.count else 0,
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+            "avg_parts_ms": {part: round(total / self.count, 1) if self.count else 0 for part, total in self.parts_ms.items()},
+            "buckets": dict(zip([f"<={bound}" for bound in LATENCY_BUCKETS_MS] + ["inf"], self.counts)),
+        }
+
+
+HANDLER_LATENCY: dict[str, LatencyHistogram] = {}
+SLOW_UPDATES = {"slow": 0, "logged": 0}
+
+
+def _update_label(event) -> str:
+    """Назва для апдейту, який не дійшов до хендлера. Набір міток фіксований:
+    текст і callback_data задають користувачі, тож з них мітки не будуються."""
+    if event.callback_query:
+        return "callback:unhandled"
+    if event.message:
+        return "message:unhandled"
+    return event.event_type
+
+
+class LatencyMiddleware(BaseMiddleware):
+    """Зовнішній middleware для Update: загальний час і розклад за складовими"""
+
+    async def __call__(self, handler, event, data):
+        timings = dict.fromkeys(LATENCY_PARTS, 0.0)
+        timings.update({f"{part}_calls": 0 for part in LATENCY_PARTS}, handler=None)
+        token = _update_timings.set(timings)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            _update_timings.reset(token)
+            name = timings["handler"] or _update_label(event)
+            HANDLER_LATENCY.setdefault(name, LatencyHistogram()).observe(elapsed_ms, timings)
+            if elapsed_ms >= SLOW_UPDATE_MS:
+                SLOW_UPDATES["slow"] += 1
+                if random.random() < SLOW_UPDATE_SAMPLE:
+                    SLOW_UPDATES["logged"] += 1
+                    parts = ", ".join(
+                        f"{part} {timings[part] * 1000:.0f}ms/{timings[part + '_calls']}" for part in LATENCY_PARTS
+                    )
+                    logging.warning(f"🐢 Slow update {event.update_id} ({name}): {elapsed_ms:.0f}ms — {parts}")
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """Внутрішній middleware: записує, який хендлер обробив апдейт"""
+
+    async def __call__(self, handler, event, data):
+        timings = _update_timings.get()
+        if timings is not None:
+            timings["handler"] = data["handler"].callback.__name__
+        return await handler(event, data)
+
+
+class TelegramTimingMiddleware(BaseRequestMiddleware):
+    """Час запитів до Bot API в межах апдейту"""
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            add_update_time("telegram", time.perf_counter() - started)
+
+
+class MongoTimingListener(monitoring.CommandListener):
+    """Час команд MongoDB в межах апдейту (тривалість рахує сам драйвер)"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        add_update_time("mongo", event.duration_micros / 1e6)
+
+    def failed(self, event):
+        add_update_time("mongo", event.duration_micros / 1e6)
+
+
+def handler_latency_report() -> dict:
+    return {
+        "handlers": {name: histogram.as_dict() for name, histogram in sorted(HANDLER_LATENCY.items())},
+        "slow_updates": {**SLOW_UPDATES, "threshold_ms": SLOW_UPDATE_MS, "sample": SLOW_UPDATE_SAMPLE},
+    }
+
+
+dp.update.outer_middleware(LatencyMiddleware())
+dp.message.middleware(HandlerNameMiddleware())
+dp.callback_query.middleware(HandlerNameMiddleware())
+bot.session.middleware(TelegramTimingMiddleware())
+
+
+# --- ЗАХИСТ ВІД ФЛУДУ ---
+# Ліміт на користувача — відро токенів: burst натискань підряд, далі одне на
+# кожні per секунд. Вид хендлера задається прапорцем flags={"throttle": ...};
+# хендлери без прапорця обмежуються правилом "default".
+DEFAULT_THROTTLE_RULES = {
+    "check": (3, 20.0),    # перегляд графіка: запити до API та кілька повідомлень
+    "lookup": (5, 10.0),   # пошук адреси: запит до API
+    "toggle": (10, 1.0),   # перемикачі черг і нагадувань: запис у MongoDB
+    "default": (20, 1.0),
+}
+THROTTLE_STATS = {"allowed": 0, "throttled": {}, "evicted": 0}
+
+
+def parse_throttle_rules(spec: str) -> dict[str, tuple[int, float]]:
+    rules = dict(DEFAULT_THROTTLE_RULES)
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        try:
+            name, value = item.split("=")
+            burst, per = value.split("/")
+            rules[name.strip()] = (int(burst), float(per))
+        except ValueError:
+            logging.warning(f"Ignoring invalid throttle rule: {item}")
+    return rules
+
+
+class TokenBuckets:
+    """Відра токенів (користувач, правило) у пам'яті. Кількість обмежена
+    max_keys (витісняються найдавніші); відро, що встигло наповнитись, видаляється."""
+
+    def __init__(self, rules: dict[str, tuple[int, float]], max_keys: int):
+        self.rules = rules
+        self.max_keys = max_keys
+        # (user_id, правило) → [токени, час оновлення, чи вже відповіли на надлишок]
+        self._buckets: OrderedDict[tuple[int, str], list] = OrderedDict()
+
+    def take(self, user_id: int, rule: str) -> tuple[bool, bool]:
+        """(дозволено, перший надлишок у серії)"""
+        burst, per = self.rules.get(rule) or self.rules["default"]
+        key = (user_id, rule)
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [float(burst), now, False]
+            self._buckets[key] = bucket
+            self._evict(now)
+        else:
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) / per)
+            bucket[1] = now
+            self._buckets.move_to_end(key)
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            bucket[2] = False
+            return True, False
+        first = not bucket[2]
+        bucket[2] = True
+        return False, first
+
+    def _evict(self, now: float):
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+            THROTTLE_STATS["evicted"] += 1
+        # Найдавніші відра спереду: якщо вже повні — вони нічого не обмежують
+        while self._buckets:
+            (_, rule), bucket = next(iter(self._buckets.items()))
+            burst, per = self.rules.get(rule) or self.rules["default"]
+            if now - bucket[1] < burst * per:
+                break
+            self._buckets.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Відкидає надлишкові натискання до виклику хендлера: на callback —
+    тиха відповідь, на повідомлення — одне коротке попередження на серію"""
+
+    def __init__(self, buckets: TokenBuckets):
+        self.buckets = buckets
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if not THROTTLE or user is None or user.id == ADMIN_ID:
+            return await handler(event, data)
+        rule = get_flag(data, "throttle", default="default")
+        allowed, first = self.buckets.take(user.id, rule)
+        if allowed:
+            THROTTLE_STATS["allowed"] += 1
+            return await handler(event, data)
+
+        THROTTLE_STATS["throttled"][rule] = THROTTLE_STATS["throttled"].get(rule, 0) + 1
+        try:
+            if isinstance(event, CallbackQuery):
+                await event.answer()
+            elif first:
+                await event.answer("⏳ Забагато запитів, спробуйте за хвилину.")
+        except Exception as e:
+            logging.debug(f"Throttle answer failed for {user.id}: {e}")
+        return None
+
+
+throttle_buckets = TokenBuckets(parse_throttle_rules(THROTTLE_RULES), THROTTLE_MAX_USERS)
+dp.message.middleware(ThrottlingMiddleware(throttle_buckets))
+dp.callback_query.middleware(ThrottlingMiddleware(throttle_buckets))
 
 # --- MongoDB ---
 mongo_client: AsyncIOMotorClient = None
@@ -90,7 +494,7 @@ async def init_db():
     """Ініціалізація підключення до MongoDB"""
     global mongo_client, db
     try:
-        mongo_client = AsyncIOMotorClient(MONGO_URI)
+        mongo_client = AsyncIOMotorClient(MONGO_URI, event_listeners=[MongoTimingListener()])
         db = mongo_client[DB_NAME]
         
         # Перевірка з'єднання
@@ -113,6 +517,39 @@ async def init_db():
         states_count = await db.schedule_state.count_documents({})
         logging.info(f"📊 Users: {users_count}, Schedule states: {states_count}")
         
+        # Історія змін для адаптивного опитування (зберігається POLL_HISTORY_DAYS днів)
+        await db.poll_changes.create_index("seen_at", expireAfterSeconds=POLL_HISTORY_DAYS * 86400)
+        await db.poll_changes.create_index([("region", 1), ("seen_at", 1)])
+        
+        # Outbox розсилки: вибірка незавершених задач, видалення завершених через 7 днів
+        await db.outbox.create_index([("status", 1), ("shard", 1), ("locked_until", 1), ("created_at", 1)])
+        await db.outbox.create_index("finished_at", expireAfterSeconds=7 * 86400)
+        await db.outbox.create_index("change_key")
+        await db.send_budget.create_index("created_at", expireAfterSeconds=60)
+        
+        # Історія версій графіків: вибірка за чергою та діапазоном днів
+        await db.schedule_history.create_index([("region", 1), ("queue", 1), ("day", 1), ("v", 1)])
+        await db.schedule_history.create_index([("day", 1)])
+        await db.schedule_history.create_index("blob")
+        
+        # Відкладені зміни (вікно згладжування); забуті видаляються через добу
+        await db.pending_changes.create_index("state_key")
+        await db.pending_changes.create_index("changed_at", expireAfterSeconds=86400)
+        
+        # FSM-стани: пошук за (chat, user), покинуті видаляються через FSM_STATE_TTL
+        await db.fsm_states.create_index([("chat_id", 1), ("user_id", 1)])
+        await db.fsm_states.create_index("updated_at", expireAfterSeconds=FSM_STATE_TTL)
+        
+        # Кеш адреса → черга: запис видаляється в момент expires_at
+        await db.address_cache.create_index("expires_at", expireAfterSeconds=0)
+        
+        # Довідник адрес ЛОЕ та кеш будинок → група
+        await db.loe_gazetteer.create_index([("kind", 1), ("city_id", 1)])
+        await db.loe_accounts.create_index("expires_at", expireAfterSeconds=0)
+        
+        # file_id картинок графіків
+        await db.timeline_images.create_index("expires_at", expireAfterSeconds=0)
+        
     except Exception as e:
         logging.error(f"❌ MongoDB connection failed: {e}")
         raise
@@ -213,15 +650,6 @@ async def remove_user_queue(user_id: int):
     """Видаляє всі підписки користувача"""
     await db.users.delete_one({"user_id": user_id})
 
-async def get_users_by_queue(queue: str, region: str = None) -> list[int]:
-    """Повертає список user_id підписаних на певну чергу (з фільтром за регіоном)"""
-    query = {"$or": [{"queues": queue}, {"queue": queue}]}
-    if region:
-        query["region"] = region
-    cursor = db.users.find(query)
-    users = await cursor.to_list(length=None)
-    return [user["user_id"] for user in users]
-
 async def toggle_user_reminders(user_id: int) -> bool:
     """Перемикає стан нагадувань користувача, повертає новий стан"""
     user = await db.users.find_one({"user_id": user_id})
@@ -263,23 +691,19 @@ async def toggle_reminder_interval(user_id: int, interval: int) -> list[int]:
     )
     return intervals
 
-async def get_schedule_state(queue_id: str) -> str | None:
-    """Отримує збережений стан графіку для черги"""
-    try:
-        state = await db.schedule_state.find_one({"queue_id": queue_id})
-        if state:
-            return state.get("data_hash")
-        return None
-    except Exception as e:
-        logging.error(f"Error getting schedule state for {queue_id}: {e}")
-        return None
+async def get_schedule_state_versioned(queue_id: str) -> tuple[str | None, int]:
+    """Отримує збережений стан графіку та його версію (помилки не приховуються)"""
+    state = await db.schedule_state.find_one({"queue_id": queue_id})
+    if state:
+        return state.get("data_hash"), state.get("version", 0)
+    return None, 0
 
 async def save_schedule_state(queue_id: str, data_hash: str):
-    """Зберігає стан графіку для черги"""
+    """Зберігає стан графіку для черги (кожне збереження збільшує версію)"""
     try:
         await db.schedule_state.update_one(
             {"queue_id": queue_id},
-            {"$set": {"data_hash": data_hash, "updated_at": datetime.now(KYIV_TZ)}},
+            {"$set": {"data_hash": data_hash, "updated_at": datetime.now(KYIV_TZ)}, "$inc": {"version": 1}},
             upsert=True
         )
     except Exception as e:
@@ -409,11 +833,26 @@ def get_cancel_keyboard() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="❌ Скасувати", callback_data="cancel_input")]
     ])
 
-def get_donate_keyboard() -> InlineKeyboardMarkup:
-    """Кнопка підтримки під повідомленнями"""
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💛 Підтримати проєкт", callback_data="show_donate")]
-    ])
+def get_street_suggestions_keyboard(suggestions: list[str], typed: str) -> InlineKeyboardMarkup:
+    """Підказки написання вулиці (ІФ)"""
+    buttons = [[InlineKeyboardButton(text=name, callback_data=f"ifstreet|{i}")] for i, name in enumerate(suggestions)]
+    buttons.append([InlineKeyboardButton(text=f"✏️ Залишити «{typed}»", callback_data="ifstreet|typed")])
+    buttons.append([InlineKeyboardButton(text="❌ Скасувати", callback_data="cancel_input")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def get_donate_keyboard(timeline: bool = False) -> InlineKeyboardMarkup:
+    """Кнопка підтримки під повідомленнями; timeline — ще й кнопка картинок графіків"""
+    buttons = [[InlineKeyboardButton(text="💛 Підтримати проєкт", callback_data="show_donate")]]
+    if timeline and TIMELINE_IMAGES:
+        buttons.insert(0, [InlineKeyboardButton(text="🖼 Картинка", callback_data="timeline")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+def get_full_schedule_keyboard(region: str, queue_id: str, date: str, donate: bool = False) -> InlineKeyboardMarkup:
+    """Кнопка повного графіка під коротким сповіщенням про зміни"""
+    buttons = [[InlineKeyboardButton(text="📋 Повний графік", callback_data=f"full|{region}|{queue_id}|{date}")]]
+    if donate:
+        buttons.append([InlineKeyboardButton(text="💛 Підтримати проєкт", callback_data="show_donate")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 def get_region_keyboard() -> InlineKeyboardMarkup:
     """Клавіатура вибору регіону"""
@@ -428,6 +867,357 @@ def get_ssl_context():
     ssl_context.set_ciphers('DEFAULT@SECLEVEL=1')
     return ssl_context
 
+# --- ЗАХИСТ ВІД ЗБОЇВ API ---
+class UpstreamError(Exception):
+    """Помилка запиту до API. transient=True — запит варто повторити"""
+
+    def __init__(self, message: str, transient: bool = True):
+        super().__init__(message)
+        self.transient = transient
+
+
+class CircuitOpenError(Exception):
+    """Запит не виконано: запобіжник API розімкнено"""
+
+
+class CircuitBreaker:
+    """Запобіжник для одного API: closed → open після серії збоїв,
+    open → half_open після паузи (один пробний запит), half_open → closed/open."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.total_failures = 0
+        self.total_rejected = 0
+        self.times_opened = 0
+        # ЛОЕ викликається з потоків (asyncio.to_thread)
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    self.total_rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self.probe_in_flight = False
+            if self.state == self.HALF_OPEN:
+                if self.probe_in_flight:
+                    self.total_rejected += 1
+                    return False
+                self.probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logging.info(f"🟢 Circuit '{self.name}' closed")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.total_failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                    logging.warning(f"🔴 Circuit '{self.name}' opened after {self.failures} failures")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.probe_in_flight = False
+
+    def release_probe(self):
+        """Пробний запит перервано без результату (скасування задачі) — знову open,
+        інакше half_open чекав би на відповідь, яка ніколи не прийде"""
+        with self._lock:
+            if self.state == self.HALF_OPEN and self.probe_in_flight:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.probe_in_flight = False
+
+    def as_dict(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "total_failures": self.total_failures,
+            "rejected": self.total_rejected,
+            "times_opened": self.times_opened,
+        }
+
+
+BREAKERS = {
+    name: CircuitBreaker(name, BREAKER_FAILURES, BREAKER_RESET)
+    for name in ("if_api", "if_search", "loe_api", "loe_power")
+}
+
+
+def _check_upstream_status(status_code: int, what: str):
+    """Кидає UpstreamError для не-200 відповідей; 429 та 5xx — тимчасові"""
+    if status_code == 200:
+        return
+    transient = status_code == 429 or status_code >= 500
+    raise UpstreamError(f"{what} returned {status_code}", transient=transient)
+
+
+_RECORDED_LAST: dict[str, str] = {}
+
+
+def record_upstream(api: str, path: str, params: dict | None, status: int, elapsed: float, body: str):
+    """Зберігає сиру відповідь API з часом запиту в UPSTREAM_RECORD_DIR (один файл на
+    відповідь). Відповідь, що не змінилась з попереднього запиту, не записується —
+    кожен файл для замінника API — нова версія."""
+    request_key = json.dumps([api, path, params or {}], ensure_ascii=False, sort_keys=True, default=str)
+    digest = hashlib.sha1(f"{status}:{body}".encode()).hexdigest()
+    if _RECORDED_LAST.get(request_key) == digest:
+        return
+    _RECORDED_LAST[request_key] = digest
+    try:
+        directory = Path(UPSTREAM_RECORD_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        snapshot = {
+            "api": api, "path": path, "params": params or {}, "status": status,
+            "elapsed_ms": round(elapsed * 1000, 1), "recorded_at": time.time(), "body": body,
+        }
+        (directory / f"{time.time_ns()}-{api}.json").write_text(json.dumps(snapshot, ensure_ascii=False), encoding="utf-8")
+    except Exception as e:
+        logging.error(f"Upstream record error: {e}")
+
+
+def _backoff_delay(attempt: int) -> float:
+    """Експоненційна затримка з повним jitter"""
+    return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * 2 ** attempt))
+
+
+async def call_upstream(breaker: CircuitBreaker, request):
+    """Виконує async request() через запобіжник з обмеженими повторами"""
+    started = time.perf_counter()
+    try:
+        return await _call_upstream(breaker, request)
+    finally:
+        add_update_time("upstream", time.perf_counter() - started)
+
+
+async def _call_upstream(breaker: CircuitBreaker, request):
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        if not breaker.allow():
+            raise CircuitOpenError(breaker.name)
+        try:
+            result = await request()
+        except UpstreamError as e:
+            if not e.transient:
+                # Сервер відповідає — це не збій доступності
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if attempt == UPSTREAM_RETRIES:
+                raise
+        except Exception as e:
+            breaker.record_failure()
+            if attempt == UPSTREAM_RETRIES:
+                raise UpstreamError(str(e) or type(e).__name__) from e
+        except BaseException:
+            # CancelledError тощо — не збій API, але пробу треба звільнити
+            breaker.release_probe()
+            raise
+        else:
+            breaker.record_success()
+            return result
+        await asyncio.sleep(_backoff_delay(attempt))
+
+
+def call_upstream_sync(breaker: CircuitBreaker, request):
+    """Синхронний варіант call_upstream для викликів з потоків
+    (asyncio.to_thread переносить контекст апдейту в потік)"""
+    started = time.perf_counter()
+    try:
+        return _call_upstream_sync(breaker, request)
+    finally:
+        add_update_time("upstream", time.perf_counter() - started)
+
+
+def _call_upstream_sync(breaker: CircuitBreaker, request):
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        if not breaker.allow():
+            raise CircuitOpenError(breaker.name)
+        try:
+            result = request()
+        except UpstreamError as e:
+            if not e.transient:
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if attempt == UPSTREAM_RETRIES:
+                raise
+        except Exception as e:
+            breaker.record_failure()
+            if attempt == UPSTREAM_RETRIES:
+                raise UpstreamError(str(e) or type(e).__name__) from e
+        except BaseException:
+            breaker.release_probe()
+            raise
+        else:
+            breaker.record_success()
+            return result
+        time.sleep(_backoff_delay(attempt))
+
+
+# Останні успішні відповіді: ключ → (дані, час отримання)
+LAST_GOOD: dict[str, tuple[object, datetime]] = {}
+
+
+def remember_good(key: str, data):
+    LAST_GOOD[key] = (data, datetime.now(KYIV_TZ))
+
+
+def format_stale_note(fetched_at: datetime, unavailable: bool = True) -> str:
+    """Позначка часу для відповіді з кешу (з попередженням, якщо API недоступне)"""
+    now = datetime.now(KYIV_TZ)
+    when = fetched_at.strftime("%H:%M") if fetched_at.date() == now.date() else fetched_at.strftime("%d.%m %H:%M")
+    if unavailable:
+        return f"\n\n⚠️ _Сервер недоступний. Дані станом на {when}_"
+    return f"\n\n🕒 _Станом на {when}_"
+
+
+async def get_if_schedule(queue_id: str) -> tuple[list | None, datetime | None]:
+    """Графік черги ІФ: (дані, None) з API або (дані, час) з останньої успішної відповіді"""
+    data = await refresh_shared(f"if:{queue_id}", lambda: fetch_schedule(None, queue_id))
+    if data:
+        return data, None
+    cached = LAST_GOOD.get(f"if:{queue_id}")
+    if cached:
+        return cached
+    return None, None
+
+
+async def get_lviv_schedules() -> tuple[dict | None, datetime | None]:
+    """Графіки ЛОЕ: (дані, None) з API або (дані, час) з останньої успішної відповіді"""
+    data = await refresh_lviv_schedules()
+    if data:
+        return data, None
+    cached = LAST_GOOD.get("loe:schedule")
+    if cached:
+        return cached
+    return None, None
+
+
+# --- ВІДПОВІДІ З КЕШУ (STALE-WHILE-REVALIDATE) ---
+# Спільні задачі оновлення: конкурентні запити одного ключа чекають один виклик API
+_REFRESH_TASKS: dict[str, asyncio.Task] = {}
+_BACKGROUND_TASKS: set[asyncio.Task] = set()
+
+
+async def refresh_shared(key: str, fetch):
+    """Виконує fetch() один раз для всіх, хто одночасно оновлює ключ"""
+    task = _REFRESH_TASKS.get(key)
+    if task is None:
+        task = asyncio.create_task(fetch())
+        _REFRESH_TASKS[key] = task
+        task.add_done_callback(lambda t: _REFRESH_TASKS.pop(key, None))
+    return await asyncio.shield(task)
+
+
+def spawn_background(coro):
+    """Запускає фонову задачу і тримає посилання на неї до завершення"""
+    task = asyncio.create_task(coro)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    return task
+
+
+def _if_records(data) -> list:
+    """Записи графіка з відповіді API ІФ (список або {"schedule": [...]})"""
+    return data if isinstance(data, list) else (data or {}).get("schedule", [])
+
+
+def get_cached_if_schedules(queues: list[str]) -> tuple[dict | None, datetime | None]:
+    """Кешовані графіки всіх черг ІФ і час найстарішого з них; None, якщо хоч одного немає"""
+    cached = {}
+    oldest = None
+    for queue_id in queues:
+        entry = LAST_GOOD.get(f"if:{queue_id}")
+        if not entry:
+            return None, None
+        cached[queue_id] = entry[0]
+        if oldest is None or entry[1] < oldest:
+            oldest = entry[1]
+    return cached, oldest
+
+
+async def refresh_if_schedules(queues: list[str], fallback: dict) -> dict | None:
+    """Свіжі графіки черг ІФ (для недоступних — з fallback); None, якщо API не відповіло"""
+    fresh = {}
+    got_any = False
+    for queue_id in queues:
+        data = await refresh_shared(f"if:{queue_id}", lambda q=queue_id: fetch_schedule(None, q))
+        got_any |= bool(data)
+        fresh[queue_id] = data or fallback.get(queue_id)
+    return fresh if got_any else None
+
+
+async def refresh_lviv_schedules() -> dict | None:
+    return await refresh_shared("loe:schedule", lambda: asyncio.to_thread(_fetch_lviv_schedule_sync))
+
+
+async def answer_with_revalidation(message: Message, texts: list[str], fetched_at: datetime, breaker_name: str, refresh, render,
+                                   markup: InlineKeyboardMarkup | None = None):
+    """Одразу відповідає текстами з кешу з позначкою часу, а якщо кеш застарів —
+    оновлює дані у фоні та редагує повідомлення, текст яких змінився.
+    markup (за замовчуванням донат) — під останнім повідомленням."""
+    unavailable = BREAKERS[breaker_name].state == CircuitBreaker.OPEN
+    note = format_stale_note(fetched_at, unavailable)
+    markup = markup or get_donate_keyboard()
+    
+    sent = []
+    for i, text in enumerate(texts):
+        last = i == len(texts) - 1
+        sent.append(await message.answer(text + note, parse_mode=ParseMode.MARKDOWN, reply_markup=markup if last else None))
+        if i < len(texts) - 1:
+            await asyncio.sleep(0.3)
+    
+    age = (datetime.now(KYIV_TZ) - fetched_at).total_seconds()
+    if age >= SWR_FRESH_SECONDS and not unavailable:
+        spawn_background(_revalidate_answers(message.chat.id, sent, texts, refresh, render, markup))
+
+
+async def _revalidate_answers(chat_id: int, sent: list[Message], texts: list[str], refresh, render,
+                              last_markup: InlineKeyboardMarkup):
+    """Фонове оновлення: редагує змінені повідомлення, нові — надсилає, зайві
+    (оновлений графік коротший) — видаляє. Клавіатура — під новим останнім."""
+    try:
+        data = await refresh()
+        if not data:
+            return
+        new_texts = render(data)
+        if not new_texts:
+            return
+        for i, new_text in enumerate(new_texts):
+            is_last = i == len(new_texts) - 1
+            markup = last_markup if is_last else None
+            if i < len(sent):
+                if new_text != texts[i]:
+                    await bot.edit_message_text(new_text, chat_id=chat_id, message_id=sent[i].message_id,
+                                                parse_mode=ParseMode.MARKDOWN, reply_markup=markup)
+                elif is_last != (i == len(sent) - 1):
+                    # Текст той самий, але повідомлення стало (або перестало бути) останнім
+                    await bot.edit_message_reply_markup(chat_id=chat_id, message_id=sent[i].message_id, reply_markup=markup)
+            else:
+                await bot.send_message(chat_id, new_text, parse_mode=ParseMode.MARKDOWN, reply_markup=markup)
+        for extra in sent[len(new_texts):]:
+            await bot.delete_message(chat_id, extra.message_id)
+    except Exception as e:
+        logging.error(f"Revalidation failed for {chat_id}: {e}")
+
 async def fetch_schedule(session, queue_id):
     if not APQE_PQFRTY:
         logging.error("APQE_PQFRTY not set!")
@@ -436,20 +1226,29 @@ async def fetch_schedule(session, queue_id):
     params = {'queue': queue_id}
     # Видаляємо старі заголовки, curl_cffi сформує їх автоматично
     
-    try:
+    async def request():
         # impersonate="chrome120" робить вигляд, що це браузер Chrome
         # proxy=PROXY_URL передає твій socks5
-        async with AsyncSession(impersonate="chrome120", proxy=PROXY_URL) as session:
+        async with AsyncSession(impersonate="chrome120", proxy=PROXY_URL, timeout=UPSTREAM_TIMEOUT) as session:
+            started = time.perf_counter()
             response = await session.get(APQE_PQFRTY, params=params)
-            
-            if response.status_code == 200:
-                return response.json()
-            else:
-                logging.error(f"[ІФ] API returned {response.status_code} for queue {queue_id}")
-                return None
+            if UPSTREAM_RECORD_DIR:
+                await asyncio.to_thread(record_upstream, "if_schedule", "", params, response.status_code,
+                                        time.perf_counter() - started, response.text)
+            _check_upstream_status(response.status_code, "[ІФ] API")
+            return response.json()
+    
+    try:
+        data = await call_upstream(BREAKERS["if_api"], request)
+    except CircuitOpenError:
+        return None
     except Exception as e:
         logging.error(f"[ІФ] Error fetching {queue_id}: {e}")
         return None
+    
+    if data:
+        remember_good(f"if:{queue_id}", data)
+    return data
 
 async def fetch_schedule_by_address(city: str, street: str, house: str) -> dict | None:
     if not APSRC_PFRTY:
@@ -463,17 +1262,23 @@ async def fetch_schedule_by_address(city: str, street: str, house: str) -> dict
         'address': address
     }
     
-    try:
-        async with AsyncSession(impersonate="chrome120", proxy=PROXY_URL) as session:
+    async def request():
+        async with AsyncSession(impersonate="chrome120", proxy=PROXY_URL, timeout=UPSTREAM_TIMEOUT) as session:
+            started = time.perf_counter()
             response = await session.post(APSRC_PFRTY, data=payload)
-            
-            if response.status_code == 200:
-                data = response.json()
-                logging.info(f"Address search result for '{address}': {data}")
-                return data
-            else:
-                logging.error(f"Address search failed: {response.status_code}")
-                return None
+            if UPSTREAM_RECORD_DIR:
+                await asyncio.to_thread(record_upstream, "if_search", "", payload, response.status_code,
+                                        time.perf_counter() - started, response.text)
+            _check_upstream_status(response.status_code, "Address search")
+            return response.json()
+    
+    try:
+        data = await call_upstream(BREAKERS["if_search"], request)
+        logging.info(f"Address search result for '{address}': {data}")
+        return data
+    except CircuitOpenError:
+        logging.warning("Address search skipped: circuit open")
+        return None
     except Exception as e:
         logging.error(f"Error searching by address: {e}")
         return None
@@ -498,6 +1303,195 @@ def extract_queue_from_response(data) -> tuple[str | None, list | None]:
     
     return None, None
 
+# Збір усіх черг ІФ: скільки запитів зроблено і скільки черг ними заповнено
+HARVEST_STATS = {"cycles": 0, "requests": 0, "queues_filled": 0}
+
+
+def _queues_in_response(data) -> set[str]:
+    """Черги, дані яких є в КОЖНОМУ записі відповіді API ІФ"""
+    records = data if isinstance(data, list) else data.get("schedule", []) if isinstance(data, dict) else []
+    covered = None
+    for record in records:
+        queues = set((record.get("queues") or {}).keys())
+        covered = queues if covered is None else covered & queues
+    return covered or set()
+
+
+async def harvest_if_schedules() -> dict[str, list]:
+    """Графіки всіх черг ІФ мінімумом запитів. Відповідь API — словник за чергами,
+    тож якщо відповідь для однієї черги вже містить інші, вони заповнюються з неї;
+    окремо запитуються лише черги, яких бракує."""
+    harvested = {}
+    HARVEST_STATS["cycles"] += 1
+    for queue_id in QUEUES:
+        if queue_id in harvested:
+            continue
+        data = await fetch_schedule(None, queue_id)
+        HARVEST_STATS["requests"] += 1
+        if not data:
+            continue
+        harvested[queue_id] = data
+        for other in _queues_in_response(data):
+            if other in QUEUES and other not in harvested:
+                harvested[other] = data
+                remember_good(f"if:{other}", data)
+    HARVEST_STATS["queues_filled"] += len(harvested)
+    return harvested
+
+
+# --- КЕШ АДРЕС (ІФ) ---
+ADDRESS_CACHE_STATS = {"hits": 0, "negative_hits": 0, "misses": 0}
+
+# Типи вулиць зводяться до одного скорочення; "вулиця" та "місто" типові й відкидаються
+_STREET_TYPES = {
+    "вулиця": "", "вул": "",
+    "провулок": "пров", "пров": "пров", "пр-к": "пров",
+    "проспект": "просп", "просп": "просп", "пр-т": "просп",
+    "бульвар": "бул", "бул": "бул", "б-р": "бул",
+    "площа": "пл", "пл": "пл",
+    "село": "с", "с": "с", "місто": "", "м": "", "смт": "смт",
+}
+_APOSTROPHES = re.compile(r"[’‘ʼ`´\"]")
+
+
+def _normalize_address_part(text: str) -> str:
+    text = _APOSTROPHES.sub("'", text.lower())
+    text = re.sub(r"\s*([/\-])\s*", r"\1", text)
+    words = (_STREET_TYPES.get(word, word) for word in re.sub(r"[.,]", " ", text).split())
+    return " ".join(word for word in words if word)
+
+
+def normalize_address(city: str, street: str, house: str) -> str:
+    """Ключ кешу адрес: регістр, пробіли, апострофи та скорочення зведені до одного вигляду"""
+    house = re.sub(r"\s+", "", house.lower())
+    return f"{_normalize_address_part(city)},{_normalize_address_part(street)},{house}"
+
+
+def address_cache_stats() -> dict:
+    lookups = sum(ADDRESS_CACHE_STATS.values())
+    hits = ADDRESS_CACHE_STATS["hits"] + ADDRESS_CACHE_STATS["negative_hits"]
+    return {**ADDRESS_CACHE_STATS, "hit_rate": round(hits / lookups, 3) if lookups else None}
+
+
+async def _get_cached_address(key: str) -> dict | None:
+    try:
+        return await db.address_cache.find_one({"_id": key, "expires_at": {"$gt": datetime.now(timezone.utc)}})
+    except Exception as e:
+        logging.error(f"Address cache read error: {e}")
+        return None
+
+
+async def _cache_address(key: str, queue: str | None):
+    ttl = ADDRESS_CACHE_TTL if queue else ADDRESS_NEGATIVE_TTL
+    try:
+        await db.address_cache.update_one(
+            {"_id": key},
+            {"$set": {"queue": queue, "expires_at": datetime.now(timezone.utc) + timedelta(seconds=ttl)}},
+            upsert=True
+        )
+    except Exception as e:
+        logging.error(f"Address cache write error: {e}")
+
+
+async def resolve_address_queue(city: str, street: str, house: str) -> tuple[str | None, list | None] | None:
+    """Черга та графік для адреси ІФ. Спершу кеш, API лише при промаху.
+    (None, None) — API відповів, що черги немає; None — API недоступний.
+    Порожній графік знайденої черги — це не «не знайдено», а відсутність відключень.
+    При влученні в кеш черга повертається одразу, графік — з LAST_GOOD, а якщо
+    його там ще немає — None (його підтягує фонове оновлення)."""
+    key = normalize_address(city, street, house)
+    cached = await _get_cached_address(key)
+    if cached:
+        queue = cached.get("queue")
+        if not queue:
+            ADDRESS_CACHE_STATS["negative_hits"] += 1
+            return None, None
+        ADDRESS_CACHE_STATS["hits"] += 1
+        entry = LAST_GOOD.get(f"if:{queue}")
+        if entry is None or (datetime.now(KYIV_TZ) - entry[1]).total_seconds() >= SWR_FRESH_SECONDS:
+            spawn_background(refresh_shared(f"if:{queue}", lambda: fetch_schedule(None, queue)))
+        return queue, _if_records(entry[0]) if entry else None
+    
+    ADDRESS_CACHE_STATS["misses"] += 1
+    result = await fetch_schedule_by_address(city, street, house)
+    if not result:
+        return None
+    queue, schedule = extract_queue_from_response(result)
+    if queue:
+        await _cache_address(key, queue)
+        await if_street_index.learn(city, street)
+        if schedule:
+            remember_good(f"if:{queue}", schedule)
+        return queue, schedule or []
+    await _cache_address(key, None)
+    return None, None
+
+
+# Вулиці ІФ, за якими вже знаходили чергу: підказки правильного написання до запиту в API
+IF_STREET_STATS = {"suggested": 0, "accepted": 0, "kept_typed": 0}
+
+
+def _edit_distance(a: str, b: str) -> int:
+    """Відстань Левенштейна"""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+class IfStreetIndex:
+    """Вулиці за населеними пунктами (нормалізовані ключі → написання, з яким адресу знайдено)"""
+
+    def __init__(self):
+        self.streets: dict[str, dict[str, str]] = {}
+
+    async def load(self):
+        streets = {}
+        async for doc in db.if_streets.find({}):
+            streets.setdefault(doc["city_key"], {})[doc["street_key"]] = doc["name"]
+        self.streets = streets
+
+    async def learn(self, city: str, street: str):
+        city_key, street_key = _normalize_address_part(city), _normalize_address_part(street)
+        self.streets.setdefault(city_key, {})[street_key] = street
+        try:
+            await db.if_streets.update_one(
+                {"_id": f"{city_key}|{street_key}"},
+                {"$set": {"city_key": city_key, "street_key": street_key, "name": street, "updated_at": datetime.now(KYIV_TZ)},
+                 "$inc": {"hits": 1}},
+                upsert=True
+            )
+        except Exception as e:
+            logging.error(f"IF street index write error: {e}")
+
+    def suggest(self, city: str, street: str, limit: int = 3) -> list[str]:
+        """Відомі вулиці, схожі на введену. Порожньо, якщо вулиця вже відома або схожих немає."""
+        known = self.streets.get(_normalize_address_part(city))
+        query = _normalize_address_part(street)
+        if not known or not query or query in known:
+            return []
+        query_grams = _trigrams(f"  {query} ")
+        max_distance = max(1, len(query) // 4)
+        ranked = []
+        for key, name in known.items():
+            grams = _trigrams(f"  {key} ")
+            similarity = 2 * len(query_grams & grams) / (len(query_grams) + len(grams))
+            distance = _edit_distance(query, key)
+            prefix = len(query) >= 4 and key.startswith(query)
+            if distance <= max_distance or similarity >= 0.5 or prefix:
+                ranked.append((distance, -similarity, name))
+        ranked.sort()
+        return [name for _, _, name in ranked[:limit]]
+
+
+if_street_index = IfStreetIndex()
+
+
 # --- ЛЬВІВСЬКА ОБЛАСТЬ (API ЛОЕ) ---
 def _parse_lviv_html(html: str) -> tuple[str | None, dict]:
     """Парсить HTML одного дня. Повертає (date_str, {group: [(from,to),...]})"""
@@ -525,13 +1519,24 @@ def _parse_lviv_html(html: str) -> tuple[str | None, dict]:
     return date_str, result
 
 
+def _loe_get_json_sync(breaker_name: str, url: str, params: dict = None) -> dict:
+    """GET до API ЛОЕ через запобіжник з повторами; повертає JSON"""
+    def request():
+        started = time.perf_counter()
+        resp = requests.get(url, params=params, timeout=UPSTREAM_TIMEOUT)
+        if UPSTREAM_RECORD_DIR:
+            api, path = ("loe_power", url[len(LVIV_POWER_API_URL):]) if breaker_name == "loe_power" else ("loe_schedule", "")
+            record_upstream(api, path, params, resp.status_code, time.perf_counter() - started, resp.text)
+        _check_upstream_status(resp.status_code, "[ЛОЕ] API")
+        return resp.json()
+    return call_upstream_sync(BREAKERS[breaker_name], request)
+
+
 def _fetch_lviv_schedule_sync() -> dict | None:
     """Завантажує графіки з ЛОЕ API (всі дні: Today, Tomorrow, ...).
     Повертає {date_str: {group: [(from, to), ...], ...}, ...} або None."""
     try:
-        resp = requests.get(LVIV_API_URL, timeout=15)
-        resp.raise_for_status()
-        data = resp.json()
+        data = _loe_get_json_sync("loe_api", LVIV_API_URL)
 
         member = data.get("hydra:member") or []
         if not member:
@@ -552,202 +1557,285 @@ def _fetch_lviv_schedule_sync() -> dict | None:
                 if date_str and groups:
                     all_schedules[date_str] = groups
         
-        return all_schedules if all_schedules else None
+        if not all_schedules:
+            return None
+        remember_good("loe:schedule", all_schedules)
+        return all_schedules
+    except CircuitOpenError:
+        return None
     except Exception as e:
         logging.error(f"[ЛОЕ] Error fetching Lviv schedule: {e}")
         return None
 
 
 def _search_lviv_cities_sync(name_part: str) -> list[dict]:
-    """Шукає населені пункти Львівської обл. за назвою"""
-    try:
-        resp = requests.get(
-            f"{LVIV_POWER_API_URL}/pw_cities",
-            params={"name": name_part, "pagination": "false"}, timeout=10,
-        )
-        resp.raise_for_status()
-        results = []
-        for item in resp.json().get("hydra:member", []):
-            otg = item.get("otg", {}).get("name", "")
-            results.append({"id": item["id"], "name": item["name"], "otg": otg})
-        return results
-    except Exception as e:
-        logging.error(f"[ЛОЕ] Error searching Lviv cities: {e}")
-        return []
+    """Шукає населені пункти Львівської обл. за назвою (порожня назва — усі).
+    Помилки API не перехоплює."""
+    params = {"pagination": "false"}
+    if name_part:
+        params["name"] = name_part
+    data = _loe_get_json_sync("loe_power", f"{LVIV_POWER_API_URL}/pw_cities", params=params)
+    results = []
+    for item in data.get("hydra:member", []):
+        otg = item.get("otg", {}).get("name", "")
+        results.append({"id": item["id"], "name": item["name"], "otg": otg})
+    return results
 
 
 def _search_lviv_streets_sync(city_id: int, name_part: str) -> list[dict]:
-    """Шукає вулиці у населеному пункті Львівської обл."""
-    try:
-        resp = requests.get(
-            f"{LVIV_POWER_API_URL}/pw_streets",
-            params={"city.id": city_id, "name": name_part, "pagination": "false"}, timeout=10,
-        )
-        resp.raise_for_status()
-        results = []
-        for item in resp.json().get("hydra:member", []):
-            results.append({"id": item["id"], "name": item["name"]})
-        return results
-    except Exception as e:
-        logging.error(f"[ЛОЕ] Error searching Lviv streets: {e}")
-        return []
+    """Шукає вулиці у населеному пункті Львівської обл. (порожня назва — усі).
+    Помилки API не перехоплює."""
+    params = {"city.id": city_id, "pagination": "false"}
+    if name_part:
+        params["name"] = name_part
+    data = _loe_get_json_sync("loe_power", f"{LVIV_POWER_API_URL}/pw_streets", params=params)
+    results = []
+    for item in data.get("hydra:member", []):
+        results.append({"id": item["id"], "name": item["name"]})
+    return results
 
 
 def _find_lviv_group_sync(city_id: int, street_id: int, house: str) -> str | None:
-    """Знаходить групу ГПВ за адресою (Львівська обл.)"""
-    try:
-        resp = requests.get(
-            f"{LVIV_POWER_API_URL}/pw_accounts",
-            params={"city.id": city_id, "street.id": street_id, "buildingName": house, "pagination": "false"},
-            timeout=10,
-        )
-        resp.raise_for_status()
-        members = resp.json().get("hydra:member", [])
-        if not members:
-            return None
-        raw = members[0].get("chergGpv")
-        if raw and len(raw) == 2 and raw.isdigit():
-            return f"{raw[0]}.{raw[1]}"
-        return raw or None
-    except Exception as e:
-        logging.error(f"[ЛОЕ] Error finding Lviv group: {e}")
+    """Знаходить групу ГПВ за адресою (Львівська обл.); None — будинок не знайдено.
+    Помилки API не перехоплює."""
+    data = _loe_get_json_sync(
+        "loe_power", f"{LVIV_POWER_API_URL}/pw_accounts",
+        params={"city.id": city_id, "street.id": street_id, "buildingName": house, "pagination": "false"},
+    )
+    members = data.get("hydra:member", [])
+    if not members:
         return None
+    raw = members[0].get("chergGpv")
+    if raw and len(raw) == 2 and raw.isdigit():
+        return f"{raw[0]}.{raw[1]}"
+    return raw or None
+
+
+# --- ДОВІДНИК АДРЕС ЛОЕ ---
+# Населені пункти та вулиці з відповідей power-api зберігаються в колекції
+# loe_gazetteer і в пам'яті з триграмним індексом. Для кожного рівня довідника
+# запам'ятовуються запити, на які API вже дав повну відповідь: результат
+# уточненого запиту (що починається з такого) — їх підмножина, тож шукаємо локально.
+
+def _fold_name(text: str) -> str:
+    """Назва для пошуку: без регістру, з одним видом апострофа та одинарними пробілами"""
+    return " ".join(_APOSTROPHES.sub("'", text.lower()).split())
+
+
+def _trigrams(text: str) -> set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _name_rank(key: str, query: str) -> tuple[bool, str]:
+    """Порядок результатів: спершу назви, що починаються із запиту, далі за абеткою"""
+    return not key.startswith(query), key
+
+
+class GazetteerScope:
+    """Один рівень довідника: усі населені пункти або вулиці одного пункту"""
+
+    def __init__(self):
+        self.items: dict[int, dict] = {}
+        self.keys: dict[int, str] = {}
+        self.trigrams: dict[str, set[int]] = {}
+        self.covered: set[str] = set()
+
+    def add(self, item: dict):
+        key = _fold_name(item["name"])
+        old_key = self.keys.get(item["id"])
+        if old_key is not None and old_key != key:
+            for gram in _trigrams(old_key):
+                self.trigrams[gram].discard(item["id"])
+        self.items[item["id"]] = item
+        self.keys[item["id"]] = key
+        for gram in _trigrams(key):
+            self.trigrams.setdefault(gram, set()).add(item["id"])
+
+    def covers(self, query: str) -> bool:
+        return any(query[:length] in self.covered for length in range(len(query) + 1))
+
+    def cover(self, query: str) -> bool:
+        """Запам'ятовує повністю отриманий запит. Зберігаються лише найкоротші:
+        довші з тим самим початком зайві. False — запит уже покритий."""
+        if self.covers(query):
+            return False
+        self.covered = {known for known in self.covered if not known.startswith(query)}
+        self.covered.add(query)
+        return True
+
+    def search(self, query: str) -> list[dict]:
+        """Записи, назва яких містить запит; спершу ті, що з нього починаються"""
+        grams = _trigrams(query)
+        if grams:
+            ids = set.intersection(*(self.trigrams.get(gram, set()) for gram in grams))
+        else:
+            ids = self.items.keys()
+        found = [item_id for item_id in ids if query in self.keys[item_id]]
+        found.sort(key=lambda item_id: _name_rank(self.keys[item_id], query))
+        return [self.items[item_id] for item_id in found]
+
+
+class LvivGazetteer:
+    """Локальний пошук населених пунктів і вулиць ЛОЕ та кеш будинок → група"""
+
+    def __init__(self):
+        self.cities = GazetteerScope()
+        self.streets: dict[int, GazetteerScope] = {}
+        self.stats = {"local": 0, "upstream": 0, "groups_cached": 0, "groups_upstream": 0}
+
+    def _scope(self, city_id: int | None) -> GazetteerScope:
+        if city_id is None:
+            return self.cities
+        return self.streets.setdefault(city_id, GazetteerScope())
+
+    async def load(self):
+        """Завантажує довідник з MongoDB у пам'ять"""
+        cities, streets = GazetteerScope(), {}
+        async for doc in db.loe_gazetteer.find({}):
+            city_id = doc.get("city_id")
+            scope = cities if city_id is None else streets.setdefault(city_id, GazetteerScope())
+            if doc["kind"] == "scope":
+                for query in sorted(doc.get("covered", []), key=len):
+                    scope.cover(query)
+            else:
+                scope.add(doc["item"])
+        self.cities, self.streets = cities, streets
+        logging.info(f"📚 [ЛОЕ] Gazetteer loaded: {len(cities.items)} cities, {sum(len(s.items) for s in streets.values())} streets")
+
+    async def _learn(self, city_id: int | None, query: str, items: list[dict]):
+        """Додає відповідь API до довідника; порожній запит замінює весь рівень"""
+        kind = "city" if city_id is None else "street"
+        scope_id = "scope:cities" if city_id is None else f"scope:streets:{city_id}"
+        if query == "":
+            scope = GazetteerScope()
+            if city_id is None:
+                self.cities = scope
+            else:
+                self.streets[city_id] = scope
+        else:
+            scope = self._scope(city_id)
+        newly_covered = scope.cover(query)
+        for item in items:
+            scope.add(item)
+
+        item_ids = [f"{kind}:{city_id}:{item['id']}" for item in items]
+        ops = [
+            UpdateOne({"_id": item_id}, {"$set": {"kind": kind, "city_id": city_id, "item": item}}, upsert=True)
+            for item_id, item in zip(item_ids, items)
+        ]
+        if newly_covered:
+            ops.append(UpdateOne(
+                {"_id": scope_id},
+                {"$set": {"kind": "scope", "city_id": city_id, "covered": sorted(scope.covered)}},
+                upsert=True
+            ))
+        try:
+            if query == "":
+                await db.loe_gazetteer.delete_many({"kind": kind, "city_id": city_id, "_id": {"$nin": item_ids}})
+            await db.loe_gazetteer.bulk_write(ops, ordered=False)
+        except Exception as e:
+            logging.error(f"[ЛОЕ] Gazetteer write error: {e}")
+
+    async def _search(self, city_id: int | None, name_part: str, fetch) -> list[dict]:
+        query = _fold_name(name_part)
+        scope = self._scope(city_id)
+        if scope.covers(query):
+            self.stats["local"] += 1
+            return scope.search(query)
+        self.stats["upstream"] += 1
+        try:
+            items = await asyncio.to_thread(fetch)
+        except Exception as e:
+            logging.error(f"[ЛОЕ] Error searching gazetteer upstream: {e}")
+            # API недоступний — віддаємо те, що вже відомо локально
+            return scope.search(query)
+        # Той самий порядок, що й у локальній відповіді на цей запит
+        items = sorted(items, key=lambda item: _name_rank(_fold_name(item["name"]), query))
+        await self._learn(city_id, query, items)
+        return items
+
+    def is_local(self, city_id: int | None, name_part: str) -> bool:
+        """Чи відповідь на запит уже є в довіднику (без звернення до API)"""
+        scope = self.cities if city_id is None else self.streets.get(city_id)
+        return scope is not None and scope.covers(_fold_name(name_part))
+
+    async def search_cities(self, name_part: str) -> list[dict]:
+        return await self._search(None, name_part, lambda: _search_lviv_cities_sync(name_part))
+
+    async def search_streets(self, city_id: int, name_part: str) -> list[dict]:
+        return await self._search(city_id, name_part, lambda: _search_lviv_streets_sync(city_id, name_part))
+
+    async def find_group(self, city_id: int, street_id: int, house: str) -> str | None:
+        """Група ГПВ для будинку: з кешу або з /pw_accounts. Ненайдені будинки
+        кешуються на ADDRESS_NEGATIVE_TTL, збої API не кешуються."""
+        house_key = re.sub(r"[\s.]", "", _fold_name(house))
+        key = f"{city_id}:{street_id}:{house_key}"
+        try:
+            cached = await db.loe_accounts.find_one({"_id": key, "expires_at": {"$gt": datetime.now(timezone.utc)}})
+        except Exception as e:
+            logging.error(f"[ЛОЕ] Account cache read error: {e}")
+            cached = None
+        if cached:
+            self.stats["groups_cached"] += 1
+            return cached.get("group")
 
+        self.stats["groups_upstream"] += 1
+        try:
+            group = await asyncio.to_thread(_find_lviv_group_sync, city_id, street_id, house)
+        except Exception as e:
+            logging.error(f"[ЛОЕ] Error finding Lviv group: {e}")
+            return None
+        ttl = ADDRESS_CACHE_TTL if group else ADDRESS_NEGATIVE_TTL
+        try:
+            await db.loe_accounts.update_one(
+                {"_id": key},
+                {"$set": {"group": group, "expires_at": datetime.now(timezone.utc) + timedelta(seconds=ttl)}},
+                upsert=True
+            )
+        except Exception as e:
+            logging.error(f"[ЛОЕ] Account cache write error: {e}")
+        return group
 
-def format_lviv_notification(queue_id: str, slots: list[tuple[str, str]], is_update: bool = False, address: str = None, date_str: str = None) -> str:
-    """Форматує графік Львівської області для однієї групи"""
-    days_names = ["Понеділок", "Вівторок", "Середа", "Четвер", "П'ятниця", "Субота", "Неділя"]
-    now = datetime.now(KYIV_TZ)
-    
-    if not date_str:
-        date_str = now.strftime("%d.%m.%Y")
-    
-    day_name = ""
-    try:
-        d, m, y = date_str.split('.')
-        dt = datetime(int(y), int(m), int(d))
-        day_name = days_names[dt.weekday()]
-    except:
-        pass
+    async def refresh(self):
+        """Повне оновлення: усі населені пункти та вулиці пунктів, які вже шукали"""
+        try:
+            cities = await asyncio.to_thread(_search_lviv_cities_sync, "")
+        except Exception as e:
+            logging.error(f"[ЛОЕ] Gazetteer refresh failed: {e}")
+            return
+        await self._learn(None, "", cities)
+        for city_id in list(self.streets):
+            try:
+                streets = await asyncio.to_thread(_search_lviv_streets_sync, city_id, "")
+            except Exception as e:
+                logging.error(f"[ЛОЕ] Gazetteer refresh failed for city {city_id}: {e}")
+                continue
+            await self._learn(city_id, "", streets)
+            await asyncio.sleep(0.2)
+        logging.info(f"📚 [ЛОЕ] Gazetteer refreshed: {len(self.cities.items)} cities, {len(self.streets)} with streets")
 
-    header = "⚡️ *Оновлення ГПВ!*" if is_update else "📊 *Поточний графік*"
-    address_line = f"📍 *Адреса:* {address}\n" if address else ""
 
-    lines = []
-    total_minutes = 0
-    if slots:
-        for start, end in slots:
-            duration_str = ""
-            try:
-                sh, sm = map(int, start.split(":"))
-                eh, em = map(int, end.split(":"))
-                s_min = sh * 60 + sm
-                e_min = eh * 60 + em
-                if e_min == 0:
-                    e_min = 24 * 60
-                diff = e_min - s_min
-                if diff > 0:
-                    total_minutes += diff
-                    h, m = divmod(diff, 60)
-                    duration_str = f" ({h} год)" if m == 0 else f" ({h} год {m} хв)"
-            except Exception:
-                pass
-            lines.append(f"  🔴 {start} - {end}{duration_str}")
-        schedule_str = "\n".join(lines)
-    else:
-        schedule_str = "  ✅ Відключень не заплановано"
+lviv_gazetteer = LvivGazetteer()
 
-    total_str = ""
-    if total_minutes > 0:
-        th, tm = divmod(total_minutes, 60)
-        total_str = f" ({th} год)" if tm == 0 else f" ({th} год {tm} хв)"
 
-    text = (
-        f"{header}\n\n"
-        f"{address_line}"
-        f"🔢 *Група:* {queue_id}\n"
-        f"📅 *{date_str}* _{day_name}_ {total_str}\n\n"
-        f"{schedule_str}"
-    )
-    return text
+async def gazetteer_refresher():
+    """Довідники адрес. Раз на GAZETTEER_REFRESH лідер оновлює довідник ЛОЕ з API,
+    інші репліки перечитують його з MongoDB; індекс вулиць ІФ перечитують усі."""
+    first = True
+    while True:
+        try:
+            await if_street_index.load()
+            if is_leader and LVIV_POWER_API_URL and not first:
+                await lviv_gazetteer.refresh()
+            else:
+                await lviv_gazetteer.load()
+        except Exception as e:
+            logging.error(f"Address directories refresh error: {e}")
+        first = False
+        await asyncio.sleep(GAZETTEER_REFRESH)
+
 
 # --- ФОРМАТУВАННЯ ПОВІДОМЛЕННЯ ---
-def format_notification(queue_id, data, is_update=True, address=None):
-    """Форматує повідомлення з графіками на ВСІ доступні дати"""
-    if not data or not isinstance(data, list):
-        return f"⚠️ Отримано некоректні дані для черги {queue_id}"
-
-    days_names = ["Понеділок", "Вівторок", "Середа", "Четвер", "П'ятниця", "Субота", "Неділя"]
-    
-    header = "⚡️ *Оновлення ГПВ!*" if is_update else "📊 *Поточний графік*"
-    address_line = f"📍 *Адреса:* {address}\n" if address else ""
-    
-    text = f"{header}\n\n{address_line}🔢 *Черга:* {queue_id}\n"
-    
-    # Обробляємо кожну дату
-    for record in data:
-        event_date = record.get("eventDate", "Невідомо")
-        approved_since = record.get("scheduleApprovedSince", "")
-        
-        # День тижня
-        day_name = ""
-        try:
-            day, month, year = event_date.split('.')
-            dt = datetime(int(year), int(month), int(day))
-            day_name = days_names[dt.weekday()]
-        except:
-            pass
-        
-        queue_data = record.get("queues", {}).get(queue_id, [])
-        
-        schedule_lines = []
-        total_minutes = 0
-        if queue_data:
-            for slot in queue_data:
-                start = slot.get('from', '??')
-                end = slot.get('to', '??')
-                
-                # Тривалість
-                duration_str = ""
-                try:
-                    start_h, start_m = map(int, start.split(':'))  
-                    end_h, end_m = map(int, end.split(':'))
-                    start_minutes = start_h * 60 + start_m
-                    end_minutes = end_h * 60 + end_m
-                    if end_minutes == 0:
-                        end_minutes = 24 * 60
-                    diff_minutes = end_minutes - start_minutes
-                    if diff_minutes > 0:
-                        total_minutes += diff_minutes
-                        h = diff_minutes // 60
-                        m = diff_minutes % 60
-                        duration_str = f" ({h} год)" if m == 0 else f" ({h} год {m} хв)"
-                except:
-                    pass
-                
-                schedule_lines.append(f"  🔴 {start} - {end}{duration_str}")
-            
-            schedule_str = "\n".join(schedule_lines)
-        else:
-            schedule_str = "  ✅ Відключень не заплановано"
-        
-        # Додаємо загальну тривалість
-        total_str = ""
-        if total_minutes > 0:
-            total_hours = total_minutes // 60
-            total_mins = total_minutes % 60
-            if total_mins == 0:
-                total_str = f"({total_hours} год)"
-            else:
-                total_str = f"({total_hours} год {total_mins} хв)"
-        
-        text += f"\n📅 *{event_date}* _{day_name}_ {total_str}\n{schedule_str}\n"
-        last_approved = data[-1].get("scheduleApprovedSince", "")
-        if last_approved:
-            text += f"\n🕒 _Затверджено: {last_approved}_"
-    
-    return text
-
 def format_user_status(user_data) -> str:
     """Форматує статус користувача"""
     if user_data:
@@ -885,6 +1973,7 @@ async def cmd_help(message: Message):
         "2. Можна відслідковувати кілька черг одночасно\n"
         "3. Бот автоматично перевіряє графіки\n"
         "4. При змінах вам прийде сповіщення\n\n"
+        "📊 /stats — скільки годин без світла за тиждень\n\n"
         "⏰ *Нагадування:*\n"
         "Обирайте інтервали: 5, 10, 15, 30 хв, 1 або 2 год\n"
         "Налаштувати можна в меню керування чергами\n\n"
@@ -893,8 +1982,33 @@ async def cmd_help(message: Message):
     )
     await message.answer(text, parse_mode=ParseMode.MARKDOWN)
 
+@dp.message(Command("stats"))
+async def cmd_stats(message: Message):
+    user_data = await get_user_data(message.from_user.id)
+    queues = sorted(user_data.get("queues", [])) if user_data else []
+    if not queues:
+        reminders_on = await get_user_reminders_state(message.from_user.id)
+        await message.answer("⚠️ Спочатку оберіть чергу!", reply_markup=get_queue_choice_keyboard(reminders_on), parse_mode=ParseMode.MARKDOWN)
+        return
+    
+    stats = await get_outage_stats(user_data.get("region", REGION_IF), queues)
+    
+    def hours(minutes: int) -> str:
+        return format_duration(minutes) if minutes else "0 год"
+    
+    lines = ["📊 *Без світла за графіками*"]
+    for queue in queues:
+        queue_stats = stats[queue]
+        lines.append(
+            f"\n🔢 *Черга {queue}*\n"
+            f"  Сьогодні: {hours(queue_stats['today'])}\n"
+            f"  Цей тиждень: {hours(queue_stats['week'])}\n"
+            f"  Минулий тиждень: {hours(queue_stats['last_week'])}"
+        )
+    await message.answer("\n".join(lines), parse_mode=ParseMode.MARKDOWN)
+
 # --- ХЕНДЛЕРИ КНОПОК КЛАВІАТУРИ ---
-@dp.message(F.text == BTN_CHECK)
+@dp.message(F.text == BTN_CHECK, flags={"throttle": "check"})
 async def btn_check(message: Message):
     user_data = await get_user_data(message.from_user.id)
     region = user_data.get("region", REGION_IF) if user_data else None
@@ -911,98 +2025,96 @@ async def btn_check(message: Message):
         await message.answer("⚠️ Спочатку оберіть чергу!", reply_markup=get_queue_choice_keyboard(reminders_on), parse_mode=ParseMode.MARKDOWN)
         return
     
-    loading_msg = await message.answer("⏳ Завантажую графіки...")
     address = user_data.get("address") if isinstance(user_data, dict) else None
+    sorted_queues = sorted(user_queues)
     
     if region == REGION_LVIV:
-        # Львівська область
-        all_schedules = await asyncio.to_thread(_fetch_lviv_schedule_sync)
+        # Львівська область — усі групи разом, стільки повідомлень, скільки вимагає ліміт
+        def render(all_schedules: dict) -> list[str]:
+            return pack_messages([format_lviv_check(queue, all_schedules, address=address if len(user_queues) == 1 else None)
+                                  for queue in sorted_queues])
+        
+        # Є графік у кеші — відповідаємо одразу, оновлюємо у фоні
+        cached = LAST_GOOD.get("loe:schedule")
+        if cached:
+            all_schedules, fetched_at = cached
+            await answer_with_revalidation(message, render(all_schedules), fetched_at, "loe_api", refresh_lviv_schedules, render,
+                                           markup=get_donate_keyboard(timeline=True))
+            return
+        
+        loading_msg = await message.answer("⏳ Завантажую графіки...")
+        all_schedules, stale_since = await get_lviv_schedules()
         await loading_msg.delete()
         
         if all_schedules is None:
             await message.answer("❌ Не вдалося отримати дані з API ЛОЕ. Спробуйте пізніше.")
             return
-        
-        for queue in sorted(user_queues):
-            # Збираємо всі дати для цієї черги
-            queue_days = []
-            for date_str in sorted(all_schedules.keys()):
-                day_data = all_schedules[date_str]
-                slots = day_data.get(queue, [])
-                queue_days.append((date_str, slots))
-            # Формуємо зведене повідомлення як в ІФ
-            if queue_days:
-                days_names = ["Понеділок", "Вівторок", "Середа", "Четвер", "П'ятниця", "Субота", "Неділя"]
-                header = "📊 *Поточний графік*"
-                address_line = f"📍 *Адреса:* {address if len(user_queues) == 1 else ''}\n" if address else ""
-                text = f"{header}\n\n{address_line}🔢 *Група:* {queue}\n"
-                for date_str, slots in queue_days:
-                    # День тижня
-                    day_name = ""
-                    try:
-                        d, m, y = date_str.split('.')
-                        dt = datetime(int(y), int(m), int(d))
-                        day_name = days_names[dt.weekday()]
-                    except:
-                        pass
-                    # Тривалість
-                    total_minutes = 0
-                    lines = []
-                    if slots:
-                        for start, end in slots:
-                            duration_str = ""
-                            try:
-                                sh, sm = map(int, start.split(":"))
-                                eh, em = map(int, end.split(":"))
-                                s_min = sh * 60 + sm
-                                e_min = eh * 60 + em
-                                if e_min == 0:
-                                    e_min = 24 * 60
-                                diff = e_min - s_min
-                                if diff > 0:
-                                    total_minutes += diff
-                                    h, m = divmod(diff, 60)
-                                    duration_str = f" ({h} год)" if m == 0 else f" ({h} год {m} хв)"
-                            except Exception:
-                                pass
-                            lines.append(f"  🔴 {start} - {end}{duration_str}")
-                        schedule_str = "\n".join(lines)
-                    else:
-                        schedule_str = "  ✅ Відключень не заплановано"
-                    # Загальна тривалість
-                    total_str = ""
-                    if total_minutes > 0:
-                        th, tm = divmod(total_minutes, 60)
-                        total_str = f" ({th} год)" if tm == 0 else f" ({th} год {tm} хв)"
-                    text += f"\n📅 {date_str} _{day_name}_ {total_str}\n{schedule_str}\n"
-                await message.answer(text, parse_mode=ParseMode.MARKDOWN, reply_markup=get_donate_keyboard())
-                await asyncio.sleep(0.3)
-            else:
-                await message.answer(f"❌ Не вдалося отримати дані для черги {queue}.")
+        stale_note = format_stale_note(stale_since) if stale_since else ""
+        await send_packed(message, render(all_schedules), stale_note, markup=get_donate_keyboard(timeline=True))
     else:
-        # Івано-Франківська область
-        ssl_context = get_ssl_context()
-        connector = aiohttp.TCPConnector(ssl=ssl_context)
+        # Івано-Франківська область — усі черги разом
+        def render(schedules: dict) -> list[str]:
+            return pack_messages([format_notification(queue, schedules[queue], is_update=False, address=address if len(user_queues) == 1 else None)
+                                  for queue in sorted_queues if schedules.get(queue)])
+        
+        # Усі черги є в кеші — відповідаємо одразу, оновлюємо у фоні
+        cached, fetched_at = get_cached_if_schedules(sorted_queues)
+        if cached is not None:
+            await answer_with_revalidation(message, render(cached), fetched_at, "if_api",
+                                           lambda: refresh_if_schedules(sorted_queues, cached), render,
+                                           markup=get_donate_keyboard(timeline=True))
+            return
+        
+        loading_msg = await message.answer("⏳ Завантажую графіки...")
+        schedules, oldest = {}, None
+        for queue in sorted_queues:
+            data, stale_since = await get_if_schedule(queue)
+            if data:
+                schedules[queue] = data
+            if stale_since and (oldest is None or stale_since < oldest):
+                oldest = stale_since
+        
+        await loading_msg.delete()
         
-        async with aiohttp.ClientSession(connector=connector) as session:
-            results = []
-            for queue in sorted(user_queues):
-                data = await fetch_schedule(session, queue)
+        if schedules:
+            await send_packed(message, render(schedules), format_stale_note(oldest) if oldest else "",
+                              markup=get_donate_keyboard(timeline=True))
+        else:
+            await message.answer("❌ Не вдалося отримати дані. Спробуйте пізніше.")
+
+async def send_packed(message: Message, texts: list[str], note: str = "", markup: InlineKeyboardMarkup | None = None):
+    """Надсилає зібрані повідомлення; кнопки (за замовчуванням донат) — під останнім"""
+    markup = markup or get_donate_keyboard()
+    for i, text in enumerate(texts):
+        await message.answer(text + note, parse_mode=ParseMode.MARKDOWN, reply_markup=markup if i == len(texts) - 1 else None)
+
+@dp.callback_query(F.data == "timeline", flags={"throttle": "check"})
+async def cb_timeline(callback: CallbackQuery):
+    """Картинки графіків на запит — кнопка «🖼 Картинка» під «Перевірити графік»"""
+    user_data = await get_user_data(callback.from_user.id)
+    queues = sorted(user_data.get("queues", [])) if user_data else []
+    region = user_data.get("region", REGION_IF) if user_data else REGION_IF
+    if not TIMELINE_IMAGES or not queues:
+        await callback.answer()
+        return
+    await callback.answer("🖼 Готую картинки...")
+    
+    if region == REGION_LVIV:
+        cached = LAST_GOOD.get("loe:schedule")
+        all_schedules = cached[0] if cached else (await get_lviv_schedules())[0]
+        items = lviv_timeline_items(all_schedules, queues) if all_schedules else []
+    else:
+        schedules, _ = get_cached_if_schedules(queues)
+        if schedules is None:
+            schedules = {}
+            for queue in queues:
+                data, _ = await get_if_schedule(queue)
                 if data:
-                    msg = format_notification(queue, data, is_update=False, address=address if len(user_queues) == 1 else None)
-                    results.append(msg)
-            
-            await loading_msg.delete()
-            
-            if results:
-                for i, msg in enumerate(results):
-                    if i == len(results) - 1:
-                        await message.answer(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=get_donate_keyboard())
-                    else:
-                        await message.answer(msg, parse_mode=ParseMode.MARKDOWN)
-                    await asyncio.sleep(0.3)
-            else:
-                await message.answer("❌ Не вдалося отримати дані. Спробуйте пізніше.")
+                    schedules[queue] = data
+        items = if_timeline_items(schedules, queues)
+    
+    if not await send_timeline_album(callback.message.chat.id, region, items):
+        await callback.message.answer("❌ Не вдалося підготувати картинки. Спробуйте пізніше.")
 
 @dp.message(F.text == BTN_MY_QUEUE)
 async def btn_my_queue(message: Message):
@@ -1060,6 +2172,25 @@ async def cb_show_donate(callback: CallbackQuery):
     await callback.message.answer(get_donate_text(), parse_mode=ParseMode.MARKDOWN)
     await callback.answer()
 
+@dp.callback_query(F.data.startswith("full|"), flags={"throttle": "check"})
+async def cb_full_schedule(callback: CallbackQuery):
+    """Повний графік дати під коротким сповіщенням про зміни"""
+    _, region, queue_id, date = callback.data.split("|", 3)
+    slots = None
+    if region == REGION_LVIV:
+        schedules, _ = await get_lviv_schedules()
+        if schedules and date in schedules:
+            slots = schedules[date].get(queue_id, [])
+    else:
+        data, _ = await get_if_schedule(queue_id)
+        slots = extract_all_schedules(data if isinstance(data, list) else (data or {}).get("schedule", []), queue_id).get(date)
+    
+    if slots is None:
+        await callback.answer("⚠️ Графік на цю дату вже недоступний", show_alert=True)
+        return
+    await callback.message.answer(format_schedule_notification(queue_id, date, slots, "updated"), parse_mode=ParseMode.MARKDOWN)
+    await callback.answer()
+
 # --- FSM ХЕНДЛЕРИ ДЛЯ АДРЕСИ ---
 @dp.message(AddressForm.waiting_for_city)
 async def process_city(message: Message, state: FSMContext):
@@ -1075,7 +2206,7 @@ async def process_city(message: Message, state: FSMContext):
     )
     await message.answer(text, reply_markup=get_cancel_keyboard(), parse_mode=ParseMode.MARKDOWN)
 
-@dp.message(AddressForm.waiting_for_street)
+@dp.message(AddressForm.waiting_for_street, flags={"throttle": "lookup"})
 async def process_street(message: Message, state: FSMContext):
     input_text = message.text.strip()
     
@@ -1101,22 +2232,65 @@ async def process_street(message: Message, state: FSMContext):
     data = await state.get_data()
     city = data.get('city')
     
+    # Схожі вулиці, за якими вже знаходили чергу, — пропонуємо до запиту в API
+    suggestions = if_street_index.suggest(city, street)
+    if suggestions:
+        IF_STREET_STATS["suggested"] += 1
+        await state.update_data(pending_street=street, pending_house=house, street_suggestions=suggestions)
+        await message.answer(
+            "🤔 *Можливо, ви мали на увазі:*",
+            reply_markup=get_street_suggestions_keyboard(suggestions, street),
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return
+    
+    await lookup_if_address(message, state, message.from_user.id, city, street, house)
+
+@dp.callback_query(AddressForm.waiting_for_street, F.data.startswith("ifstreet|"), flags={"throttle": "lookup"})
+async def cb_if_street_select(callback: CallbackQuery, state: FSMContext):
+    choice = callback.data.split("|", 1)[1]
+    data = await state.get_data()
+    suggestions = data.get("street_suggestions", [])
+    house = data.get("pending_house")
+    
+    if choice == "typed":
+        street = data.get("pending_street")
+        IF_STREET_STATS["kept_typed"] += 1
+    elif choice.isdigit() and int(choice) < len(suggestions):
+        street = suggestions[int(choice)]
+        IF_STREET_STATS["accepted"] += 1
+    else:
+        street = None
+    
+    if not street or not house:
+        await callback.answer("⚠️ Введіть адресу ще раз", show_alert=True)
+        return
+    
+    await callback.answer()
+    try:
+        await callback.message.edit_text(f"✅ *Вулиця:* {street}", parse_mode=ParseMode.MARKDOWN)
+    except TelegramBadRequest:
+        pass
+    await lookup_if_address(callback.message, state, callback.from_user.id, data.get("city"), street, house)
+
+async def lookup_if_address(message: Message, state: FSMContext, user_id: int, city: str, street: str, house: str):
+    """Пошук черги за адресою ІФ і відповідь користувачу"""
     full_address = f"{city}, {street}, {house}"
     
     loading_msg = await message.answer(f"⏳ Шукаю чергу для адреси:\n*{full_address}*...", parse_mode=ParseMode.MARKDOWN)
     
-    result = await fetch_schedule_by_address(city, street, house)
+    result = await resolve_address_queue(city, street, house)
     
     await loading_msg.delete()
     
     if result:
-        queue, schedule = extract_queue_from_response(result)
+        queue, schedule = result
         
-        if queue and schedule:
-            await add_queue_to_user(message.from_user.id, queue, full_address)
+        if queue:
+            await add_queue_to_user(user_id, queue, full_address)
             await state.clear()
             
-            user_queues = await get_user_queues(message.from_user.id)
+            user_queues = await get_user_queues(user_id)
             queues_str = ", ".join(sorted(user_queues))
             
             text = (
@@ -1128,11 +2302,31 @@ async def process_street(message: Message, state: FSMContext):
             )
             await message.answer(text, reply_markup=get_main_keyboard(has_queue=True), parse_mode=ParseMode.MARKDOWN)
             
-            msg = format_notification(queue, schedule, is_update=False, address=full_address)
+            def render(schedules: dict) -> list[str]:
+                records = _if_records(schedules.get(queue))
+                if not records:
+                    return [f"📊 *Черга {queue}*\n\n{NO_OUTAGES}"]
+                return [format_notification(queue, records, is_update=False, address=full_address)]
+            
+            # Графік черги вже є в кеші — відповідаємо одразу з позначкою часу, оновлюємо у фоні
+            cached, fetched_at = get_cached_if_schedules([queue])
+            if cached is not None:
+                await answer_with_revalidation(message, render(cached), fetched_at, "if_api",
+                                               lambda: refresh_if_schedules([queue], cached), render)
+                return
+            
+            if schedule is None:
+                # Адреса з кешу, а графіка черги ще немає в пам'яті — чекаємо на оновлення
+                data, _ = await get_if_schedule(queue)
+                schedule = _if_records(data) if data else None
+            if schedule is None:
+                msg = f"📊 *Черга {queue}*\n\n⚠️ Графік зараз недоступний, спробуйте «{BTN_CHECK}» пізніше."
+            else:
+                msg = render({queue: schedule})[0]
             await message.answer(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=get_donate_keyboard())
         else:
             await state.clear()
-            reminders_on = await get_user_reminders_state(message.from_user.id)
+            reminders_on = await get_user_reminders_state(user_id)
             await message.answer(
                 "⚠️ Не вдалося визначити чергу для цієї адреси.\n\n"
                 "Спробуйте ввести адресу ще раз або оберіть чергу вручну.",
@@ -1141,7 +2335,7 @@ async def process_street(message: Message, state: FSMContext):
             )
     else:
         await state.clear()
-        reminders_on = await get_user_reminders_state(message.from_user.id)
+        reminders_on = await get_user_reminders_state(user_id)
         await message.answer(
             "❌ Адресу не знайдено.\n\n"
             "Перевірте правильність написання та спробуйте ще раз.",
@@ -1150,24 +2344,33 @@ async def process_street(message: Message, state: FSMContext):
         )
 
 # --- FSM ХЕНДЛЕРИ ДЛЯ АДРЕСИ (ЛЬВІВ) ---
-@dp.message(LvivAddressForm.waiting_for_city_search)
+def get_pressed_button_text(callback: CallbackQuery) -> str | None:
+    """Текст натиснутої inline-кнопки"""
+    markup = callback.message.reply_markup if callback.message else None
+    if markup:
+        for row in markup.inline_keyboard:
+            for button in row:
+                if button.callback_data == callback.data:
+                    return button.text
+    return None
+
+@dp.message(LvivAddressForm.waiting_for_city_search, flags={"throttle": "lookup"})
 async def lviv_city_search(message: Message, state: FSMContext):
     query = message.text.strip()
     if len(query) < 2:
         await message.answer("⚠️ Введіть хоча б 2 символи.", reply_markup=get_cancel_keyboard())
         return
     
-    loading = await message.answer("🔍 Шукаю...")
-    cities = await asyncio.to_thread(_search_lviv_cities_sync, query)
-    await loading.delete()
+    # Запит піде в API — показуємо, що шукаємо
+    loading = None if lviv_gazetteer.is_local(None, query) else await message.answer("🔍 Шукаю...")
+    cities = await lviv_gazetteer.search_cities(query)
+    if loading:
+        await loading.delete()
     
     if not cities:
         await message.answer("❌ Населений пункт не знайдено. Спробуйте ще раз:", reply_markup=get_cancel_keyboard())
         return
     
-    cities_map = {str(c["id"]): c["name"] for c in cities[:20]}
-    await state.update_data(cities_map=cities_map)
-    
     buttons = []
     for c in cities[:20]:
         label = f"{c['name']} ({c['otg']})" if c["otg"] else c["name"]
@@ -1183,12 +2386,12 @@ async def lviv_city_search(message: Message, state: FSMContext):
     )
 
 
-@dp.callback_query(F.data.startswith("lcity|"))
+@dp.callback_query(F.data.startswith("lcity|"), flags={"throttle": "lookup"})
 async def cb_lviv_city_select(callback: CallbackQuery, state: FSMContext):
     city_id = callback.data.split("|", 1)[1]
-    data = await state.get_data()
-    cities_map = data.get("cities_map", {})
-    city_name = cities_map.get(city_id, f"ID:{city_id}")
+    # Назву беремо з натиснутої кнопки — варіанти пошуку у стані не зберігаються
+    label = get_pressed_button_text(callback)
+    city_name = re.sub(r"\s*\([^()]*\)$", "", label) if label else f"ID:{city_id}"
     
     await state.update_data(city_id=city_id, city_name=city_name)
     await state.set_state(LvivAddressForm.waiting_for_street_search)
@@ -1203,7 +2406,7 @@ async def cb_lviv_city_select(callback: CallbackQuery, state: FSMContext):
         pass
 
 
-@dp.message(LvivAddressForm.waiting_for_street_search)
+@dp.message(LvivAddressForm.waiting_for_street_search, flags={"throttle": "lookup"})
 async def lviv_street_search(message: Message, state: FSMContext):
     query = message.text.strip()
     if len(query) < 2:
@@ -1213,17 +2416,15 @@ async def lviv_street_search(message: Message, state: FSMContext):
     data = await state.get_data()
     city_id = int(data["city_id"])
     
-    loading = await message.answer("🔍 Шукаю...")
-    streets = await asyncio.to_thread(_search_lviv_streets_sync, city_id, query)
-    await loading.delete()
+    loading = None if lviv_gazetteer.is_local(city_id, query) else await message.answer("🔍 Шукаю...")
+    streets = await lviv_gazetteer.search_streets(city_id, query)
+    if loading:
+        await loading.delete()
     
     if not streets:
         await message.answer("❌ Вулицю не знайдено. Спробуйте ще:", reply_markup=get_cancel_keyboard())
         return
     
-    streets_map = {str(s["id"]): s["name"] for s in streets[:20]}
-    await state.update_data(streets_map=streets_map)
-    
     buttons = []
     for s in streets[:20]:
         buttons.append([InlineKeyboardButton(text=s["name"], callback_data=f"lstreet|{s['id']}")])  
@@ -1238,12 +2439,11 @@ async def lviv_street_search(message: Message, state: FSMContext):
     )
 
 
-@dp.callback_query(F.data.startswith("lstreet|"))
+@dp.callback_query(F.data.startswith("lstreet|"), flags={"throttle": "lookup"})
 async def cb_lviv_street_select(callback: CallbackQuery, state: FSMContext):
     street_id = callback.data.split("|", 1)[1]
     data = await state.get_data()
-    streets_map = data.get("streets_map", {})
-    street_name = streets_map.get(street_id, f"ID:{street_id}")
+    street_name = get_pressed_button_text(callback) or f"ID:{street_id}"
     city_name = data.get("city_name", "")
     
     await state.update_data(street_id=street_id, street_name=street_name)
@@ -1260,7 +2460,7 @@ async def cb_lviv_street_select(callback: CallbackQuery, state: FSMContext):
         pass
 
 
-@dp.message(LvivAddressForm.waiting_for_house)
+@dp.message(LvivAddressForm.waiting_for_house, flags={"throttle": "lookup"})
 async def lviv_house_input(message: Message, state: FSMContext):
     house = message.text.strip()
     if not house:
@@ -1274,7 +2474,7 @@ async def lviv_house_input(message: Message, state: FSMContext):
     street_name = data.get("street_name", "")
     
     loading = await message.answer("🔍 Шукаю групу...")
-    group = await asyncio.to_thread(_find_lviv_group_sync, city_id, street_id, house)
+    group = await lviv_gazetteer.find_group(city_id, street_id, house)
     await loading.delete()
     await state.clear()
     
@@ -1295,8 +2495,18 @@ async def lviv_house_input(message: Message, state: FSMContext):
         await message.answer(text, reply_markup=get_main_keyboard(has_queue=True), parse_mode=ParseMode.MARKDOWN)
         
         # Показуємо графік одразу
+        def render(schedules: dict) -> list[str]:
+            return [format_lviv_notification(group, schedules[date_str].get(group, []), address=full_address, date_str=date_str)
+                    for date_str in schedules]
+        
+        cached = LAST_GOOD.get("loe:schedule")
+        if cached:
+            schedules, fetched_at = cached
+            await answer_with_revalidation(message, render(schedules), fetched_at, "loe_api", refresh_lviv_schedules, render)
+            return
+        
         loading2 = await message.answer("⏳ Завантажую графік...")
-        schedules = await asyncio.to_thread(_fetch_lviv_schedule_sync)
+        schedules, stale_since = await get_lviv_schedules()
         await loading2.delete()
         
         if schedules is not None:
@@ -1304,6 +2514,8 @@ async def lviv_house_input(message: Message, state: FSMContext):
             for i, date_str in enumerate(date_keys):
                 slots = schedules[date_str].get(group, [])
                 msg = format_lviv_notification(group, slots, address=full_address, date_str=date_str)
+                if stale_since:
+                    msg += format_stale_note(stale_since)
                 if i == len(date_keys) - 1:
                     await message.answer(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=get_donate_keyboard())
                 else:
@@ -1374,7 +2586,7 @@ async def cb_back_choice(callback: CallbackQuery):
     await callback.message.edit_text(text, reply_markup=get_queue_choice_keyboard(reminders_on), parse_mode=ParseMode.MARKDOWN)
     await callback.answer()
 
-@dp.callback_query(F.data.startswith("queue_"))
+@dp.callback_query(F.data.startswith("queue_"), flags={"throttle": "toggle"})
 async def cb_queue_select(callback: CallbackQuery):
     queue = callback.data.replace("queue_", "")
     
@@ -1397,7 +2609,7 @@ async def cb_queue_select(callback: CallbackQuery):
     text = "🔢 *Оберіть черги для відслідковування:*\n\n✅ — підписані\nНатисніть на чергу щоб додати/видалити"
     await callback.message.edit_text(text, reply_markup=get_queue_list_keyboard(user_queues), parse_mode=ParseMode.MARKDOWN)
 
-@dp.callback_query(F.data == "done_select")
+@dp.callback_query(F.data == "done_select", flags={"throttle": "check"})
 async def cb_done_select(callback: CallbackQuery):
     """Завершення вибору черг"""
     user_queues = await get_user_queues(callback.from_user.id)
@@ -1421,7 +2633,18 @@ async def cb_done_select(callback: CallbackQuery):
         sorted_queues = sorted(user_queues)
         
         if region == REGION_LVIV:
-            all_schedules = await asyncio.to_thread(_fetch_lviv_schedule_sync)
+            def render(all_schedules: dict) -> list[str]:
+                return [format_lviv_notification(queue, day_data.get(queue, []), date_str=date_str)
+                        for queue in sorted_queues for date_str, day_data in all_schedules.items()]
+            
+            cached = LAST_GOOD.get("loe:schedule")
+            if cached:
+                all_schedules, fetched_at = cached
+                await answer_with_revalidation(callback.message, render(all_schedules), fetched_at, "loe_api", refresh_lviv_schedules, render)
+                await callback.answer()
+                return
+            
+            all_schedules, stale_since = await get_lviv_schedules()
             if all_schedules:
                 messages = []
                 for queue in sorted_queues:
@@ -1430,24 +2653,36 @@ async def cb_done_select(callback: CallbackQuery):
                         messages.append((queue, slots, date_str))
                 for i, (queue, slots, date_str) in enumerate(messages):
                     msg = format_lviv_notification(queue, slots, date_str=date_str)
+                    if stale_since:
+                        msg += format_stale_note(stale_since)
                     if i == len(messages) - 1:
                         await callback.message.answer(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=get_donate_keyboard())
                     else:
                         await callback.message.answer(msg, parse_mode=ParseMode.MARKDOWN)
                     await asyncio.sleep(0.3)
         else:
-            ssl_context = get_ssl_context()
-            connector = aiohttp.TCPConnector(ssl=ssl_context)
-            async with aiohttp.ClientSession(connector=connector) as session:
-                for i, queue in enumerate(sorted_queues):
-                    data = await fetch_schedule(session, queue)
-                    if data:
-                        msg = format_notification(queue, data, is_update=False)
-                        if i == len(sorted_queues) - 1:
-                            await callback.message.answer(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=get_donate_keyboard())
-                        else:
-                            await callback.message.answer(msg, parse_mode=ParseMode.MARKDOWN)
-                    await asyncio.sleep(0.3)
+            def render(schedules: dict) -> list[str]:
+                return [format_notification(queue, schedules[queue], is_update=False)
+                        for queue in sorted_queues if schedules.get(queue)]
+            
+            cached, fetched_at = get_cached_if_schedules(sorted_queues)
+            if cached is not None:
+                await answer_with_revalidation(callback.message, render(cached), fetched_at, "if_api",
+                                               lambda: refresh_if_schedules(sorted_queues, cached), render)
+                await callback.answer()
+                return
+            
+            for i, queue in enumerate(sorted_queues):
+                data, stale_since = await get_if_schedule(queue)
+                if data:
+                    msg = format_notification(queue, data, is_update=False)
+                    if stale_since:
+                        msg += format_stale_note(stale_since)
+                    if i == len(sorted_queues) - 1:
+                        await callback.message.answer(msg, parse_mode=ParseMode.MARKDOWN, reply_markup=get_donate_keyboard())
+                    else:
+                        await callback.message.answer(msg, parse_mode=ParseMode.MARKDOWN)
+                await asyncio.sleep(0.3)
     else:
         reminders_on = await get_user_reminders_state(callback.from_user.id)
         text = "⚠️ *Ви не обрали жодної черги*\n\nОберіть хоча б одну чергу для відслідковування."
@@ -1455,7 +2690,7 @@ async def cb_done_select(callback: CallbackQuery):
     
     await callback.answer()
 
-@dp.callback_query(F.data == "toggle_reminders")
+@dp.callback_query(F.data == "toggle_reminders", flags={"throttle": "toggle"})
 async def cb_toggle_reminders(callback: CallbackQuery):
     """Перемикає стан нагадувань і оновлює екран налаштувань"""
     new_state = await toggle_user_reminders(callback.from_user.id)
@@ -1485,385 +2720,1134 @@ async def cb_toggle_reminders(callback: CallbackQuery):
     state_text = "увімкнено" if new_state else "вимкнено"
     await callback.answer(f"🔔 Нагадування {state_text}!")
 
-@dp.callback_query(F.data == "reminder_settings")
-async def cb_reminder_settings(callback: CallbackQuery):
-    """Показує налаштування інтервалів нагадувань"""
-    intervals = await get_user_reminder_intervals(callback.from_user.id)
-    reminders_on = await get_user_reminders_state(callback.from_user.id)
-    
-    if intervals:
-        selected = [AVAILABLE_REMINDER_INTERVALS[i] for i in sorted(intervals, reverse=True) if i in AVAILABLE_REMINDER_INTERVALS]
-        selected_text = ", ".join(selected)
-    else:
-        selected_text = "не обрано"
-    
-    status_text = "увімкнено ✅" if reminders_on else "вимкнено ❌"
-    
-    text = (
-        "⏰ *Налаштування нагадувань*\n\n"
-        f"*Стан:* {status_text}\n"
-        f"*Обрані інтервали:* {selected_text}\n\n"
-        "Натисніть на інтервал щоб додати/видалити:"
-    )
-    
-    await callback.message.edit_text(text, reply_markup=get_reminder_intervals_keyboard(intervals, reminders_on), parse_mode=ParseMode.MARKDOWN)
-    await callback.answer()
+@dp.callback_query(F.data == "reminder_settings")
+async def cb_reminder_settings(callback: CallbackQuery):
+    """Показує налаштування інтервалів нагадувань"""
+    intervals = await get_user_reminder_intervals(callback.from_user.id)
+    reminders_on = await get_user_reminders_state(callback.from_user.id)
+    
+    if intervals:
+        selected = [AVAILABLE_REMINDER_INTERVALS[i] for i in sorted(intervals, reverse=True) if i in AVAILABLE_REMINDER_INTERVALS]
+        selected_text = ", ".join(selected)
+    else:
+        selected_text = "не обрано"
+    
+    status_text = "увімкнено ✅" if reminders_on else "вимкнено ❌"
+    
+    text = (
+        "⏰ *Налаштування нагадувань*\n\n"
+        f"*Стан:* {status_text}\n"
+        f"*Обрані інтервали:* {selected_text}\n\n"
+        "Натисніть на інтервал щоб додати/видалити:"
+    )
+    
+    await callback.message.edit_text(text, reply_markup=get_reminder_intervals_keyboard(intervals, reminders_on), parse_mode=ParseMode.MARKDOWN)
+    await callback.answer()
+
+@dp.callback_query(F.data.startswith("reminder_int_"), flags={"throttle": "toggle"})
+async def cb_toggle_reminder_interval(callback: CallbackQuery):
+    """Перемикає інтервал нагадування"""
+    interval = int(callback.data.replace("reminder_int_", ""))
+    
+    if interval not in AVAILABLE_REMINDER_INTERVALS:
+        await callback.answer("❌ Невідомий інтервал!", show_alert=True)
+        return
+    
+    new_intervals = await toggle_reminder_interval(callback.from_user.id, interval)
+    reminders_on = await get_user_reminders_state(callback.from_user.id)
+    
+    if new_intervals:
+        selected = [AVAILABLE_REMINDER_INTERVALS[i] for i in sorted(new_intervals, reverse=True) if i in AVAILABLE_REMINDER_INTERVALS]
+        selected_text = ", ".join(selected)
+    else:
+        selected_text = "не обрано"
+    
+    status_text = "увімкнено ✅" if reminders_on else "вимкнено ❌"
+    
+    text = (
+        "⏰ *Налаштування нагадувань*\n\n"
+        f"*Стан:* {status_text}\n"
+        f"*Обрані інтервали:* {selected_text}\n\n"
+        "Натисніть на інтервал щоб додати/видалити:"
+    )
+    
+    await callback.message.edit_text(text, reply_markup=get_reminder_intervals_keyboard(new_intervals, reminders_on), parse_mode=ParseMode.MARKDOWN)
+    
+    label = AVAILABLE_REMINDER_INTERVALS[interval]
+    if interval in new_intervals:
+        await callback.answer(f"✅ {label} додано")
+    else:
+        await callback.answer(f"➖ {label} видалено")
+
+@dp.callback_query(F.data == "unsubscribe")
+async def cb_unsubscribe(callback: CallbackQuery):
+    user_queues = await get_user_queues(callback.from_user.id)
+    
+    if not user_queues:
+        await callback.answer("ℹ️ У вас немає активних підписок", show_alert=True)
+        return
+    
+    await remove_user_queue(callback.from_user.id)
+    
+    text = "🔕 *Всі підписки скасовано*\n\nВи більше не отримуватимете сповіщення."
+    await callback.message.edit_text(text, parse_mode=ParseMode.MARKDOWN)
+    await callback.message.answer("Меню оновлено:", reply_markup=get_main_keyboard(has_queue=False))
+    await callback.answer("✅ Підписки скасовано")
+
+# --- ОСНОВНИЙ ЦИКЛ ПЕРЕВІРКИ ---
+def extract_all_schedules(data, queue_id: str) -> dict:
+    """
+    Витягує графіки для ВСІХ дат.
+    Повертає: {"20.01.2026": [...hours...], "21.01.2026": [...hours...]}
+    """
+    result = {}
+    
+    if not data or not isinstance(data, list):
+        return result
+    
+    for record in data:
+        event_date = record.get("eventDate")
+        if not event_date:
+            continue
+            
+        queue_hours = record.get("queues", {}).get(queue_id, [])
+        
+        simplified_hours = []
+        for slot in queue_hours:
+            simplified_hours.append({
+                "from": slot.get("from"),
+                "to": slot.get("to"),
+                "status": slot.get("status")
+            })
+        
+        result[event_date] = simplified_hours
+    
+    return result
+
+
+# --- ПЛАНУВАЛЬНИК ОПИТУВАННЯ ---
+REGION_LABELS = {REGION_IF: "ІФ", REGION_LVIV: "ЛОЕ"}
+
+
+class PollStats:
+    """Статистика опитування регіону: пропущені дедлайни та фактична частота"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.polls = 0
+        self.missed_deadlines = 0
+        self.max_lateness = 0.0
+        self.last_duration = 0.0
+        self.first_started: float | None = None
+        self.last_started: float | None = None
+
+    def record_start(self, started: float, lateness: float):
+        if self.first_started is None:
+            self.first_started = started
+        self.last_started = started
+        self.polls += 1
+        self.max_lateness = max(self.max_lateness, lateness)
+
+    def effective_per_minute(self) -> float:
+        """Фактична кількість опитувань за хвилину"""
+        if self.polls < 2 or self.last_started <= self.first_started:
+            return 0.0
+        return (self.polls - 1) * 60 / (self.last_started - self.first_started)
+
+    def as_dict(self) -> dict:
+        return {
+            "interval": self.interval,
+            "polls": self.polls,
+            "missed_deadlines": self.missed_deadlines,
+            "max_lateness_sec": round(self.max_lateness, 2),
+            "last_duration_sec": round(self.last_duration, 2),
+            "effective_per_minute": round(self.effective_per_minute(), 3),
+        }
+
+
+POLL_STATS: dict[str, PollStats] = {}
+
+
+class AdaptivePollPolicy:
+    """Обирає інтервал опитування регіону за історією змін:
+    мінімальний — одразу після зміни та в історично активні години,
+    експоненційне зростання до максимуму — у тихі періоди."""
+
+    ACTIVE_HOUR_RATIO = 0.25  # година активна, якщо в ній >= 25% змін найактивнішої години
+
+    def __init__(self, region: str, base: float, floor: float, ceiling: float, boost_window: float):
+        self.region = region
+        self.base = base
+        self.floor = min(floor, ceiling)
+        self.ceiling = ceiling
+        self.boost_window = boost_window
+        self.current = base
+        self.hour_counts = [0] * 24
+        self.last_change: datetime | None = None
+        # Для звіту
+        self.started_at = datetime.now(KYIV_TZ)
+        self.polls = 0
+        self.changes = 0
+        self.detection_intervals = 0.0
+
+    def load_history(self, seen_times: list[datetime]):
+        """Заповнює погодинну гістограму зі збережених часів змін"""
+        for seen_at in seen_times:
+            if seen_at.tzinfo is None:
+                seen_at = seen_at.replace(tzinfo=timezone.utc)
+            seen_at = seen_at.astimezone(KYIV_TZ)
+            self.hour_counts[seen_at.hour] += 1
+            if self.last_change is None or seen_at > self.last_change:
+                self.last_change = seen_at
+
+    def is_active_hour(self, now: datetime) -> bool:
+        peak = max(self.hour_counts)
+        if peak == 0:
+            return False
+        # Враховуємо і наступну годину, щоб прискоритись заздалегідь
+        threshold = peak * self.ACTIVE_HOUR_RATIO
+        return max(self.hour_counts[now.hour], self.hour_counts[(now.hour + 1) % 24]) >= threshold
+
+    def next_interval(self, changed: bool, holding: bool = False) -> float:
+        """holding — зміна вже помічена, але ще відстоює вікно згладжування:
+        опитуємо часто, проте не рахуємо її ще раз"""
+        now = datetime.now(KYIV_TZ)
+        self.polls += 1
+        if changed:
+            self.changes += 1
+            self.detection_intervals += self.current
+            self.hour_counts[now.hour] += 1
+            self.last_change = now
+
+        if holding or (self.last_change and (now - self.last_change).total_seconds() < self.boost_window):
+            self.current = self.floor
+        elif self.is_active_hour(now):
+            self.current = self.floor
+        else:
+            # Тихий період: подвоюємо інтервал (не менше базового) до стелі
+            self.current = min(self.ceiling, max(self.current * 2, self.base))
+        self.current = max(self.floor, min(self.ceiling, self.current))
+        return self.current
+
+    def report(self) -> dict:
+        """Порівняння з фіксованим інтервалом CHECK_INTERVAL"""
+        elapsed = (datetime.now(KYIV_TZ) - self.started_at).total_seconds()
+        fixed_polls = elapsed / self.base if self.base else 0
+        # Середня затримка виявлення ≈ половина інтервалу, що діяв до виявлення
+        latency = self.detection_intervals / self.changes / 2 if self.changes else None
+        peak = max(self.hour_counts)
+        return {
+            "current_interval": self.current,
+            "polls": self.polls,
+            "fixed_interval_polls": round(fixed_polls),
+            "requests_ratio": round(self.polls / fixed_polls, 3) if fixed_polls else None,
+            "changes_detected": self.changes,
+            "est_detection_latency_sec": round(latency, 1) if latency is not None else None,
+            "fixed_detection_latency_sec": self.base / 2,
+            "active_hours": [h for h in range(24) if peak and self.hour_counts[h] >= peak * self.ACTIVE_HOUR_RATIO],
+        }
+
+
+POLL_POLICIES: dict[str, AdaptivePollPolicy] = {}
+
+
+async def record_poll_change(region: str):
+    """Зберігає час виявленої зміни для навчання адаптивного опитування"""
+    try:
+        await db.poll_changes.insert_one({"region": region, "seen_at": datetime.now(KYIV_TZ)})
+    except Exception as e:
+        logging.error(f"Error saving poll change for {region}: {e}")
+
+
+async def get_poll_policy(region: str) -> AdaptivePollPolicy:
+    """Створює політику регіону та завантажує історію змін з MongoDB"""
+    policy = AdaptivePollPolicy(region, CHECK_INTERVAL, POLL_MIN_INTERVAL, POLL_MAX_INTERVAL, POLL_BOOST_WINDOW)
+    try:
+        since = datetime.now(KYIV_TZ) - timedelta(days=POLL_HISTORY_DAYS)
+        cursor = db.poll_changes.find({"region": region, "seen_at": {"$gte": since}}, {"seen_at": 1})
+        events = await cursor.to_list(length=None)
+        policy.load_history([e["seen_at"] for e in events])
+        logging.info(f"[{REGION_LABELS.get(region, region)}] Adaptive polling: {len(events)} changes in history")
+    except Exception as e:
+        logging.error(f"Error loading poll history for {region}: {e}")
+    POLL_POLICIES[region] = policy
+    return policy
+
+
+async def run_fixed_rate(region: str, poll_once, interval: float, initial_delay: float = 0, policy: AdaptivePollPolicy = None):
+    """Запускає poll_once з фіксованим темпом: наступний старт рахується від дедлайну,
+    а не від завершення попереднього циклу. Пропущені дедлайни рахуються і пропускаються.
+    Якщо задано policy, інтервал після кожного циклу обирає вона (poll_once повертає
+    (changed, holding): чи була зміна і чи є зміни, що ще чекають згладжування)."""
+    label = REGION_LABELS.get(region, region)
+    stats = POLL_STATS.setdefault(region, PollStats(interval))
+    loop = asyncio.get_running_loop()
+    await asyncio.sleep(initial_delay)
+
+    deadline = loop.time()
+    while True:
+        started = loop.time()
+        stats.record_start(started, started - deadline)
+        changed = holding = False
+        try:
+            changed, holding = await poll_once()
+        except Exception as e:
+            logging.error(f"[{label}] Checker error: {e}")
+        finished = loop.time()
+        stats.last_duration = finished - started
+
+        if policy:
+            if changed:
+                await record_poll_change(region)
+            interval = policy.next_interval(changed, holding)
+            stats.interval = interval
+
+        deadline += interval
+        if finished > deadline:
+            missed = int((finished - deadline) // interval) + 1
+            stats.missed_deadlines += missed
+            deadline += missed * interval
+            logging.warning(f"[{label}] Poll took {stats.last_duration:.1f}s, missed {missed} deadline(s)")
+        await asyncio.sleep(max(0.0, deadline - loop.time()))
+
+
+# --- ІСТОРІЯ ГРАФІКІВ ---
+# schedule_history — документ на кожну нову версію графіка (регіон, черга, дата):
+# номер версії, час появи та хеш вмісту. Самі відрізки лежать у schedule_blobs
+# одним документом на унікальний вміст (однакові графіки різних черг — один запис)
+# у вигляді плаского списку хвилин [від, до, від, до, ...].
+_HISTORY_LAST: dict[tuple[str, str, str], tuple[int, str]] = {}
+
+
+def _history_day(date_str: str) -> str | None:
+    """'dd.mm.YYYY' → 'YYYY-MM-DD' (сортується як рядок)"""
+    date_obj = _parse_date(date_str)
+    return date_obj.isoformat() if date_obj else None
+
+
+def _encode_slots(day: DaySchedule) -> list[int]:
+    return [minute for span in day.spans for minute in span]
+
+
+def _schedule_hash(day: DaySchedule) -> str:
+    return hashlib.sha1(json.dumps(_encode_slots(day)).encode()).hexdigest()[:16]
+
+
+def _decode_slots(encoded: list[int]) -> list[dict]:
+    return [
+        {"from": hhmm(encoded[i]), "to": hhmm(encoded[i + 1])}
+        for i in range(0, len(encoded), 2)
+    ]
+
+
+async def archive_schedule(region: str, queue_id: str, date_str: str, day: DaySchedule):
+    """Додає версію графіка в історію, якщо вміст відрізняється від останньої збереженої"""
+    history_day = _history_day(date_str)
+    if not history_day:
+        return
+    encoded = _encode_slots(day)
+    blob_hash = _schedule_hash(day)
+    key = (region, queue_id, history_day)
+
+    last = _HISTORY_LAST.get(key)
+    if last is None:
+        doc = await db.schedule_history.find_one(
+            {"region": region, "queue": queue_id, "day": history_day}, sort=[("v", -1)]
+        )
+        last = (doc["v"], doc["blob"]) if doc else (0, None)
+    if last[1] == blob_hash:
+        _HISTORY_LAST[key] = last
+        return
+
+    version = last[0] + 1
+    now = datetime.now(timezone.utc)
+    if len(_HISTORY_LAST) > 5000:
+        # Минулі дні більше не перевіряються — кеш просто скидається
+        _HISTORY_LAST.clear()
+    # Блоб пишеться першим: версія в історії ніколи не посилається на відсутній блоб.
+    # Якщо вставка версії не вдасться, блоб лишиться без посилань — його прибере
+    # cleanup_orphan_blobs (touched_at не дає прибрати блоб, який саме використовують)
+    await db.schedule_blobs.update_one(
+        {"_id": blob_hash},
+        {"$setOnInsert": {"slots": encoded, "created_at": now}, "$set": {"touched_at": now}},
+        upsert=True,
+    )
+    try:
+        await db.schedule_history.insert_one({
+            "_id": f"{region}:{queue_id}:{history_day}:{version}",
+            "region": region, "queue": queue_id, "day": history_day,
+            "v": version, "blob": blob_hash, "seen_at": now,
+        })
+    except DuplicateKeyError:
+        # Версію вже записав інший процес — перечитаємо при наступному виклику
+        _HISTORY_LAST.pop(key, None)
+        return
+    _HISTORY_LAST[key] = (version, blob_hash)
+    await update_outage_rollups(region, queue_id, history_day, day.outage_minutes)
+
+
+async def cleanup_orphan_blobs():
+    """Видаляє блоби графіків, на які не посилається жодна версія історії
+    (лишаються, якщо запис версії після запису блоба не вдався)"""
+    try:
+        cutoff = datetime.now(timezone.utc) - timedelta(days=1)
+        pipeline = [
+            {"$match": {"touched_at": {"$lt": cutoff}}},
+            {"$lookup": {"from": "schedule_history", "localField": "_id", "foreignField": "blob", "as": "refs",
+                         "pipeline": [{"$limit": 1}, {"$project": {"_id": 1}}]}},
+            {"$match": {"refs": []}},
+            {"$project": {"_id": 1}},
+        ]
+        orphans = [doc["_id"] async for doc in db.schedule_blobs.aggregate(pipeline)]
+        if orphans:
+            result = await db.schedule_blobs.delete_many({"_id": {"$in": orphans}, "touched_at": {"$lt": cutoff}})
+            logging.info(f"Cleaned {result.deleted_count} orphan schedule blobs")
+    except Exception as e:
+        logging.error(f"Error cleaning schedule blobs: {e}")
+
+
+async def get_schedule_history(region: str, queue_id: str, day_from: str, day_to: str) -> list[dict]:
+    """Усі версії графіків черги за дні [day_from, day_to] ('YYYY-MM-DD')"""
+    docs = await db.schedule_history.find(
+        {"region": region, "queue": queue_id, "day": {"$gte": day_from, "$lte": day_to}},
+        sort=[("day", 1), ("v", 1)]
+    ).to_list(length=None)
+    blobs = {}
+    hashes = list({doc["blob"] for doc in docs})
+    async for blob in db.schedule_blobs.find({"_id": {"$in": hashes}}):
+        blobs[blob["_id"]] = blob["slots"]
+    return [
+        {"day": doc["day"], "version": doc["v"], "seen_at": doc["seen_at"].isoformat(),
+         "slots": _decode_slots(blobs.get(doc["blob"], []))}
+        for doc in docs
+    ]
+
+
+# --- СТАТИСТИКА ВІДКЛЮЧЕНЬ ---
+# outage_rollups — готові підсумки хвилин без світла за графіками, один документ
+# на ISO-тиждень: week:{region}:{queue}:{YYYY-Www} з полем days {YYYY-MM-DD: хвилини}.
+# Нова версія графіка замінює одне поле days одним записом, тож день і тиждень
+# не можуть розійтися; тижневий підсумок — сума days при читанні за _id.
+
+def _week_key(day_obj) -> str:
+    year, week, _ = day_obj.isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+async def update_outage_rollups(region: str, queue_id: str, history_day: str, minutes: int):
+    """Хвилини доби записуються ($set) у документ її тижня"""
+    week = _week_key(datetime.fromisoformat(history_day).date())
+    await db.outage_rollups.update_one(
+        {"_id": f"week:{region}:{queue_id}:{week}"},
+        {"$set": {f"days.{history_day}": minutes, "kind": "week", "region": region, "queue": queue_id,
+                  "period": week, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True,
+    )
+
+
+async def get_outage_stats(region: str, queues: list[str]) -> dict[str, dict]:
+    """Хвилини без світла за графіками: сьогодні, цей і минулий тиждень — для кожної черги"""
+    today = datetime.now(KYIV_TZ).date()
+    weeks = {"week": _week_key(today), "last_week": _week_key(today - timedelta(days=7))}
+    ids = {queue: {name: f"week:{region}:{queue}:{week}" for name, week in weeks.items()} for queue in queues}
+    all_ids = [doc_id for by_week in ids.values() for doc_id in by_week.values()]
+    found = {doc["_id"]: doc.get("days", {}) async for doc in db.outage_rollups.find({"_id": {"$in": all_ids}})}
+    return {
+        queue: {
+            "today": found.get(ids[queue]["week"], {}).get(today.isoformat(), 0),
+            "week": sum(found.get(ids[queue]["week"], {}).values()),
+            "last_week": sum(found.get(ids[queue]["last_week"], {}).values()),
+        }
+        for queue in queues
+    }
+
+
+# --- КАРТИНКИ ГРАФІКІВ ---
+# Картинка залежить лише від регіону, черги, дати та вмісту графіка. Перше
+# надсилання завантажує PNG, далі всі підписники й «Перевірити графік» отримують
+# file_id з Telegram. Кеш у пам'яті та в колекції timeline_images (спільний для
+# реплік і воркерів розсилки); нова версія графіка — новий ключ.
+TIMELINE_STATS = {"hits": 0, "uploads": 0, "renders": 0, "render_ms": 0.0, "invalidated": 0}
+TIMELINE_KEEP = 3 * 86400
+TIMELINE_ALBUM_SIZE = 10
+
+_TIMELINE_FILE_IDS: dict[str, str] = {}
+_TIMELINE_LOCKS: dict[str, asyncio.Lock] = {}
+_TIMELINE_LOCK_USERS: dict[str, int] = {}
+# Фрагменти помилок Telegram про сам файл (а не про підпис чи розмітку)
+FILE_ID_ERRORS = ("wrong file identifier", "wrong remote file identifier", "file reference", "file_reference")
+
+
+def timeline_key(region: str, queue_id: str, date_str: str, day: DaySchedule) -> str:
+    return f"{region}:{queue_id}:{date_str}:{_schedule_hash(day)}"
+
+
+def _file_id_rejected(error: TelegramBadRequest) -> bool:
+    message = str(error).lower()
+    return any(marker in message for marker in FILE_ID_ERRORS)
+
+
+def _remember_timeline(key: str, file_id: str):
+    if len(_TIMELINE_FILE_IDS) > 5000:
+        # Старі дати більше не надсилаються — кеш просто скидається
+        _TIMELINE_FILE_IDS.clear()
+    _TIMELINE_FILE_IDS[key] = file_id
+
+
+async def _get_timeline_file_id(key: str) -> str | None:
+    file_id = _TIMELINE_FILE_IDS.get(key)
+    if file_id is not None:
+        return file_id
+    try:
+        doc = await db.timeline_images.find_one({"_id": key})
+    except Exception as e:
+        logging.error(f"Timeline cache read error: {e}")
+        return None
+    if doc:
+        _remember_timeline(key, doc["file_id"])
+        return doc["file_id"]
+    return None
+
+
+async def _store_timeline(key: str, file_id: str):
+    _remember_timeline(key, file_id)
+    try:
+        await db.timeline_images.update_one(
+            {"_id": key},
+            {"$setOnInsert": {
+                "file_id": file_id,
+                "expires_at": datetime.now(timezone.utc) + timedelta(seconds=TIMELINE_KEEP),
+            }},
+            upsert=True
+        )
+    except Exception as e:
+        logging.error(f"Timeline cache write error: {e}")
+
+
+async def _forget_timeline(key: str):
+    TIMELINE_STATS["invalidated"] += 1
+    _TIMELINE_FILE_IDS.pop(key, None)
+    try:
+        await db.timeline_images.delete_one({"_id": key})
+    except Exception as e:
+        logging.error(f"Timeline cache delete error: {e}")
+
+
+async def render_timeline_png(queue_id: str, date_str: str, day: DaySchedule) -> bytes:
+    """Рендер у потоці, щоб не блокувати цикл подій"""
+    started = time.perf_counter()
+    png = await asyncio.to_thread(render_timeline, day, queue_id, date_str)
+    TIMELINE_STATS["renders"] += 1
+    TIMELINE_STATS["render_ms"] += (time.perf_counter() - started) * 1000
+    return png
+
+
+async def send_schedule_photo(chat_id: int, region: str, queue_id: str, date_str: str, day: DaySchedule,
+                              caption: str, **kwargs) -> Message | None:
+    """Надсилає графік картинкою з підписом caption (у межах send_budget).
+    None — картинки вимкнені, підпис задовгий або Telegram відхилив фото
+    (застарілий file_id, помилка розмітки підпису): тоді повідомлення треба
+    надіслати текстом. Кеш скидається лише тоді, коли відхилено сам файл."""
+    if not TIMELINE_IMAGES or not fits_caption(caption):
+        return None
+    key = timeline_key(region, queue_id, date_str, day)
+    file_id = await _get_timeline_file_id(key)
+    if file_id is None:
+        # Завантажує лише перше надсилання, решта чекає на його file_id.
+        # Замок видаляється, коли його вже ніхто не чекає — інакше нове
+        # надсилання створило б свій замок і завантажило картинку вдруге.
+        lock = _TIMELINE_LOCKS.setdefault(key, asyncio.Lock())
+        _TIMELINE_LOCK_USERS[key] = _TIMELINE_LOCK_USERS.get(key, 0) + 1
+        try:
+            async with lock:
+                file_id = await _get_timeline_file_id(key)
+                if file_id is None:
+                    png = await render_timeline_png(queue_id, date_str, day)
+                    try:
+                        sent = await send_photo_with_retry(chat_id, BufferedInputFile(png, "schedule.png"), caption=caption, **kwargs)
+                    except TelegramBadRequest as e:
+                        logging.warning(f"Timeline photo rejected for {key}: {e}")
+                        return None
+                    TIMELINE_STATS["uploads"] += 1
+                    if sent.photo:
+                        await _store_timeline(key, sent.photo[-1].file_id)
+                    return sent
+        finally:
+            _TIMELINE_LOCK_USERS[key] -= 1
+            if not _TIMELINE_LOCK_USERS[key]:
+                del _TIMELINE_LOCK_USERS[key]
+                _TIMELINE_LOCKS.pop(key, None)
+
+    TIMELINE_STATS["hits"] += 1
+    try:
+        return await send_photo_with_retry(chat_id, file_id, caption=caption, **kwargs)
+    except TelegramBadRequest as e:
+        logging.warning(f"Timeline photo rejected for {key}: {e}")
+        if _file_id_rejected(e):
+            await _forget_timeline(key)
+        return None
+
+
+def if_timeline_items(schedules: dict, queues: list[str]) -> list[tuple[str, str, DaySchedule]]:
+    return [
+        (queue, record["eventDate"], day_schedule(record.get("queues", {}).get(queue, [])))
+        for queue in queues for record in schedules.get(queue) or [] if record.get("eventDate")
+    ]
+
+
+def lviv_timeline_items(all_schedules: dict, queues: list[str]) -> list[tuple[str, str, DaySchedule]]:
+    return [
+        (queue, date_str, day_schedule(all_schedules[date_str].get(queue, [])))
+        for queue in queues for date_str in sorted(all_schedules)
+    ]
+
+
+async def send_timeline_album(chat_id: int, region: str, items: list[tuple[str, str, DaySchedule]]) -> bool:
+    """Картинки графіків на запит (кнопка «🖼 Картинка») — одним альбомом (до 10 шт.)
+    у межах send_budget. Відсутні в кеші картинки рендеряться паралельно."""
+    if not TIMELINE_IMAGES or not items:
+        return False
+    items = items[:TIMELINE_ALBUM_SIZE]
+    keys = [timeline_key(region, queue_id, date_str, day) for queue_id, date_str, day in items]
+    file_ids = []
+    try:
+        file_ids = list(await asyncio.gather(*(_get_timeline_file_id(key) for key in keys)))
+        missing = [i for i, file_id in enumerate(file_ids) if file_id is None]
+        pngs = await asyncio.gather(*(render_timeline_png(*items[i]) for i in missing))
+        photos = list(file_ids)
+        for i, png in zip(missing, pngs):
+            photos[i] = BufferedInputFile(png, "schedule.png")
+        TIMELINE_STATS["hits"] += len(items) - len(missing)
+
+        if len(photos) == 1:
+            sent = [await send_photo_with_retry(chat_id, photos[0])]
+        else:
+            sent = await send_media_group_with_retry(chat_id, [InputMediaPhoto(media=photo) for photo in photos])
+        for key, file_id, message in zip(keys, file_ids, sent):
+            if file_id is None and message.photo:
+                TIMELINE_STATS["uploads"] += 1
+                await _store_timeline(key, message.photo[-1].file_id)
+        return True
+    except TelegramBadRequest as e:
+        logging.warning(f"Timeline album rejected for {chat_id}: {e}")
+        if _file_id_rejected(e):
+            # Якийсь file_id застарів — наступного разу ці картинки завантажаться заново
+            for key, file_id in zip(keys, file_ids):
+                if file_id is not None:
+                    await _forget_timeline(key)
+    except Exception as e:
+        logging.error(f"Timeline album error for {chat_id}: {e}")
+    return False
+
+
+def timeline_stats() -> dict:
+    renders = TIMELINE_STATS["renders"]
+    sends = TIMELINE_STATS["hits"] + TIMELINE_STATS["uploads"]
+    return {
+        **TIMELINE_STATS,
+        "render_ms": round(TIMELINE_STATS["render_ms"], 1),
+        "avg_render_ms": round(TIMELINE_STATS["render_ms"] / renders, 2) if renders else 0,
+        "hit_rate": round(TIMELINE_STATS["hits"] / sends, 3) if sends else 0,
+    }
+
+
+# --- РОЗСИЛКА ЗМІН (OUTBOX) ---
+# Задачі розсилки зберігаються в MongoDB (колекція outbox): одна задача на
+# (зміну, шард, пакет підписників). Ключ задачі — ідемпотентний: повторне виявлення
+# тієї ж зміни після перезапуску не створює дублікатів.
+outbox_wakeup = asyncio.Event()
+
+
+class SendBudget:
+    """Глобальний ліміт надсилань за секунду (щоб тримати ліміти Telegram).
+    shared — спільний лічильник у MongoDB (колекція send_budget, документ на
+    секунду), з якого кожен процес бере токени порціями; інакше — локальний."""
+
+    def __init__(self, rate: int, shared: bool, workers: int = 1):
+        self.rate = rate
+        self.shared = shared
+        self.chunk = max(1, rate // (2 * max(1, workers)))
+        self.waits = 0
+        self._second = 0
+        self._tokens = 0
+        self._exhausted = False
+        self._lock = asyncio.Lock()
+
+    async def _grant(self, second: int) -> int:
+        if not self.shared:
+            self._exhausted = True
+            return self.rate
+        for _ in range(2):
+            try:
+                doc = await db.send_budget.find_one_and_update(
+                    {"_id": second},
+                    {"$inc": {"used": self.chunk}, "$setOnInsert": {"created_at": datetime.now(timezone.utc)}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                )
+                break
+            except DuplicateKeyError:
+                # Два процеси одночасно створили документ секунди — повторюємо
+                continue
+        else:
+            return 0
+        granted = max(0, min(self.chunk, self.rate - (doc["used"] - self.chunk)))
+        if granted < self.chunk:
+            self._exhausted = True
+        return granted
+
+    async def acquire(self):
+        """Чекає на дозвіл надіслати одне повідомлення"""
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.time()
+                second = int(now)
+                if second != self._second:
+                    self._second = second
+                    self._tokens = 0
+                    self._exhausted = False
+                if self._tokens == 0 and not self._exhausted:
+                    self._tokens = await self._grant(second)
+                if self._tokens > 0:
+                    self._tokens -= 1
+                    return
+                self.waits += 1
+                await asyncio.sleep(second + 1 - now)
+
+
+# Лічильник завжди спільний: надсилати можуть і кілька реплік, і процеси-воркери
+send_budget = SendBudget(SEND_RATE_LIMIT, shared=True, workers=FANOUT_WORKERS)
+
+
+def get_shard(user_id: int) -> int:
+    """Шард воркера розсилки для користувача"""
+    return user_id % FANOUT_WORKERS if FANOUT_WORKERS > 1 else 0
+
+
+async def get_subscribers(queue_id: str, region: str) -> list[tuple[int, str | None]]:
+    """Повертає [(user_id, address)] підписників черги одним запитом"""
+    query = {"$or": [{"queues": queue_id}, {"queue": queue_id}], "region": region}
+    cursor = db.users.find(query, {"user_id": 1, "address": 1})
+    users = await cursor.to_list(length=None)
+    return [(user["user_id"], user.get("address")) for user in users]
+
+
+async def enqueue_changes(region: str, queue_id: str, change_key: str, changes: list):
+    """Ставить зміни в outbox пакетами по OUTBOX_BATCH_SIZE підписників одного шарду.
+    Підписники, які вже є в задачах цієї зміни (повторне виявлення після падіння),
+    пропускаються: між падінням і повтором список підписників міг змінитись, і
+    пакети інакше зсунулись би — той самий користувач потрапив би у дві задачі."""
+    change_key = f"{region}:{change_key}"
+    subscribers = await get_subscribers(queue_id, region)
+    if not subscribers:
+        return
+    queued = set()
+    async for job in db.outbox.find({"change_key": change_key}, {"recipients": 1}):
+        queued.update(user_id for user_id, _ in job["recipients"])
+
+    by_shard: dict[int, list] = {}
+    for user_id, address in sorted(subscribers, key=lambda subscriber: subscriber[0]):
+        if user_id not in queued:
+            by_shard.setdefault(get_shard(user_id), []).append((user_id, address))
+    if not by_shard:
+        return
+
+    now = datetime.now(KYIV_TZ)
+    ops = []
+    for shard, shard_subscribers in by_shard.items():
+        for start in range(0, len(shard_subscribers), OUTBOX_BATCH_SIZE):
+            batch = shard_subscribers[start:start + OUTBOX_BATCH_SIZE]
+            # Ключ пакета — від його вмісту (перший і останній user_id), а не від номера
+            job_id = f"{change_key}:{shard}:{batch[0][0]}-{batch[-1][0]}"
+            ops.append(_outbox_job_op(job_id, change_key, region, queue_id, shard, changes, batch, now))
+    result = await db.outbox.bulk_write(ops, ordered=False)
+    logging.info(f"[{REGION_LABELS.get(region, region)}] Outbox: {result.upserted_count} new job(s) for {queue_id}")
+    outbox_wakeup.set()
+
+
+def _outbox_job_op(job_id: str, change_key: str, region: str, queue_id: str, shard: int, changes: list,
+                   batch: list, now: datetime) -> UpdateOne:
+    """Upsert задачі outbox: існуюча задача з тим самим ключем не змінюється"""
+    return UpdateOne(
+        {"_id": job_id},
+        {"$setOnInsert": {
+            "change_key": change_key,
+            "region": region,
+            "queue_id": queue_id,
+            "shard": shard,
+            "changes": changes,
+            "recipients": [[user_id, address] for user_id, address in batch],
+            "sent": [],
+            "failed": [],
+            "status": "pending",
+            "attempts": 0,
+            "locked_until": now,
+            "created_at": now,
+        }},
+        upsert=True,
+    )
+
+
+async def claim_outbox_job(shard: int | None = None) -> dict | None:
+    """Бере в роботу найстарішу незавершену задачу (свого шарду), оренда якої вільна"""
+    now = datetime.now(KYIV_TZ)
+    query = {"status": "pending", "locked_until": {"$lte": now}}
+    if shard is not None:
+        query["shard"] = shard
+    return await db.outbox.find_one_and_update(
+        query,
+        {"$set": {"locked_until": now + timedelta(seconds=OUTBOX_LEASE)}, "$inc": {"attempts": 1}},
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def _send_with_retry(send, chat_id: int, content, **kwargs):
+    """Надсилання у межах send_budget з повтором після TelegramRetryAfter (429)"""
+    for _ in range(3):
+        await send_budget.acquire()
+        try:
+            return await send(chat_id, content, **kwargs)
+        except TelegramRetryAfter as e:
+            logging.warning(f"Flood control for {chat_id}, retry after {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+    await send_budget.acquire()
+    return await send(chat_id, content, **kwargs)
+
+
+async def send_message_with_retry(chat_id: int, text: str, **kwargs):
+    return await _send_with_retry(bot.send_message, chat_id, text, **kwargs)
+
+
+async def send_photo_with_retry(chat_id: int, photo, **kwargs):
+    return await _send_with_retry(bot.send_photo, chat_id, photo, **kwargs)
+
+
+async def send_media_group_with_retry(chat_id: int, media: list, **kwargs):
+    return await _send_with_retry(bot.send_media_group, chat_id, media, **kwargs)
+
+
+# Помилки, після яких повторювати надсилання користувачу немає сенсу
+PERMANENT_SEND_ERRORS = ("chat not found", "user is deactivated", "bot was blocked", "peer_id_invalid")
+
+
+def _is_permanent_send_error(error: Exception) -> bool:
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    message = str(error).lower()
+    return isinstance(error, TelegramBadRequest) and any(marker in message for marker in PERMANENT_SEND_ERRORS)
+
+
+async def deliver_outbox_job(job: dict):
+    """Розсилає задачу; кожна доставка підтверджується в outbox,
+    тож після перезапуску вже обслужені підписники пропускаються.
+    Після тимчасової помилки (мережа, 5xx, 429 після повторів, MongoDB) підписник
+    лишається непідтвердженим — із запам'ятованою кількістю вже надісланих дат —
+    і задача повертається в роботу, щойно спливе оренда. У failed потрапляють лише
+    ті, хто заблокував бота чи видалив чат, або після OUTBOX_RECIPIENT_ATTEMPTS спроб."""
+    region = job["region"]
+    queue_id = job["queue_id"]
+    changes = job["changes"]
+    label = REGION_LABELS.get(region, region)
+    done = set(job.get("sent", [])) | set(job.get("failed", []))
+    progress = job.get("progress", {})
+    retries = job.get("retries", {})
+    pending = False
+
+    for user_id, address in job["recipients"]:
+        if user_id in done:
+            continue
+        delivered = progress.get(str(user_id), 0)
+        try:
+            # Окреме повідомлення для кожної зміненої дати; вже надіслані до збою — пропускаємо
+            for i, change in enumerate(changes):
+                if i < delivered:
+                    continue
+                # Задачі до появи дельт мають три поля, без попередньої версії
+                date, hours, change_type, *rest = change
+                previous = rest[0] if rest else None
+                is_last = i == len(changes) - 1
+                msg = format_schedule_delta(queue_id, date, previous, hours, address) if previous is not None else None
+                if msg:
+                    markup = get_full_schedule_keyboard(region, queue_id, date, donate=is_last)
+                else:
+                    msg = format_schedule_notification(queue_id, date, hours, change_type, address)
+                    # Додаємо кнопку донату до останнього повідомлення
+                    markup = get_donate_keyboard() if is_last else None
+                sent = await send_schedule_photo(user_id, region, queue_id, date, day_schedule(hours), msg,
+                                                 parse_mode=ParseMode.MARKDOWN, reply_markup=markup)
+                if sent is None:
+                    await send_message_with_retry(user_id, msg, parse_mode=ParseMode.MARKDOWN, reply_markup=markup)
+                delivered = i + 1
+
+            logging.info(f"[{label}] Notifications sent to {user_id} for {queue_id}")
+            ack = {"$addToSet": {"sent": user_id}, "$set": {}}
+        except Exception as e:
+            attempts = retries.get(str(user_id), 0) + 1
+            if _is_permanent_send_error(e) or attempts >= OUTBOX_RECIPIENT_ATTEMPTS:
+                logging.error(f"[{label}] Failed to send to {user_id}: {e}")
+                ack = {"$addToSet": {"failed": user_id}, "$set": {}}
+            else:
+                logging.warning(f"[{label}] Send to {user_id} will be retried ({attempts}/{OUTBOX_RECIPIENT_ATTEMPTS}): {e}")
+                ack = {"$set": {f"progress.{user_id}": delivered, f"retries.{user_id}": attempts}}
+                pending = True
+
+        ack["$set"]["locked_until"] = datetime.now(KYIV_TZ) + timedelta(seconds=OUTBOX_LEASE)
+        await db.outbox.update_one({"_id": job["_id"]}, ack)
 
-@dp.callback_query(F.data.startswith("reminder_int_"))
-async def cb_toggle_reminder_interval(callback: CallbackQuery):
-    """Перемикає інтервал нагадування"""
-    interval = int(callback.data.replace("reminder_int_", ""))
-    
-    if interval not in AVAILABLE_REMINDER_INTERVALS:
-        await callback.answer("❌ Невідомий інтервал!", show_alert=True)
+    if pending:
+        # Задача лишається pending і повернеться в роботу після оренди
         return
-    
-    new_intervals = await toggle_reminder_interval(callback.from_user.id, interval)
-    reminders_on = await get_user_reminders_state(callback.from_user.id)
-    
-    if new_intervals:
-        selected = [AVAILABLE_REMINDER_INTERVALS[i] for i in sorted(new_intervals, reverse=True) if i in AVAILABLE_REMINDER_INTERVALS]
-        selected_text = ", ".join(selected)
-    else:
-        selected_text = "не обрано"
-    
-    status_text = "увімкнено ✅" if reminders_on else "вимкнено ❌"
-    
-    text = (
-        "⏰ *Налаштування нагадувань*\n\n"
-        f"*Стан:* {status_text}\n"
-        f"*Обрані інтервали:* {selected_text}\n\n"
-        "Натисніть на інтервал щоб додати/видалити:"
+    await db.outbox.update_one(
+        {"_id": job["_id"]},
+        {"$set": {"status": "done", "finished_at": datetime.now(KYIV_TZ)}}
     )
-    
-    await callback.message.edit_text(text, reply_markup=get_reminder_intervals_keyboard(new_intervals, reminders_on), parse_mode=ParseMode.MARKDOWN)
-    
-    label = AVAILABLE_REMINDER_INTERVALS[interval]
-    if interval in new_intervals:
-        await callback.answer(f"✅ {label} додано")
-    else:
-        await callback.answer(f"➖ {label} видалено")
 
-@dp.callback_query(F.data == "unsubscribe")
-async def cb_unsubscribe(callback: CallbackQuery):
-    user_queues = await get_user_queues(callback.from_user.id)
-    
-    if not user_queues:
-        await callback.answer("ℹ️ У вас немає активних підписок", show_alert=True)
-        return
-    
-    await remove_user_queue(callback.from_user.id)
-    
-    text = "🔕 *Всі підписки скасовано*\n\nВи більше не отримуватимете сповіщення."
-    await callback.message.edit_text(text, parse_mode=ParseMode.MARKDOWN)
-    await callback.message.answer("Меню оновлено:", reply_markup=get_main_keyboard(has_queue=False))
-    await callback.answer("✅ Підписки скасовано")
 
-# --- ОСНОВНИЙ ЦИКЛ ПЕРЕВІРКИ ---
-def extract_all_schedules(data, queue_id: str) -> dict:
-    """
-    Витягує графіки для ВСІХ дат.
-    Повертає: {"20.01.2026": [...hours...], "21.01.2026": [...hours...]}
-    """
-    result = {}
-    
-    if not data or not isinstance(data, list):
-        return result
-    
-    for record in data:
-        event_date = record.get("eventDate")
-        if not event_date:
+async def outbox_worker(shard: int | None = None):
+    """Розсилає задачі з outbox незалежно від циклу опитування.
+    Незавершені задачі (після перезапуску) підхоплюються, щойно спливе їхня оренда.
+    shard=None — всі задачі, інакше лише задачі свого шарду."""
+    logging.info(f"📤 Outbox worker started (shard: {'all' if shard is None else shard})")
+    while True:
+        try:
+            job = await claim_outbox_job(shard)
+        except Exception as e:
+            logging.error(f"Outbox claim error: {e}")
+            job = None
+
+        if job is None:
+            try:
+                timeout = OUTBOX_POLL_INTERVAL if shard is None else OUTBOX_SHARD_POLL_INTERVAL
+                await asyncio.wait_for(outbox_wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            outbox_wakeup.clear()
             continue
-            
-        queue_hours = record.get("queues", {}).get(queue_id, [])
-        
-        simplified_hours = []
-        for slot in queue_hours:
-            simplified_hours.append({
-                "from": slot.get("from"),
-                "to": slot.get("to"),
-                "status": slot.get("status")
-            })
-        
-        result[event_date] = simplified_hours
-    
-    return result
 
-def format_schedule_notification(queue_id: str, date: str, hours: list, change_type: str, address: str = None) -> str:
-    """
-    Форматує сповіщення про зміну графіку.
-    change_type: "new" | "updated"
-    """
-    # День тижня
-    day_name = ""
+        if job["attempts"] > OUTBOX_MAX_ATTEMPTS:
+            logging.error(f"Outbox job {job['_id']} dropped after {job['attempts'] - 1} attempts")
+            await db.outbox.update_one({"_id": job["_id"]}, {"$set": {"status": "failed", "finished_at": datetime.now(KYIV_TZ)}})
+            continue
+
+        try:
+            await deliver_outbox_job(job)
+        except Exception as e:
+            logging.error(f"Outbox job {job['_id']} error: {e}")
+
+
+def _parse_date(date_str: str):
+    """'dd.mm.YYYY' → date або None"""
     try:
-        day, month, year = date.split('.')
-        dt = datetime(int(year), int(month), int(day))
-        days = ["Понеділок", "Вівторок", "Середа", "Четвер", "П'ятниця", "Субота", "Неділя"]
-        day_name = days[dt.weekday()]
-    except:
-        pass
+        day, month, year = date_str.split('.')
+        return datetime(int(year), int(month), int(day)).date()
+    except Exception:
+        return None
 
-    # Заголовок
-    if change_type == "new":
-        header = f"📅 *Додано новий графік на {date}*"
-    else:
-        header = f"🔄 *Оновлено графік на {date}*"
-    
-    # Години
-    schedule_lines = []
-    total_minutes = 0
-    if hours:
-        for slot in hours:
-            start = slot.get('from', '??')
-            end = slot.get('to', '??')
-            
-            # Тривалість
-            duration_str = ""
-            try:
-                start_h, start_m = map(int, start.split(':'))
-                end_h, end_m = map(int, end.split(':'))
-                start_minutes = start_h * 60 + start_m
-                end_minutes = end_h * 60 + end_m
-                if end_minutes == 0:
-                    end_minutes = 24 * 60
-                diff_minutes = end_minutes - start_minutes
-                if diff_minutes > 0:
-                    total_minutes += diff_minutes
-                    h = diff_minutes // 60
-                    m = diff_minutes % 60
-                    duration_str = f" ({h} год)" if m == 0 else f" ({h} год {m} хв)"
-            except:
-                pass
-            
-            schedule_lines.append(f"🔴 {start} - {end}{duration_str}")
-        
-        schedule_str = "\n".join(schedule_lines)
-    else:
-        schedule_str = "✅ Відключень не заплановано"
-    
-    # Додаємо загальну тривалість до заголовка
-    if total_minutes > 0:
-        total_hours = total_minutes // 60
-        total_mins = total_minutes % 60
-        if total_mins == 0:
-            total_str = f" ({total_hours} год)"
-        else:
-            total_str = f" ({total_hours} год {total_mins} хв)"
-        if change_type == "new":
-            header = f"📅 *Додано новий графік на {date}{total_str}*"
-        else:
-            header = f"🔄 *Оновлено графік на {date}{total_str}*"
-    
-    address_line = f"📍 {address}\n" if address else ""
 
-    text = (
-        f"{header}\n"
-        f"_{day_name}_\n\n"
-        f"{address_line}"
-        f"🔢 Черга: *{queue_id}*\n\n"
-        f"{schedule_str}"
-    )
-    return text
+async def _load_saved_schedules(state_key: str) -> tuple[dict, int]:
+    """Завантажує збережений стан {date: [[from, to], ...]} для ключа черги та його версію.
+    Старий формат зберігав для дати рядок json.dumps(slots) — його розбираємо назад у відрізки."""
+    saved_state_json, version = await get_schedule_state_versioned(state_key)
+    if saved_state_json:
+        try:
+            saved = json.loads(saved_state_json)
+        except Exception:
+            return {}, version
+        for date, slots in saved.items():
+            if isinstance(slots, str):
+                try:
+                    saved[date] = json.loads(slots)
+                except Exception:
+                    saved[date] = []
+        return saved, version
+    return {}, version
 
 
-async def lviv_scheduled_checker():
-    """Моніторинг графіків Львівської області (ЛОЕ)"""
-    logging.info("🚀 [ЛОЕ] Monitor started")
-    await asyncio.sleep(15)
-    
-    while True:
+SUPPRESSED_CHANGES = {"noise": 0}
+
+# Вікно згладжування: held — відкладені версії, replaced — замінені новішою до
+# відправки, reverted — скасовані поверненням до надісланої, released — надіслані
+COALESCE_STATS = {"held": 0, "replaced": 0, "reverted": 0, "released": 0, "messages_avoided": 0}
+
+
+async def _load_pending_changes(state_key: str) -> dict:
+    """Відкладені зміни черги {date: документ}"""
+    if not COALESCE_WINDOW:
+        return {}
+    docs = await db.pending_changes.find({"state_key": state_key}).to_list(length=None)
+    return {doc["date"]: doc for doc in docs}
+
+
+async def _count_subscribers(queue_id: str, region: str) -> int:
+    return await db.users.count_documents({"$or": [{"queues": queue_id}, {"queue": queue_id}], "region": region})
+
+
+async def _coalesce_change(region: str, queue_id: str, state_key: str, date: str, held: dict | None,
+                           day: DaySchedule, stored: list, now: datetime) -> bool:
+    """Притримує зміну дати. True — версія відстояла вікно і її час надсилати."""
+    if held and day_schedule(held["slots"]).same_outages(day):
+        since, changed_at = held["since"], held["changed_at"]
+        if since.tzinfo is None:
+            since, changed_at = since.replace(tzinfo=timezone.utc), changed_at.replace(tzinfo=timezone.utc)
+        if (now - changed_at).total_seconds() < COALESCE_WINDOW and (now - since).total_seconds() < COALESCE_MAX_HOLD:
+            return False
+        await db.pending_changes.delete_one({"_id": held["_id"]})
+        COALESCE_STATS["released"] += 1
+        return True
+
+    if held:
+        # Нова версія замінює відкладену — попередня вже не буде надіслана
+        COALESCE_STATS["replaced"] += 1
+        COALESCE_STATS["messages_avoided"] += await _count_subscribers(queue_id, region)
+    else:
+        COALESCE_STATS["held"] += 1
+    await db.pending_changes.update_one(
+        {"_id": f"{state_key}:{date}"},
+        {"$set": {"state_key": state_key, "date": date, "slots": stored, "changed_at": now,
+                  "since": held["since"] if held else now}},
+        upsert=True
+    )
+    return False
+
+
+async def detect_and_enqueue(region: str, queue_id: str, state_key: str, current: dict) -> tuple[bool, bool]:
+    """Порівнює поточні графіки {date: slots} зі збереженим станом, ставить зміни
+    в outbox та зберігає новий стан. Повертає (changed, holding): чи були
+    поставлені зміни і чи лишились зміни, які ще відстоюють вікно згладжування.
+    Зміни ставляться в outbox до збереження стану, з ключем від версії стану:
+    якщо процес впаде між цими кроками, повторне виявлення дасть ті самі задачі.
+    Збережений стан — остання надіслана версія; нові версії спершу відстоюють
+    вікно згладжування в pending_changes."""
+    label = REGION_LABELS.get(region, region)
+    saved_schedules, version = await _load_saved_schedules(state_key)
+    pending = await _load_pending_changes(state_key)
+    now = datetime.now(timezone.utc)
+    waiting = False
+
+    # Очищення старих дат (до сьогодні)
+    today = datetime.now(KYIV_TZ).date()
+    old_dates = []
+    for date_str in list(saved_schedules.keys()):
+        date_obj = _parse_date(date_str)
+        if date_obj and date_obj < today:
+            old_dates.append(date_str)
+            del saved_schedules[date_str]
+
+    if old_dates:
+        logging.info(f"[{label}] Cleaned old dates for {queue_id}: {old_dates}")
+
+    # Порівнюємо кожну дату окремо: лише відключення, без службових полів (status тощо)
+    changes = []  # [(date, hours, "new"|"updated", попередні відрізки), ...]
+    state_changed = False
+
+    for date, slots in current.items():
+        # Не повертаємо в стан дати, які вже минули
+        date_obj = _parse_date(date)
+        if date_obj and date_obj < today:
+            continue
+
+        day = day_schedule(slots)
+        stored = [[start, end] for start, end, _ in day.slots]
         try:
-            all_schedules = await asyncio.to_thread(_fetch_lviv_schedule_sync)
-            if not all_schedules:
-                logging.warning("[ЛОЕ] No schedule data received")
-                await asyncio.sleep(CHECK_INTERVAL)
+            await archive_schedule(region, queue_id, date, day)
+        except Exception as e:
+            logging.error(f"[{label}] History archive error for {queue_id} on {date}: {e}")
+        hours = [{"from": s, "to": e} for s, e in slots] if region == REGION_LVIV else slots
+        previous = saved_schedules.get(date)
+        held = pending.get(date)
+
+        if previous is None or not day_schedule(previous).same_outages(day):
+            if COALESCE_WINDOW and not await _coalesce_change(region, queue_id, state_key, date, held, day, stored, now):
+                waiting = True
                 continue
-            
-            today = datetime.now(KYIV_TZ).date()
-            
-            for queue_id in QUEUES:
-                state_key = f"lviv_{queue_id}"
-                
-                # Завантажуємо збережений стан
-                saved_state_json = await get_schedule_state(state_key)
-                saved_data = {}
-                if saved_state_json:
-                    try:
-                        saved_data = json.loads(saved_state_json)
-                    except:
-                        saved_data = {}
-                
-                # Очищення старих дат
-                cleaned_dates = []
-                for ds in list(saved_data.keys()):
-                    try:
-                        d, m, y = ds.split('.')
-                        if datetime(int(y), int(m), int(d)).date() < today:
-                            del saved_data[ds]
-                            cleaned_dates.append(ds)
-                    except Exception:
-                        pass
-                
-                if cleaned_dates:
-                    logging.info(f"[ЛОЕ] Cleaned old dates for {queue_id}: {cleaned_dates}")
-                    await save_schedule_state(state_key, json.dumps(saved_data))
-                
-                # Порівнюємо кожну дату
-                changes = []  # [(date_str, slots, "new"|"updated")]
-                
-                for date_str, day_data in all_schedules.items():
-                    # skip dates that are already in the past (avoid re-adding yesterday)
-                    try:
-                        d, m, y = date_str.split('.')
-                        date_obj = datetime(int(y), int(m), int(d)).date()
-                        if date_obj < today:
-                            continue
-                    except Exception:
-                        pass
-
-                    slots = day_data.get(queue_id)
-                    if slots is None:
-                        continue
+            if previous is None:
+                # Нова дата - новий графік
+                changes.append((date, hours, "new", None))
+                logging.info(f"[{label}] New schedule for {queue_id} on {date}")
+            else:
+                # Дата є, але відключення змінились
+                changes.append((date, hours, "updated", previous))
+                logging.info(f"[{label}] Updated schedule for {queue_id} on {date}")
+        elif held:
+            # Графік повернувся до вже надісланої версії — відкладені зміни не надсилаємо
+            await db.pending_changes.delete_one({"_id": held["_id"]})
+            COALESCE_STATS["reverted"] += 1
+            COALESCE_STATS["messages_avoided"] += 2 * await _count_subscribers(queue_id, region)
+            logging.info(f"[{label}] Schedule for {queue_id} on {date} reverted, pending change dropped")
+            if previous == stored:
+                continue
+        elif previous != stored:
+            # Змінились лише службові поля чи запис часу — стан оновлюємо мовчки
+            SUPPRESSED_CHANGES["noise"] += 1
+        else:
+            continue
 
-                    current_hash = json.dumps(slots, sort_keys=True)
-                    old_hash = saved_data.get(date_str)
+        saved_schedules[date] = stored
+        state_changed = True
 
-                    if old_hash is None:
-                        changes.append((date_str, slots, "new"))
-                        logging.info(f"[ЛОЕ] New schedule for {queue_id} on {date_str}")
-                    elif old_hash != current_hash:
-                        changes.append((date_str, slots, "updated"))
-                        logging.info(f"[ЛОЕ] Updated schedule for {queue_id} on {date_str}")
+    if changes:
+        await enqueue_changes(region, queue_id, f"{state_key}:v{version}", changes)
 
-                    saved_data[date_str] = current_hash
-                
-                if changes:
-                    subscribers = await get_users_by_queue(queue_id, REGION_LVIV)
-                    if subscribers:
-                        for user_id in subscribers:
-                            try:
-                                user_data = await get_user_data(user_id)
-                                address = user_data.get("address") if isinstance(user_data, dict) else None
-                                
-                                for i, (date_str, slots, change_type) in enumerate(changes):
-                                    msg = format_schedule_notification(queue_id, date_str, [
-                                        {"from": s, "to": e} for s, e in slots
-                                    ], change_type, address)
-                                    if i == len(changes) - 1:
-                                        await bot.send_message(user_id, msg, parse_mode=ParseMode.MARKDOWN, reply_markup=get_donate_keyboard())
-                                    else:
-                                        await bot.send_message(user_id, msg, parse_mode=ParseMode.MARKDOWN)
-                                    await asyncio.sleep(0.3)
-                                
-                                logging.info(f"[ЛОЕ] Notifications sent to {user_id} for {queue_id}")
-                            except Exception as e:
-                                logging.error(f"[ЛОЕ] Failed to send to {user_id}: {e}")
-                            await asyncio.sleep(0.5)
-                    
-                    await save_schedule_state(state_key, json.dumps(saved_data))
-                
-                await asyncio.sleep(0.5)
-            
-            logging.info(f"[ЛОЕ] Check completed. Next check in {CHECK_INTERVAL} seconds")
-        except Exception as e:
-            logging.error(f"[ЛОЕ] Checker error: {e}")
-        
-        await asyncio.sleep(CHECK_INTERVAL)
+    if state_changed or old_dates:
+        await save_schedule_state(state_key, json.dumps(saved_schedules))
+
+    return bool(changes), waiting
+
+
+async def poll_lviv_schedules() -> tuple[bool, bool]:
+    """Один цикл опитування ЛОЕ. Повертає (changed, holding), як detect_and_enqueue"""
+    all_schedules = await asyncio.to_thread(_fetch_lviv_schedule_sync)
+    if not all_schedules:
+        logging.warning("[ЛОЕ] No schedule data received")
+        return False, False
+
+    changed = holding = False
+    for queue_id in QUEUES:
+        current = {}
+        for date_str, day_data in all_schedules.items():
+            slots = day_data.get(queue_id)
+            if slots is not None:
+                current[date_str] = slots
+        queue_changed, queue_holding = await detect_and_enqueue(REGION_LVIV, queue_id, f"lviv_{queue_id}", current)
+        changed |= queue_changed
+        holding |= queue_holding
+
+    logging.info("[ЛОЕ] Check completed")
+    return changed, holding
+
+
+async def poll_if_schedules() -> tuple[bool, bool]:
+    """Один цикл опитування ІФ. Повертає (changed, holding), як detect_and_enqueue"""
+    changed = holding = False
+    for queue_id, data in (await harvest_if_schedules()).items():
+        # Витягуємо графіки для всіх дат
+        current_schedules = extract_all_schedules(data, queue_id)
+        if not current_schedules:
+            continue
+
+        queue_changed, queue_holding = await detect_and_enqueue(REGION_IF, queue_id, queue_id, current_schedules)
+        changed |= queue_changed
+        holding |= queue_holding
+
+    logging.info("[ІФ] Check completed")
+    return changed, holding
+
+
+async def lviv_scheduled_checker():
+    """Моніторинг графіків Львівської області (ЛОЕ)"""
+    logging.info("🚀 [ЛОЕ] Monitor started")
+    policy = await get_poll_policy(REGION_LVIV) if ADAPTIVE_POLLING else None
+    await run_fixed_rate(REGION_LVIV, poll_lviv_schedules, CHECK_INTERVAL, initial_delay=15, policy=policy)
 
 
 async def scheduled_checker():
+    """Моніторинг графіків Івано-Франківської області"""
     logging.info("🚀 [ІФ] Monitor started")
-    await asyncio.sleep(10)
-    
-    while True:
-        for queue_id in QUEUES:
-            data = await fetch_schedule(None, queue_id)
-            if not data:
-                continue
-
-            # Витягуємо графіки для всіх дат
-            current_schedules = extract_all_schedules(data, queue_id)
-            if not current_schedules:
-                continue
-            
-            # Завантажуємо збережений стан
-            saved_state_json = await get_schedule_state(queue_id)
-            saved_schedules = {}
-            if saved_state_json:
-                try:
-                    saved_schedules = json.loads(saved_state_json)
-                except:
-                    saved_schedules = {}
-            
-            # Очищення старих дат (до сьогодні)
-            today = datetime.now(KYIV_TZ).date()
-            old_dates = []
-            for date_str in list(saved_schedules.keys()):
-                try:
-                    day, month, year = date_str.split('.')
-                    date_obj = datetime(int(year), int(month), int(day)).date()
-                    if date_obj < today:
-                        old_dates.append(date_str)
-                        del saved_schedules[date_str]
-                except:
-                    pass
-            
-            if old_dates:
-                logging.info(f"[ІФ] Cleaned old dates for {queue_id}: {old_dates}")
-                await save_schedule_state(queue_id, json.dumps(saved_schedules))
-            
-            # Порівнюємо кожну дату окремо
-            changes = []  # [(date, hours, "new"|"updated"), ...]
-            
-            for date, hours in current_schedules.items():
-                current_hash = json.dumps(hours, sort_keys=True)
-                
-                if date not in saved_schedules:
-                    # Нова дата - новий графік
-                    changes.append((date, hours, "new"))
-                    logging.info(f"[ІФ] New schedule for {queue_id} on {date}")
-                elif saved_schedules[date] != current_hash:
-                    # Дата є, але графік змінився
-                    changes.append((date, hours, "updated"))
-                    logging.info(f"[ІФ] Updated schedule for {queue_id} on {date}")
-                
-                # Оновлюємо збережений стан
-                saved_schedules[date] = current_hash
-            
-            # Якщо є зміни - надсилаємо сповіщення
-            if changes:
-                subscribers = await get_users_by_queue(queue_id, REGION_IF)
-                
-                if subscribers:
-                    for user_id in subscribers:
-                        try:
-                            user_data = await get_user_data(user_id)
-                            address = user_data.get("address") if isinstance(user_data, dict) else None
-                            
-                            # Надсилаємо окреме повідомлення для кожної зміненої дати
-                            for i, (date, hours, change_type) in enumerate(changes):
-                                msg = format_schedule_notification(queue_id, date, hours, change_type, address)
-                                # Додаємо кнопку донату до останнього повідомлення
-                                if i == len(changes) - 1:
-                                    await bot.send_message(user_id, msg, parse_mode=ParseMode.MARKDOWN, reply_markup=get_donate_keyboard())
-                                else:
-                                    await bot.send_message(user_id, msg, parse_mode=ParseMode.MARKDOWN)
-                                await asyncio.sleep(0.3)
-                            
-                            logging.info(f"Notifications sent to {user_id} for queue {queue_id}")
-                        except Exception as e:
-                            logging.error(f"Failed to send to {user_id}: {e}")
-                        
-                        await asyncio.sleep(0.5)
-                
-                # Зберігаємо оновлений стан
-                await save_schedule_state(queue_id, json.dumps(saved_schedules))
-            
-            await asyncio.sleep(1)
-        
-        logging.info(f"[ІФ] Check completed. Next check in {CHECK_INTERVAL} seconds")
-        await asyncio.sleep(CHECK_INTERVAL)
+    policy = await get_poll_policy(REGION_IF) if ADAPTIVE_POLLING else None
+    await run_fixed_rate(REGION_IF, poll_if_schedules, CHECK_INTERVAL, initial_delay=10, policy=policy)
 
 async def reminder_checker():
     """Перевіряє та надсилає нагадування про наближення подій"""
@@ -1875,21 +3859,19 @@ async def reminder_checker():
             now = datetime.now(KYIV_TZ)
             today_str = now.strftime("%d.%m.%Y")
             
-            # Очищення старих нагадувань раз на добу (о 3:00)
+            # Очищення старих нагадувань і блобів без посилань раз на добу (о 3:00)
             if now.hour == 3 and now.minute < 2:
                 await cleanup_old_reminders()
+                await cleanup_orphan_blobs()
             
             # Завантажуємо графіки для ВСІХ черг один раз (кеш) — ІФ
             schedules_cache_if = {}
-            for queue_id in QUEUES:
-                data = await fetch_schedule(None, queue_id)
-                if data:
-                    schedule_data = data if isinstance(data, list) else data.get("schedule", [])
-                    for record in schedule_data:
-                        if record.get("eventDate") == today_str:
-                            schedules_cache_if[queue_id] = record.get("queues", {}).get(queue_id, [])
-                            break
-                await asyncio.sleep(0.2)
+            for queue_id, data in (await harvest_if_schedules()).items():
+                schedule_data = data if isinstance(data, list) else data.get("schedule", [])
+                for record in schedule_data:
+                    if record.get("eventDate") == today_str:
+                        schedules_cache_if[queue_id] = day_schedule(record.get("queues", {}).get(queue_id, []))
+                        break
             
             # Завантажуємо графіки Львів
             schedules_cache_lviv = {}
@@ -1897,7 +3879,7 @@ async def reminder_checker():
             if lviv_data:
                 lviv_today = lviv_data.get(today_str, {})
                 for queue_id, slots in lviv_today.items():
-                    schedules_cache_lviv[queue_id] = [{"from": s, "to": e} for s, e in slots]
+                    schedules_cache_lviv[queue_id] = day_schedule(slots)
             
             # Отримуємо всіх користувачів з підписками та увімкненими нагадуваннями
             cursor = db.users.find({"queues": {"$exists": True, "$ne": []},"reminders": True})
@@ -1915,28 +3897,23 @@ async def reminder_checker():
                 
                 # Оновлюємо now для кожного користувача
                 now = datetime.now(KYIV_TZ)
+                day_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+                now_minute = (now - day_start).total_seconds() / 60
                 
                 # Обираємо кеш відповідно до регіону
                 schedules_cache = schedules_cache_lviv if region == REGION_LVIV else schedules_cache_if
                 
                 for queue_id in queues:
-                    queue_data = schedules_cache.get(queue_id, [])
+                    day = schedules_cache.get(queue_id)
+                    if not day:
+                        continue
                     
-                    for slot in queue_data:
-                        from_time = slot.get("from", "")
-                        to_time = slot.get("to", "")
-                        
-                        if not from_time or not to_time:
-                            continue
-                        
-                        # Перевіряємо нагадування для ВИМКНЕННЯ (from_time)
-                        await check_and_send_reminder(
-                            user_id, queue_id, today_str, from_time, "off", now, user_intervals
-                        )
-                        
-                        # Перевіряємо нагадування для УВІМКНЕННЯ (to_time)
+                    # Лише події, до яких лишилось не більше найбільшого інтервалу нагадування
+                    horizon = now_minute + max(user_intervals) + 1
+                    for minute, time_str, event_type in day.events_between(now_minute, horizon):
                         await check_and_send_reminder(
-                            user_id, queue_id, today_str, to_time, "on", now, user_intervals
+                            user_id, queue_id, today_str, time_str, event_type,
+                            day_start + timedelta(minutes=minute), now, user_intervals
                         )
             
         except Exception as e:
@@ -1945,14 +3922,9 @@ async def reminder_checker():
         # Перевіряємо кожну хвилину
         await asyncio.sleep(60)
 
-async def check_and_send_reminder(user_id: int, queue_id: str, date_str: str, time_str: str, event_type: str, now: datetime, user_intervals: list[int]):
+async def check_and_send_reminder(user_id: int, queue_id: str, date_str: str, time_str: str, event_type: str, event_time: datetime, now: datetime, user_intervals: list[int]):
     """Перевіряє та надсилає нагадування якщо потрібно"""
     try:
-        # Парсимо час події
-        day, month, year = date_str.split('.')
-        hour, minute = time_str.split(':')
-        event_time = datetime(int(year), int(month), int(day), int(hour), int(minute), tzinfo=KYIV_TZ)
-        
         # Різниця в хвилинах
         diff = (event_time - now).total_seconds() / 60
         
@@ -1986,6 +3958,7 @@ async def check_and_send_reminder(user_id: int, queue_id: str, date_str: str, ti
                     )
                     
                     try:
+                        await send_budget.acquire()
                         await bot.send_message(user_id, msg, parse_mode=ParseMode.MARKDOWN)
                         await mark_reminder_sent(user_id, queue_id, event_key, event_type, minutes)
                         logging.info(f"Reminder sent: {user_id}, {queue_id}, {event_type} in {minutes}min at {time_str}")
@@ -1997,6 +3970,92 @@ async def check_and_send_reminder(user_id: int, queue_id: str, date_str: str, ti
     except Exception as e:
         logging.error(f"Error in check_and_send_reminder: {e}")
 
+# --- ВИБІР ЛІДЕРА ---
+# Фонові цикли (моніторинг і нагадування) працюють лише в одному процесі —
+# власнику оренди в колекції leases. Хендлери та outbox працюють у всіх репліках.
+LEADER_LEASE_NAME = "scheduler"
+is_leader = False
+
+
+async def try_acquire_leadership() -> bool:
+    """Захоплює або продовжує оренду лідера; False, якщо її тримає інший процес"""
+    now = datetime.now(timezone.utc)
+    try:
+        lease = await db.leases.find_one_and_update(
+            {"_id": LEADER_LEASE_NAME, "$or": [{"holder": INSTANCE_ID}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"holder": INSTANCE_ID, "expires_at": now + timedelta(seconds=LEADER_LEASE), "renewed_at": now}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # Документ існує і оренда чинна в іншого процесу
+        return False
+    return lease is not None and lease.get("holder") == INSTANCE_ID
+
+
+async def release_leadership():
+    """Звільняє оренду при зупинці, щоб інша репліка перейняла роботу одразу"""
+    try:
+        await db.leases.delete_one({"_id": LEADER_LEASE_NAME, "holder": INSTANCE_ID})
+    except Exception as e:
+        logging.error(f"Error releasing leadership: {e}")
+
+
+def start_leader_tasks() -> list[asyncio.Task]:
+    tasks = [
+        # Моніторинг графіків (ІФ)
+        asyncio.create_task(scheduled_checker()),
+        # Моніторинг графіків (Львів)
+        asyncio.create_task(lviv_scheduled_checker()),
+        # Нагадування
+        asyncio.create_task(reminder_checker()),
+    ]
+    if not WEBHOOK_URL:
+        # Апдейти через getUpdates — лише в лідері; сесію бота тримаємо для розсилки
+        tasks.append(asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False)))
+    return tasks
+
+
+async def leader_loop():
+    """Продовжує оренду кожні LEADER_LEASE/3 секунд; запускає фонові цикли при
+    отриманні лідерства і зупиняє їх при втраті. Якщо оренду не вдається
+    продовжити до її закінчення, процес сам складає повноваження."""
+    global is_leader
+    tasks: list[asyncio.Task] = []
+    loop = asyncio.get_running_loop()
+    last_renewed = 0.0
+
+    try:
+        while True:
+            try:
+                acquired = await try_acquire_leadership()
+                if acquired:
+                    last_renewed = loop.time()
+            except Exception as e:
+                logging.error(f"Leader lease error: {e}")
+                # Поки оренда не сплила — лишаємось лідером
+                acquired = is_leader and loop.time() - last_renewed < LEADER_LEASE
+
+            if acquired and not is_leader:
+                logging.info(f"👑 {INSTANCE_ID} became leader")
+                is_leader = True
+                tasks = start_leader_tasks()
+            elif not acquired and is_leader:
+                logging.warning(f"⚠️ {INSTANCE_ID} lost leadership, stopping background loops")
+                is_leader = False
+                for task in tasks:
+                    task.cancel()
+                tasks = []
+
+            await asyncio.sleep(LEADER_LEASE / 3)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if is_leader:
+            is_leader = False
+            await release_leadership()
+
+
 # --- АДМІН-ПАНЕЛЬ ---
 def is_admin(user_id: int) -> bool:
     return user_id == ADMIN_ID
@@ -2410,17 +4469,70 @@ async def handle_index(request):
 
 async def handle_health(request):
     """Health check для Render"""
+    upstreams = {name: breaker.state for name, breaker in BREAKERS.items()}
     return web.json_response({
-        "status": "ok",
+        "status": "degraded" if CircuitBreaker.OPEN in upstreams.values() else "ok",
         "service": "lumos-bot",
+        "upstreams": upstreams,
+        "instance": INSTANCE_ID,
+        "leader": is_leader,
+        "timestamp": datetime.now(KYIV_TZ).isoformat()
+    })
+
+async def handle_metrics(request):
+    """Метрики опитування та розсилки"""
+    return web.json_response({
+        "polling": {region: stats.as_dict() for region, stats in POLL_STATS.items()},
+        "adaptive_polling": {region: policy.report() for region, policy in POLL_POLICIES.items()},
+        "outbox_pending": await db.outbox.count_documents({"status": "pending"}),
+        "send_budget_waits": send_budget.waits,
+        "if_harvest": HARVEST_STATS,
+        "address_cache": address_cache_stats(),
+        "lviv_gazetteer": lviv_gazetteer.stats,
+        "if_street_suggestions": IF_STREET_STATS,
+        "suppressed_changes": SUPPRESSED_CHANGES,
+        "coalescing": {**COALESCE_STATS, "window": COALESCE_WINDOW},
+        "timeline_images": timeline_stats(),
+        "throttling": {**THROTTLE_STATS, "tracked": len(throttle_buckets)},
+        "handler_latency": handler_latency_report(),
+        "upstreams": {name: breaker.as_dict() for name, breaker in BREAKERS.items()},
         "timestamp": datetime.now(KYIV_TZ).isoformat()
     })
 
+async def handle_history(request):
+    """Версії графіка черги: /history?queue=1.1&region=if&from=YYYY-MM-DD&to=YYYY-MM-DD"""
+    queue_id = request.query.get("queue")
+    if queue_id not in QUEUES:
+        return web.json_response({"error": "unknown queue"}, status=400)
+    region = request.query.get("region", REGION_IF)
+    today = datetime.now(KYIV_TZ).date()
+    day_from = request.query.get("from", (today - timedelta(days=7)).isoformat())
+    day_to = request.query.get("to", today.isoformat())
+    return web.json_response({
+        "region": region,
+        "queue": queue_id,
+        "versions": await get_schedule_history(region, queue_id, day_from, day_to),
+    })
+
+async def handle_stats(request):
+    """Підсумки відключень: /stats?queue=1.1&region=if (хвилини)"""
+    queue_id = request.query.get("queue")
+    if queue_id not in QUEUES:
+        return web.json_response({"error": "unknown queue"}, status=400)
+    region = request.query.get("region", REGION_IF)
+    stats = await get_outage_stats(region, [queue_id])
+    return web.json_response({"region": region, "queue": queue_id, "minutes": stats[queue_id]})
+
 async def start_web_server():
     """Запуск веб-сервера"""
     app = web.Application()
     app.router.add_get("/", handle_index)
     app.router.add_get("/health", handle_health)
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/history", handle_history)
+    app.router.add_get("/stats", handle_stats)
+    if WEBHOOK_URL:
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
     
     runner = web.AppRunner(app)
     await runner.setup()
@@ -2434,24 +4546,89 @@ async def main():
     logging.info(f"📋 Config: APQE_LOE={'SET' if LVIV_API_URL else 'NOT SET'}, APWR_LOE={'SET' if LVIV_POWER_API_URL else 'NOT SET'}")
     logging.info(f"📋 MongoDB: {MONGO_URI[:20]}...")
     await init_db()
+    leader_task = None
     
     try:
         # Запускаємо веб-сервер
         await start_web_server()
         
-        # Запускаємо моніторинг графіків (ІФ)
-        asyncio.create_task(scheduled_checker())
+        # Моніторинг, нагадування і (без webhook) getUpdates — лише в репліці-лідері
+        leader_task = asyncio.create_task(leader_loop())
         
-        # Запускаємо моніторинг графіків (Львів)
-        asyncio.create_task(lviv_scheduled_checker())
+        # Довідники адрес ЛОЕ та ІФ (у кожній репліці)
+        asyncio.create_task(gazetteer_refresher())
         
-        # Запускаємо нагадування
-        asyncio.create_task(reminder_checker())
+        # Розсилка змін з outbox окремо від опитування (у кожній репліці)
+        if FANOUT_WORKERS > 1:
+            await rebalance_outbox_shards()
+            for shard in range(FANOUT_WORKERS):
+                asyncio.create_task(supervise_fanout_worker(shard))
+        else:
+            asyncio.create_task(outbox_worker())
         
-        # Запускаємо бота
-        await dp.start_polling(bot)
+        # Запускаємо бота: з webhook апдейти приймає кожна репліка, інакше — лідер
+        if WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                  allowed_updates=dp.resolve_used_update_types())
+            logging.info(f"🌐 Webhook set to {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
     finally:
+        if leader_task:
+            # Звільняємо оренду лідера до закриття з'єднання з БД
+            leader_task.cancel()
+            try:
+                await leader_task
+            except asyncio.CancelledError:
+                pass
+        await close_db()
+
+# --- ВОРКЕРИ РОЗСИЛКИ (ПРОЦЕСИ) ---
+async def rebalance_outbox_shards():
+    """Переносить незавершені задачі з шардів, яких більше немає (змінився FANOUT_WORKERS)"""
+    await db.outbox.update_many({"status": "pending", "shard": {"$exists": False}}, {"$set": {"shard": 0}})
+    result = await db.outbox.update_many(
+        {"status": "pending", "shard": {"$gte": FANOUT_WORKERS}},
+        [{"$set": {"shard": {"$mod": ["$shard", FANOUT_WORKERS]}}}],
+    )
+    if result.modified_count:
+        logging.info(f"📤 Rebalanced {result.modified_count} outbox job(s) to {FANOUT_WORKERS} shards")
+
+
+async def supervise_fanout_worker(shard: int):
+    """Запускає процес-воркер розсилки для шарду і перезапускає його при падінні"""
+    while True:
+        process = await asyncio.create_subprocess_exec(sys.executable, str(Path(__file__).resolve()), "--fanout-worker", str(shard))
+        logging.info(f"📤 Fan-out worker {shard} started (pid {process.pid})")
+        try:
+            code = await process.wait()
+        except asyncio.CancelledError:
+            process.terminate()
+            raise
+        logging.error(f"📤 Fan-out worker {shard} exited with code {code}, restarting")
+        await asyncio.sleep(5)
+
+
+async def fanout_worker_main(shard: int):
+    """Точка входу процесу-воркера: лише розсилка задач свого шарду.
+    Воркер завершується сам, якщо батьківський процес зник (вбитий без очищення)."""
+    await init_db()
+    parent = os.getppid()
+    worker = asyncio.create_task(outbox_worker(shard))
+    try:
+        while not worker.done():
+            if os.getppid() != parent:
+                logging.error(f"📤 Fan-out worker {shard}: parent process {parent} is gone, exiting")
+                break
+            await asyncio.wait([worker], timeout=FANOUT_PARENT_CHECK)
+    finally:
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+        await bot.session.close()
         await close_db()
 
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if len(sys.argv) == 3 and sys.argv[1] == "--fanout-worker":
+        asyncio.run(fanout_worker_main(int(sys.argv[2])))
+    else:
+        asyncio.run(main())
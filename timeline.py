@@ -0,0 +1,71 @@
+"""Картинка графіка доби: 24-годинна шкала, відключення позначені червоним.
+
+Зображення залежить лише від черги, дати та відключень, тож для однієї версії
+графіка воно рендериться один раз, а далі бот надсилає його за file_id.
+"""
+import io
+
+from PIL import Image, ImageDraw, ImageFont
+
+from formatting import DaySchedule
+
+WIDTH, HEIGHT = 720, 132
+MARGIN = 16
+BAR_TOP, BAR_BOTTOM = 48, 88
+
+COLOR_BACKGROUND = (255, 255, 255)
+COLOR_TEXT = (33, 33, 33)
+COLOR_GRID = (158, 158, 158)
+COLOR_ON = (200, 230, 201)
+COLOR_OFF = (229, 57, 53)
+COLOR_UNPARSED = (255, 193, 7)
+
+_FONTS = {}
+
+
+def _font(size: int):
+    font = _FONTS.get(size)
+    if font is None:
+        try:
+            font = ImageFont.truetype("DejaVuSans.ttf", size)
+        except OSError:
+            font = ImageFont.load_default()
+        _FONTS[size] = font
+    return font
+
+
+def _x(minute: int) -> float:
+    return MARGIN + minute * (WIDTH - 2 * MARGIN) / (24 * 60)
+
+
+def render_timeline(day: DaySchedule, queue_id: str, date_str: str) -> bytes:
+    """PNG зі шкалою доби для черги queue_id на дату date_str.
+    Підписи лише з цифр, щоб не залежати від кирилиці у шрифті."""
+    image = Image.new("RGB", (WIDTH, HEIGHT), COLOR_BACKGROUND)
+    draw = ImageDraw.Draw(image)
+
+    draw.text((MARGIN, 12), f"{queue_id}   {date_str}", fill=COLOR_TEXT, font=_font(22))
+    off_minutes = day.outage_minutes
+    if off_minutes:
+        hours, minutes = divmod(off_minutes, 60)
+        draw.text((WIDTH - MARGIN, 14), f"-{hours}:{minutes:02d}", fill=COLOR_OFF, font=_font(20), anchor="ra")
+
+    draw.rectangle((_x(0), BAR_TOP, _x(24 * 60), BAR_BOTTOM), fill=COLOR_ON)
+    for start, end in day.intervals:
+        draw.rectangle((_x(start), BAR_TOP, _x(end), BAR_BOTTOM), fill=COLOR_OFF)
+    # Відрізки, які не вдалося розібрати, — тонка смуга над шкалою
+    if day.unparsed():
+        draw.rectangle((_x(0), BAR_TOP - 6, _x(24 * 60), BAR_TOP - 3), fill=COLOR_UNPARSED)
+
+    label_font = _font(14)
+    for hour in range(25):
+        x = _x(hour * 60)
+        major = hour % 3 == 0
+        draw.line((x, BAR_BOTTOM, x, BAR_BOTTOM + (8 if major else 4)), fill=COLOR_GRID, width=1)
+        if major:
+            draw.text((x, BAR_BOTTOM + 10), f"{hour:02d}", fill=COLOR_TEXT, font=label_font, anchor="ma")
+
+    # Кольорів кілька — з палітрою PNG значно менший, ніж у RGB
+    buffer = io.BytesIO()
+    image.convert("P", palette=Image.Palette.ADAPTIVE, colors=16).save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
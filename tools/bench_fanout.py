@@ -0,0 +1,237 @@
+"""Наскрізний бенчмарк розсилки змін: від опитування API до останньої доставки.
+
+Наповнює окрему базу MongoDB синтетичними підписниками (обидва регіони, різні
+черги й налаштування нагадувань). Потім кожен прогін:
+- змінює графіки в замінника API (tools/upstream_stub.py);
+- виконує справжні main.poll_if_schedules та main.poll_lviv_schedules
+  (виявлення, outbox);
+- чекає, поки main.outbox_worker доставить усе на фейковий Bot API із
+  затримкою та часткою 429.
+
+Звітує час до останньої доставки, повідомлень за секунду, операції MongoDB за
+зміну та піковий RSS.
+
+    python tools/bench_fanout.py --users 50000 --runs 3 --save bench_fanout.json
+    python tools/bench_fanout.py --users 50000 --runs 3 --compare bench_fanout.json
+
+--compare завершується з кодом 1, якщо медіана часу доставки або операцій
+MongoDB погіршилась більше ніж на --tolerance. Прогін, що не дочекався доставки
+(--timeout) або доставив не стільки повідомлень, скільки очікувалось, теж дає
+код 1, і його підсумок не зберігається. Потрібен локальний mongod; база
+DB_NAME (за замовчуванням lumos_bench) очищається.
+"""
+import argparse
+import asyncio
+import collections
+import contextvars
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from pymongo import monitoring
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from fake_telegram import FakeTelegram  # noqa: E402
+from upstream_stub import UpstreamStub  # noqa: E402
+
+BENCH_TOKEN = "123456:BENCHMARKBENCHMARKBENCHMARKBENCHMAR"
+QUEUES = [f"{group}.{sub}" for group in range(1, 7) for sub in (1, 2)]
+COLLECTIONS = (
+    "users", "outbox", "schedule_state", "pending_changes", "schedule_history", "schedule_blobs",
+    "outage_rollups", "poll_changes", "send_budget", "timeline_images", "reminders",
+)
+
+# Власні запити бенчмарку (очікування доставки) не входять у лічильник
+_bench_query = contextvars.ContextVar("bench_query", default=False)
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def started(self, event):
+        if not _bench_query.get():
+            self.counts[event.command_name] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+async def own(coro):
+    token = _bench_query.set(True)
+    try:
+        return await coro
+    finally:
+        _bench_query.reset(token)
+
+
+async def seed_users(db, count: int, lviv_share: float, seed: int):
+    rng = random.Random(seed)
+    chunk = 10_000
+    for start in range(0, count, chunk):
+        docs = []
+        for i in range(start, min(count, start + chunk)):
+            reminders = rng.random() < 0.6
+            docs.append({
+                "user_id": 10_000_000 + i,
+                "region": "lviv" if rng.random() < lviv_share else "if",
+                "queues": rng.sample(QUEUES, rng.choice([1, 1, 1, 2, 3])),
+                "address": f"Вулиця {i}, {rng.randrange(1, 200)}" if rng.random() < 0.5 else None,
+                "reminders": reminders,
+                "reminder_intervals": rng.sample([5, 15, 30, 60, 120], rng.randrange(1, 4)) if reminders else [],
+            })
+        await db.users.insert_many(docs)
+
+
+async def run_once(main, fake: FakeTelegram, stub: UpstreamStub, counter: CommandCounter, timeout: float) -> dict:
+    stub.bump()
+    fake.reset()
+    counter.counts.clear()
+
+    started = time.monotonic()
+    await main.poll_if_schedules()
+    await main.poll_lviv_schedules()
+    detected = time.monotonic()
+
+    jobs = await own(main.db.outbox.find({"status": "pending"}, {"recipients": 1, "changes": 1}).to_list(None))
+    expected = sum(len(job["recipients"]) * len(job["changes"]) for job in jobs)
+    timed_out = True
+    while time.monotonic() - started < timeout:
+        pending = await own(main.db.outbox.count_documents({"status": "pending"}))
+        if not pending:
+            timed_out = False
+            break
+        await asyncio.sleep(0.2)
+    elapsed = (fake.last_at or time.monotonic()) - started
+
+    ops = sum(counter.counts.values())
+    return {
+        "jobs": len(jobs),
+        "expected": expected,
+        "delivered": fake.delivered,
+        "timed_out": timed_out,
+        "complete": not timed_out and fake.delivered == expected,
+        "detect_sec": round(detected - started, 2),
+        "time_to_last_delivery_sec": round(elapsed, 2),
+        "msgs_per_sec": round(fake.delivered / elapsed, 1) if elapsed > 0 else 0,
+        "rate_limited": fake.rate_limited,
+        "mongo_ops": ops,
+        "mongo_ops_per_message": round(ops / fake.delivered, 2) if fake.delivered else None,
+        "mongo_top": dict(counter.counts.most_common(5)),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def summarize(results: list[dict]) -> dict:
+    return {
+        "time_to_last_delivery_sec": statistics.median(r["time_to_last_delivery_sec"] for r in results),
+        "msgs_per_sec": statistics.median(r["msgs_per_sec"] for r in results),
+        "mongo_ops_per_change": statistics.median(r["mongo_ops"] for r in results),
+        "peak_rss_mb": max(r["peak_rss_mb"] for r in results),
+        "incomplete_runs": sum(1 for r in results if not r["complete"]),
+    }
+
+
+def compare(summary: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    if summary["incomplete_runs"]:
+        regressions.append(f"incomplete_runs: {summary['incomplete_runs']} (timed out or lost messages)")
+    for key in ("time_to_last_delivery_sec", "mongo_ops_per_change", "peak_rss_mb"):
+        before, after = baseline.get(key), summary[key]
+        if before and after > before * (1 + tolerance):
+            regressions.append(f"{key}: {before} → {after} (+{(after / before - 1) * 100:.0f}%)")
+    return regressions
+
+
+async def amain(args) -> int:
+    fake = FakeTelegram(latency_ms=args.latency_ms, rate_limit_ratio=args.rate_limited)
+    stub = UpstreamStub(args.recordings, latency_ms=args.upstream_latency_ms)
+    api_url = await fake.start(args.port)
+    os.environ.update(await stub.start(args.port + 1))
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "MONGO_URI": args.mongo_uri,
+        "DB_NAME": args.db,
+        "TELEGRAM_API_URL": api_url,
+        "SEND_RATE_LIMIT": str(args.rate),
+        "FANOUT_WORKERS": "0",
+        "COALESCE_WINDOW": "0",
+        "TIMELINE_IMAGES": "1" if args.images else "0",
+    })
+
+    counter = CommandCounter()
+    monitoring.register(counter)
+    import main  # noqa: E402 — після налаштування оточення
+    await main.init_db()
+    for name in COLLECTIONS:
+        await main.db[name].delete_many({})
+    print(f"Seeding {args.users} users...")
+    await seed_users(main.db, args.users, args.lviv_share, args.seed)
+
+    # Перше опитування лише запам'ятовує стан — його сповіщення не рахуються
+    await main.poll_if_schedules()
+    await main.poll_lviv_schedules()
+    await main.db.outbox.delete_many({})
+
+    worker = asyncio.create_task(main.outbox_worker())
+    results = []
+    try:
+        for run in range(args.runs):
+            result = await run_once(main, fake, stub, counter, args.timeout)
+            results.append(result)
+            print(f"run {run + 1}: {json.dumps(result, ensure_ascii=False)}")
+    finally:
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+        for name in COLLECTIONS:
+            await main.db[name].delete_many({})
+        await main.close_db()
+        await main.bot.session.close()
+        await stub.stop()
+        await fake.stop()
+
+    summary = {"users": args.users, **summarize(results)}
+    print("\nsummary:", json.dumps(summary))
+    if summary["incomplete_runs"]:
+        # Час і швидкість неповного прогону нічого не означають
+        print(f"❌ {summary['incomplete_runs']} run(s) timed out or delivered a different number of messages than expected")
+    if args.save and not summary["incomplete_runs"]:
+        Path(args.save).write_text(json.dumps(summary, indent=2), encoding="utf-8")
+    if args.compare:
+        regressions = compare(summary, json.loads(Path(args.compare).read_text(encoding="utf-8")), args.tolerance)
+        for line in regressions:
+            print(f"❌ regression {line}")
+        return 1 if regressions else 0
+    return 1 if summary["incomplete_runs"] else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--lviv-share", type=float, default=0.3, help="частка підписників ЛОЕ")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--latency-ms", type=float, default=30, help="затримка фейкового Bot API")
+    parser.add_argument("--rate-limited", type=float, default=0.01, help="частка відповідей 429")
+    parser.add_argument("--rate", type=int, default=0, help="SEND_RATE_LIMIT (0 — без ліміту)")
+    parser.add_argument("--upstream-latency-ms", type=float, default=100)
+    parser.add_argument("--recordings", help="записані відповіді API (інакше згенеровані)")
+    parser.add_argument("--images", action="store_true", help="надсилати картинки графіків")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    parser.add_argument("--db", default="lumos_bench")
+    parser.add_argument("--port", type=int, default=8096, help="фейковий Bot API; замінник API — на port + 1")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--timeout", type=float, default=3600)
+    parser.add_argument("--save", help="записати підсумок у JSON")
+    parser.add_argument("--compare", help="порівняти з підсумком попереднього прогону")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    sys.exit(asyncio.run(amain(parser.parse_args())))
@@ -0,0 +1,379 @@
+"""Мікробенчмарк форматування графіків: formatting.py проти попередніх форматерів.
+
+Попередні реалізації (розбір "HH:MM" у кожному форматері, накопичення тексту
+через +=) скопійовано нижче без змін. Спершу перевіряється, що на тих самих
+даних обидві версії дають байт-у-байт однаковий текст, потім вимірюється час.
+
+    python tools/bench_formatting.py --cases 2000 --repeat 5
+
+Бот, MongoDB і мережа не потрібні.
+"""
+import argparse
+import random
+import sys
+import timeit
+from datetime import datetime
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import formatting  # noqa: E402
+
+KYIV_TZ = ZoneInfo("Europe/Kyiv")
+QUEUES = [f"{group}.{sub}" for group in range(1, 7) for sub in (1, 2)]
+
+
+# --- ПОПЕРЕДНІ ФОРМАТЕРИ ---
+def legacy_format_lviv_notification(queue_id: str, slots: list[tuple[str, str]], is_update: bool = False, address: str = None, date_str: str = None) -> str:
+    """Форматує графік Львівської області для однієї групи"""
+    days_names = ["Понеділок", "Вівторок", "Середа", "Четвер", "П'ятниця", "Субота", "Неділя"]
+    now = datetime.now(KYIV_TZ)
+    
+    if not date_str:
+        date_str = now.strftime("%d.%m.%Y")
+    
+    day_name = ""
+    try:
+        d, m, y = date_str.split('.')
+        dt = datetime(int(y), int(m), int(d))
+        day_name = days_names[dt.weekday()]
+    except:
+        pass
+
+    header = "⚡️ *Оновлення ГПВ!*" if is_update else "📊 *Поточний графік*"
+    address_line = f"📍 *Адреса:* {address}\n" if address else ""
+
+    lines = []
+    total_minutes = 0
+    if slots:
+        for start, end in slots:
+            duration_str = ""
+            try:
+                sh, sm = map(int, start.split(":"))
+                eh, em = map(int, end.split(":"))
+                s_min = sh * 60 + sm
+                e_min = eh * 60 + em
+                if e_min == 0:
+                    e_min = 24 * 60
+                diff = e_min - s_min
+                if diff > 0:
+                    total_minutes += diff
+                    h, m = divmod(diff, 60)
+                    duration_str = f" ({h} год)" if m == 0 else f" ({h} год {m} хв)"
+            except Exception:
+                pass
+            lines.append(f"  🔴 {start} - {end}{duration_str}")
+        schedule_str = "\n".join(lines)
+    else:
+        schedule_str = "  ✅ Відключень не заплановано"
+
+    total_str = ""
+    if total_minutes > 0:
+        th, tm = divmod(total_minutes, 60)
+        total_str = f" ({th} год)" if tm == 0 else f" ({th} год {tm} хв)"
+
+    text = (
+        f"{header}\n\n"
+        f"{address_line}"
+        f"🔢 *Група:* {queue_id}\n"
+        f"📅 *{date_str}* _{day_name}_ {total_str}\n\n"
+        f"{schedule_str}"
+    )
+    return text
+
+
+def legacy_format_lviv_check(queue_id: str, all_schedules: dict, address: str = None) -> str:
+    """Форматує зведений графік групи ЛОЕ на всі доступні дати"""
+    days_names = ["Понеділок", "Вівторок", "Середа", "Четвер", "П'ятниця", "Субота", "Неділя"]
+    header = "📊 *Поточний графік*"
+    address_line = f"📍 *Адреса:* {address}\n" if address else ""
+    text = f"{header}\n\n{address_line}🔢 *Група:* {queue_id}\n"
+    for date_str in sorted(all_schedules.keys()):
+        slots = all_schedules[date_str].get(queue_id, [])
+        # День тижня
+        day_name = ""
+        try:
+            d, m, y = date_str.split('.')
+            dt = datetime(int(y), int(m), int(d))
+            day_name = days_names[dt.weekday()]
+        except:
+            pass
+        # Тривалість
+        total_minutes = 0
+        lines = []
+        if slots:
+            for start, end in slots:
+                duration_str = ""
+                try:
+                    sh, sm = map(int, start.split(":"))
+                    eh, em = map(int, end.split(":"))
+                    s_min = sh * 60 + sm
+                    e_min = eh * 60 + em
+                    if e_min == 0:
+                        e_min = 24 * 60
+                    diff = e_min - s_min
+                    if diff > 0:
+                        total_minutes += diff
+                        h, m = divmod(diff, 60)
+                        duration_str = f" ({h} год)" if m == 0 else f" ({h} год {m} хв)"
+                except Exception:
+                    pass
+                lines.append(f"  🔴 {start} - {end}{duration_str}")
+            schedule_str = "\n".join(lines)
+        else:
+            schedule_str = "  ✅ Відключень не заплановано"
+        # Загальна тривалість
+        total_str = ""
+        if total_minutes > 0:
+            th, tm = divmod(total_minutes, 60)
+            total_str = f" ({th} год)" if tm == 0 else f" ({th} год {tm} хв)"
+        text += f"\n📅 {date_str} _{day_name}_ {total_str}\n{schedule_str}\n"
+    return text
+
+
+def legacy_format_notification(queue_id, data, is_update=True, address=None):
+    """Форматує повідомлення з графіками на ВСІ доступні дати"""
+    if not data or not isinstance(data, list):
+        return f"⚠️ Отримано некоректні дані для черги {queue_id}"
+
+    days_names = ["Понеділок", "Вівторок", "Середа", "Четвер", "П'ятниця", "Субота", "Неділя"]
+    
+    header = "⚡️ *Оновлення ГПВ!*" if is_update else "📊 *Поточний графік*"
+    address_line = f"📍 *Адреса:* {address}\n" if address else ""
+    
+    text = f"{header}\n\n{address_line}🔢 *Черга:* {queue_id}\n"
+    
+    # Обробляємо кожну дату
+    for record in data:
+        event_date = record.get("eventDate", "Невідомо")
+        approved_since = record.get("scheduleApprovedSince", "")
+        
+        # День тижня
+        day_name = ""
+        try:
+            day, month, year = event_date.split('.')
+            dt = datetime(int(year), int(month), int(day))
+            day_name = days_names[dt.weekday()]
+        except:
+            pass
+        
+        queue_data = record.get("queues", {}).get(queue_id, [])
+        
+        schedule_lines = []
+        total_minutes = 0
+        if queue_data:
+            for slot in queue_data:
+                start = slot.get('from', '??')
+                end = slot.get('to', '??')
+                
+                # Тривалість
+                duration_str = ""
+                try:
+                    start_h, start_m = map(int, start.split(':'))  
+                    end_h, end_m = map(int, end.split(':'))
+                    start_minutes = start_h * 60 + start_m
+                    end_minutes = end_h * 60 + end_m
+                    if end_minutes == 0:
+                        end_minutes = 24 * 60
+                    diff_minutes = end_minutes - start_minutes
+                    if diff_minutes > 0:
+                        total_minutes += diff_minutes
+                        h = diff_minutes // 60
+                        m = diff_minutes % 60
+                        duration_str = f" ({h} год)" if m == 0 else f" ({h} год {m} хв)"
+                except:
+                    pass
+                
+                schedule_lines.append(f"  🔴 {start} - {end}{duration_str}")
+            
+            schedule_str = "\n".join(schedule_lines)
+        else:
+            schedule_str = "  ✅ Відключень не заплановано"
+        
+        # Додаємо загальну тривалість
+        total_str = ""
+        if total_minutes > 0:
+            total_hours = total_minutes // 60
+            total_mins = total_minutes % 60
+            if total_mins == 0:
+                total_str = f"({total_hours} год)"
+            else:
+                total_str = f"({total_hours} год {total_mins} хв)"
+        
+        text += f"\n📅 *{event_date}* _{day_name}_ {total_str}\n{schedule_str}\n"
+        last_approved = data[-1].get("scheduleApprovedSince", "")
+        if last_approved:
+            text += f"\n🕒 _Затверджено: {last_approved}_"
+    
+    return text
+
+
+def legacy_format_schedule_notification(queue_id: str, date: str, hours: list, change_type: str, address: str = None) -> str:
+    """
+    Форматує сповіщення про зміну графіку.
+    change_type: "new" | "updated"
+    """
+    # День тижня
+    day_name = ""
+    try:
+        day, month, year = date.split('.')
+        dt = datetime(int(year), int(month), int(day))
+        days = ["Понеділок", "Вівторок", "Середа", "Четвер", "П'ятниця", "Субота", "Неділя"]
+        day_name = days[dt.weekday()]
+    except:
+        pass
+
+    # Заголовок
+    if change_type == "new":
+        header = f"📅 *Додано новий графік на {date}*"
+    else:
+        header = f"🔄 *Оновлено графік на {date}*"
+    
+    # Години
+    schedule_lines = []
+    total_minutes = 0
+    if hours:
+        for slot in hours:
+            start = slot.get('from', '??')
+            end = slot.get('to', '??')
+            
+            # Тривалість
+            duration_str = ""
+            try:
+                start_h, start_m = map(int, start.split(':'))
+                end_h, end_m = map(int, end.split(':'))
+                start_minutes = start_h * 60 + start_m
+                end_minutes = end_h * 60 + end_m
+                if end_minutes == 0:
+                    end_minutes = 24 * 60
+                diff_minutes = end_minutes - start_minutes
+                if diff_minutes > 0:
+                    total_minutes += diff_minutes
+                    h = diff_minutes // 60
+                    m = diff_minutes % 60
+                    duration_str = f" ({h} год)" if m == 0 else f" ({h} год {m} хв)"
+            except:
+                pass
+            
+            schedule_lines.append(f"🔴 {start} - {end}{duration_str}")
+        
+        schedule_str = "\n".join(schedule_lines)
+    else:
+        schedule_str = "✅ Відключень не заплановано"
+    
+    # Додаємо загальну тривалість до заголовка
+    if total_minutes > 0:
+        total_hours = total_minutes // 60
+        total_mins = total_minutes % 60
+        if total_mins == 0:
+            total_str = f" ({total_hours} год)"
+        else:
+            total_str = f" ({total_hours} год {total_mins} хв)"
+        if change_type == "new":
+            header = f"📅 *Додано новий графік на {date}{total_str}*"
+        else:
+            header = f"🔄 *Оновлено графік на {date}{total_str}*"
+    
+    address_line = f"📍 {address}\n" if address else ""
+
+    text = (
+        f"{header}\n"
+        f"_{day_name}_\n\n"
+        f"{address_line}"
+        f"🔢 Черга: *{queue_id}*\n\n"
+        f"{schedule_str}"
+    )
+    return text
+
+
+# --- ДАНІ ---
+def random_time(rng: random.Random) -> str:
+    if rng.random() < 0.03:
+        return rng.choice(["24:00", "00:00", "??", "8:00", ""])
+    return f"{rng.randrange(24):02d}:{rng.choice(['00', '00', '30'])}"
+
+
+def random_slots(rng: random.Random) -> list[tuple[str, str]]:
+    """Відключення черги на добу: 0–4 відрізки, як у реальних графіках"""
+    return [(random_time(rng), random_time(rng)) for _ in range(rng.choice([0, 1, 2, 2, 3, 4]))]
+
+
+def make_cases(count: int, seed: int) -> list[dict]:
+    """Набори даних для обох форматерів. Графіки повторюються між чергами і днями,
+    як у відповідях API, тож кеш розбору працює в реалістичних умовах."""
+    rng = random.Random(seed)
+    dates = ["20.01.2026", "21.01.2026", "22.01.2026"]
+    pool = [random_slots(rng) for _ in range(max(8, count // 20))]
+    cases = []
+    for i in range(count):
+        queue = rng.choice(QUEUES)
+        per_date = {date: rng.choice(pool) for date in dates[:rng.choice([1, 2, 2, 3])]}
+        data = [
+            {
+                "eventDate": date,
+                "scheduleApprovedSince": rng.choice(["", "20.01.2026 18:40"]),
+                "queues": {queue: [{"from": start, "to": end, "status": 1} for start, end in slots]},
+            }
+            for date, slots in per_date.items()
+        ]
+        cases.append({
+            "queue": queue,
+            "date": next(iter(per_date)),
+            "slots": next(iter(per_date.values())),
+            "lviv": {date: {queue: slots} for date, slots in per_date.items()},
+            "data": data,
+            "address": rng.choice([None, "м. Львів, вул. Городоцька, 12"]),
+            "is_update": bool(i % 2),
+            "change_type": rng.choice(["new", "updated"]),
+        })
+    return cases
+
+
+NAMES = ("format_lviv_notification", "format_lviv_check", "format_notification", "format_schedule_notification")
+LEGACY = {name: globals()[f"legacy_{name}"] for name in NAMES}
+CURRENT = {name: getattr(formatting, name) for name in NAMES}
+
+
+def render_all(impl: dict, case: dict) -> list[str]:
+    queue, address = case["queue"], case["address"]
+    return [
+        impl["format_lviv_notification"](queue, case["slots"], case["is_update"], address, case["date"]),
+        impl["format_lviv_check"](queue, case["lviv"], address),
+        impl["format_notification"](queue, case["data"], case["is_update"], address),
+        impl["format_schedule_notification"](queue, case["date"], case["data"][0]["queues"][queue],
+                                             case["change_type"], address),
+    ]
+
+
+def check_identical(cases: list[dict]) -> int:
+    checked = 0
+    for case in cases:
+        old, new = render_all(LEGACY, case), render_all(CURRENT, case)
+        for before, after in zip(old, new):
+            if before != after:
+                raise SystemExit(f"❌ Output differs:\n--- old\n{before}\n--- new\n{after}")
+            checked += 1
+    return checked
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cases", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    cases = make_cases(args.cases, args.seed)
+    print(f"✅ {check_identical(cases)} messages identical")
+
+    for label, impl in (("legacy", LEGACY), ("formatting", CURRENT)):
+        timer = timeit.Timer(lambda: [render_all(impl, case) for case in cases])
+        best = min(timer.repeat(repeat=args.repeat, number=1))
+        per_message = best / (len(cases) * 4) * 1e6
+        print(f"{label:>10}: {best * 1000:8.1f} ms per pass, {per_message:6.2f} µs per message")
+
+
+if __name__ == "__main__":
+    main()
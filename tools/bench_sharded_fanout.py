@@ -0,0 +1,128 @@
+"""Бенчмарк розсилки кількома процесами-воркерами (FANOUT_WORKERS).
+
+Наповнює окрему базу MongoDB синтетичними підписниками, ставить одну зміну
+графіку в outbox через main.enqueue_changes і вимірює час до останньої
+доставки на фейковий Bot API для кожного N воркерів.
+
+    python tools/bench_sharded_fanout.py --users 100000 --workers 1,2,4,8
+
+Потрібен локальний mongod. База DB_NAME (за замовчуванням lumos_bench) очищається.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from fake_telegram import FakeTelegram  # noqa: E402
+
+BENCH_TOKEN = "123456:BENCHMARKBENCHMARKBENCHMARKBENCHMAR"
+
+
+def configure_env(args, api_url: str):
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "MONGO_URI": args.mongo_uri,
+        "DB_NAME": args.db,
+        "TELEGRAM_API_URL": api_url,
+        "SEND_RATE_LIMIT": str(args.rate),
+    })
+
+
+async def seed_users(db, count: int):
+    await db.users.delete_many({})
+    chunk = 10_000
+    for start in range(0, count, chunk):
+        await db.users.insert_many([
+            {"user_id": 10_000_000 + i, "queues": ["1.1"], "region": "if", "address": f"Вулиця {i}, 1"}
+            for i in range(start, min(count, start + chunk))
+        ])
+
+
+async def run_once(main, fake: FakeTelegram, workers: int, args) -> dict:
+    await main.db.outbox.delete_many({})
+    await main.db.send_budget.delete_many({})
+    fake.reset()
+
+    main.FANOUT_WORKERS = workers
+    env = dict(os.environ, FANOUT_WORKERS=str(workers))
+    procs = [
+        subprocess.Popen([sys.executable, str(ROOT / "main.py"), "--fanout-worker", str(shard)], env=env,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for shard in range(workers)
+    ]
+    try:
+        # Чекаємо, поки воркери піднімуться (імпорт aiogram, підключення до БД)
+        await asyncio.sleep(args.warmup)
+
+        changes = [["01.01.2030", [{"from": "08:00", "to": "12:00", "status": "off"}], "updated"]]
+        started = time.monotonic()
+        await main.enqueue_changes(main.REGION_IF, "1.1", f"bench:{workers}:{time.time()}", changes)
+        enqueued = time.monotonic()
+
+        expected = args.users * len(changes)
+        while fake.delivered < expected:
+            if time.monotonic() - started > args.timeout:
+                break
+            await asyncio.sleep(0.2)
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait()
+
+    elapsed = (fake.last_at or time.monotonic()) - started
+    return {
+        "workers": workers,
+        "delivered": fake.delivered,
+        "enqueue_sec": round(enqueued - started, 2),
+        "time_to_last_delivery_sec": round(elapsed, 2),
+        "msgs_per_sec": round(fake.delivered / elapsed, 1) if elapsed > 0 else 0,
+        "rate_limited": fake.rate_limited,
+    }
+
+
+async def amain(args):
+    fake = FakeTelegram(latency_ms=args.latency_ms, rate_limit_ratio=args.rate_limited)
+    api_url = await fake.start(args.port)
+    configure_env(args, api_url)
+
+    import main  # noqa: E402 — після налаштування оточення
+    await main.init_db()
+    print(f"Seeding {args.users} users...")
+    await seed_users(main.db, args.users)
+
+    results = []
+    for workers in [int(w) for w in args.workers.split(",")]:
+        result = await run_once(main, fake, workers, args)
+        results.append(result)
+        print(result)
+
+    print("\nworkers  delivered  last_delivery_s  msgs/s")
+    for r in results:
+        print(f"{r['workers']:>7}  {r['delivered']:>9}  {r['time_to_last_delivery_sec']:>15}  {r['msgs_per_sec']:>6}")
+
+    await main.db.users.delete_many({})
+    await main.close_db()
+    await main.bot.session.close()
+    await fake.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--workers", default="1,2,4,8")
+    parser.add_argument("--latency-ms", type=float, default=10, help="затримка фейкового Bot API")
+    parser.add_argument("--rate-limited", type=float, default=0.0, help="частка відповідей 429")
+    parser.add_argument("--rate", type=int, default=0, help="SEND_RATE_LIMIT (0 — без ліміту)")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    parser.add_argument("--db", default="lumos_bench")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--warmup", type=float, default=5)
+    parser.add_argument("--timeout", type=float, default=3600)
+    asyncio.run(amain(parser.parse_args()))
@@ -0,0 +1,123 @@
+"""Бенчмарк картинок графіків: час рендеру та частка надсилань за file_id.
+
+1. Рендерить --renders випадкових графіків доби і звітує час на картинку та
+   розмір PNG (потрібен лише Pillow).
+2. Розсилає --versions версій графіка для --queues черг по --users підписників
+   на фейковий Bot API через main.send_schedule_photo і рахує,
+   скільки разів картинку рендерили й завантажували, а скільки — брали з кешу.
+
+    python tools/bench_timeline.py --renders 500 --users 2000 --queues 12 --versions 3
+
+Для другої частини потрібен локальний mongod; колекція timeline_images у базі
+DB_NAME (за замовчуванням lumos_bench) очищається.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from fake_telegram import FakeTelegram  # noqa: E402
+from formatting import day_schedule  # noqa: E402
+from timeline import render_timeline  # noqa: E402
+
+BENCH_TOKEN = "123456:BENCHMARKBENCHMARKBENCHMARKBENCHMAR"
+QUEUES = [f"{group}.{sub}" for group in range(1, 7) for sub in (1, 2)]
+
+
+def random_hours(rng: random.Random) -> list[dict]:
+    hours, start = [], rng.randrange(0, 8) * 60
+    while start < 22 * 60 and len(hours) < 4:
+        end = min(24 * 60, start + rng.choice([60, 120, 180, 240]))
+        hours.append({"from": f"{start // 60:02d}:{start % 60:02d}", "to": f"{end // 60 % 24:02d}:{end % 60:02d}"})
+        start = end + rng.choice([120, 180, 240, 300])
+    return hours
+
+
+def bench_render(count: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    timings, sizes = [], []
+    for _ in range(count):
+        day = day_schedule(random_hours(rng))
+        started = time.perf_counter()
+        png = render_timeline(day, rng.choice(QUEUES), "20.01.2026")
+        timings.append((time.perf_counter() - started) * 1000)
+        sizes.append(len(png))
+    timings.sort()
+    return {
+        "renders": count,
+        "mean_ms": round(statistics.mean(timings), 2),
+        "p95_ms": round(timings[int(len(timings) * 0.95) - 1], 2),
+        "avg_png_bytes": int(statistics.mean(sizes)),
+    }
+
+
+async def bench_cache(args) -> dict:
+    fake = FakeTelegram(latency_ms=args.latency_ms)
+    api_url = await fake.start(args.port)
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "MONGO_URI": args.mongo_uri,
+        "DB_NAME": args.db,
+        "TELEGRAM_API_URL": api_url,
+        "SEND_RATE_LIMIT": "0",
+        "TIMELINE_IMAGES": "1",
+    })
+    import main  # noqa: E402 — після налаштування оточення
+    await main.init_db()
+    await main.db.timeline_images.delete_many({})
+
+    rng = random.Random(args.seed)
+    queues = QUEUES[:args.queues]
+    subscribers = {queue: [20_000_000 + i for i in range(args.users) if i % len(queues) == index]
+                   for index, queue in enumerate(queues)}
+    started = time.monotonic()
+    sent = 0
+    for version in range(args.versions):
+        for queue in queues:
+            hours = random_hours(rng)
+            day = main.day_schedule(hours)
+            caption = main.format_schedule_notification(queue, "20.01.2026", hours, "updated")
+            # Підписники однієї черги отримують картинку паралельно, як у воркерах розсилки
+            results = await asyncio.gather(*(
+                main.send_schedule_photo(user_id, main.REGION_IF, queue, "20.01.2026", day, caption)
+                for user_id in subscribers[queue]
+            ))
+            sent += sum(1 for result in results if result is not None)
+    elapsed = time.monotonic() - started
+
+    report = {"photos_sent": sent, "elapsed_sec": round(elapsed, 2), **main.timeline_stats()}
+    await main.db.timeline_images.delete_many({})
+    await main.close_db()
+    await main.bot.session.close()
+    await fake.stop()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--renders", type=int, default=500)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--queues", type=int, default=12)
+    parser.add_argument("--versions", type=int, default=3, help="скільки разів змінюється графік кожної черги")
+    parser.add_argument("--latency-ms", type=float, default=10, help="затримка фейкового Bot API")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    parser.add_argument("--db", default="lumos_bench")
+    parser.add_argument("--port", type=int, default=8098)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--render-only", action="store_true", help="лише частина 1, без MongoDB")
+    args = parser.parse_args()
+
+    print("render:", bench_render(args.renders, args.seed))
+    if not args.render_only:
+        print("cache:", asyncio.run(bench_cache(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Фейковий Bot API для бенчмарків: приймає будь-які методи, імітує затримку
+Telegram і (за бажанням) частку відповідей 429 з retry_after. Запам'ятовує
+останню inline-клавіатуру в кожному чаті, щоб генератор навантаження міг
+натискати справжні кнопки бота."""
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+
+class FakeTelegram:
+    def __init__(self, latency_ms: float = 20, rate_limit_ratio: float = 0.0, retry_after: int = 1):
+        self.latency = latency_ms / 1000
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.requests = 0
+        self.delivered = 0
+        self.rate_limited = 0
+        self.first_at: float | None = None
+        self.last_at: float | None = None
+        self._message_id = 0
+        self.keyboards: dict[int, list[list[dict]]] = {}
+        self._runner: web.AppRunner | None = None
+
+    def reset(self):
+        self.requests = self.delivered = self.rate_limited = 0
+        self.first_at = self.last_at = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+
+        if method.lower().startswith("send") and random.random() < self.rate_limit_ratio:
+            self.rate_limited += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+
+        now = time.monotonic()
+        self.first_at = self.first_at or now
+        self.last_at = now
+        self._message_id += 1
+        chat_id = int(data.get("chat_id", 0) or 0)
+        markup = json.loads(data.get("reply_markup") or "{}")
+        if "inline_keyboard" in markup:
+            self.keyboards[chat_id] = markup["inline_keyboard"]
+        result = True
+        if method.lower() in ("sendmessage", "editmessagetext", "sendphoto"):
+            self.delivered += 1
+            result = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": data.get("text", ""),
+            }
+            if method.lower() == "sendphoto":
+                result["photo"] = self._photo()
+        elif method.lower() == "sendmediagroup":
+            self.delivered += 1
+            result = []
+            for _ in json.loads(data.get("media", "[]")):
+                self._message_id += 1
+                result.append({
+                    "message_id": self._message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "photo": self._photo(),
+                })
+        elif method.lower() == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "Lumos", "username": "lumos_bench_bot"}
+        return web.json_response({"ok": True, "result": result})
+
+    def _photo(self) -> list[dict]:
+        return [{"file_id": f"fake-{self._message_id}", "file_unique_id": f"u{self._message_id}", "width": 1, "height": 1}]
+
+    async def start(self, port: int) -> str:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", port).start()
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
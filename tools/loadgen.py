@@ -0,0 +1,315 @@
+"""Генератор навантаження на хендлери: синтетичні апдейти через dp.feed_update.
+
+Кожен віртуальний користувач — окремий підписник у базі (ІФ або ЛОЕ), який у
+циклі виконує сценарії:
+- check — натискає «Перевірити графік» (btn_check);
+- queue — перемикає чергу кнопкою queue_X.Y (cb_queue_select);
+- address — проходить пошук адреси свого регіону: місто, вулиця, будинок,
+  натискаючи ті кнопки, які бот справді надіслав.
+
+Апдейти збираються з JSON, як їх надсилає Telegram, і проходять через увесь
+dispatcher (middleware, фільтри, FSM). Відповіді бота йдуть на фейковий Bot API,
+запити до API ІФ/ЛОЕ — на tools/upstream_stub.py (записані або згенеровані
+відповіді). Конкурентність зростає по рівнях --concurrency; для кожного рівня
+звітуються p50/p95/p99 і помилки по хендлерах, а також середній розклад часу
+(MongoDB / API / Telegram) з main.HANDLER_LATENCY.
+
+    python tools/loadgen.py --concurrency 1,5,20,50 --duration 20 --mix check=6,queue=3,address=1
+
+Потрібен локальний mongod; база DB_NAME (за замовчуванням lumos_bench)
+очищається. Обмеження флуду вимкнене (THROTTLE=0), якщо не задано --throttle.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.types import Update
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from fake_telegram import FakeTelegram  # noqa: E402
+from upstream_stub import UpstreamStub  # noqa: E402
+
+BENCH_TOKEN = "123456:BENCHMARKBENCHMARKBENCHMARKBENCHMAR"
+QUEUES = [f"{group}.{sub}" for group in range(1, 7) for sub in (1, 2)]
+COLLECTIONS = (
+    "users", "fsm_states", "address_cache", "if_streets", "loe_gazetteer", "timeline_images",
+    "outbox", "send_budget",
+)
+IF_CITIES = ["Івано-Франківськ", "Калуш", "Коломия"]
+IF_STREETS = ["Незалежності", "Бельведерська", "Галицька", "Паркова", "Вовчинецька"]
+LVIV_CITY_QUERIES = ["Льв", "Вин", "Брюх"]
+LVIV_STREET_QUERIES = ["Шев", "Гор", "Нау"]
+FIRST_USER_ID = 30_000_000
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 1)
+
+
+class LoadGen:
+    """Збирає апдейти, подає їх у dispatcher і міряє кожен крок"""
+
+    def __init__(self, main, fake: FakeTelegram, rng: random.Random):
+        self.main = main
+        self.fake = fake
+        self.rng = rng
+        self.update_id = 0
+        self.message_id = 0
+        self.timings: dict[str, list[float]] = collections.defaultdict(list)
+        self.errors: dict[str, collections.Counter] = collections.defaultdict(collections.Counter)
+
+    def reset(self):
+        self.timings.clear()
+        self.errors.clear()
+
+    # --- АПДЕЙТИ ---
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"Load {user_id}", "language_code": "uk"}
+
+    def _message(self, user_id: int, sender: dict, text: str, keyboard: list | None = None) -> dict:
+        self.message_id += 1
+        message = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"Load {user_id}"},
+            "from": sender,
+            "text": text,
+        }
+        if keyboard:
+            message["reply_markup"] = {"inline_keyboard": keyboard}
+        return message
+
+    def _update(self, payload: dict) -> Update:
+        self.update_id += 1
+        return Update.model_validate({"update_id": self.update_id, **payload}, context={"bot": self.main.bot})
+
+    def message_update(self, user_id: int, text: str) -> Update:
+        return self._update({"message": self._message(user_id, self._user(user_id), text)})
+
+    def callback_update(self, user_id: int, data: str, keyboard: list | None = None) -> Update:
+        bot_user = {"id": 1, "is_bot": True, "first_name": "Lumos"}
+        return self._update({"callback_query": {
+            "id": str(self.update_id + 1),
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": self._message(user_id, bot_user, "…", keyboard),
+        }})
+
+    # --- КРОКИ ---
+    async def step(self, name: str, user_id: int, update: Update) -> bool:
+        # Клавіатура, що залишиться після кроку, — відповідь саме на нього
+        self.fake.keyboards.pop(user_id, None)
+        started = time.perf_counter()
+        try:
+            result = await self.main.dp.feed_update(self.main.bot, update)
+        except Exception as e:
+            self.errors[name][type(e).__name__] += 1
+            return False
+        finally:
+            self.timings[name].append((time.perf_counter() - started) * 1000)
+        if result is UNHANDLED:
+            self.errors[name]["unhandled"] += 1
+            return False
+        return True
+
+    async def tap(self, name: str, user_id: int, prefix: str) -> bool:
+        """Натискає одну з кнопок з callback_data на prefix з останньої клавіатури бота"""
+        keyboard = self.fake.keyboards.get(user_id) or []
+        buttons = [button for row in keyboard for button in row if button.get("callback_data", "").startswith(prefix)]
+        if not buttons:
+            self.errors[name]["no_button"] += 1
+            return False
+        data = self.rng.choice(buttons)["callback_data"]
+        return await self.step(name, user_id, self.callback_update(user_id, data, keyboard))
+
+    # --- СЦЕНАРІЇ ---
+    async def check(self, user: dict):
+        await self.step("btn_check", user["user_id"], self.message_update(user["user_id"], self.main.BTN_CHECK))
+
+    async def queue(self, user: dict):
+        data = f"queue_{self.rng.choice(QUEUES)}"
+        await self.step("cb_queue_select", user["user_id"], self.callback_update(user["user_id"], data))
+
+    async def address(self, user: dict):
+        user_id = user["user_id"]
+        if not await self.step("cb_enter_address", user_id, self.callback_update(user_id, "enter_address")):
+            return
+        if user["region"] == self.main.REGION_LVIV:
+            if not await self.step("lviv_city_search", user_id, self.message_update(user_id, self.rng.choice(LVIV_CITY_QUERIES))):
+                return
+            if not await self.tap("cb_lviv_city_select", user_id, "lcity|"):
+                return
+            if not await self.step("lviv_street_search", user_id, self.message_update(user_id, self.rng.choice(LVIV_STREET_QUERIES))):
+                return
+            if not await self.tap("cb_lviv_street_select", user_id, "lstreet|"):
+                return
+            await self.step("lviv_house_input", user_id, self.message_update(user_id, str(self.rng.randrange(1, 150))))
+            return
+
+        if not await self.step("process_city", user_id, self.message_update(user_id, self.rng.choice(IF_CITIES))):
+            return
+        street = f"{self.rng.choice(IF_STREETS)}, {self.rng.randrange(1, 150)}"
+        if not await self.step("process_street", user_id, self.message_update(user_id, street)):
+            return
+        # Якщо бот запропонував схожу вулицю — погоджуємося
+        keyboard = self.fake.keyboards.get(user_id) or []
+        if any(button.get("callback_data", "").startswith("ifstreet|") for row in keyboard for button in row):
+            await self.tap("cb_if_street_select", user_id, "ifstreet|")
+
+
+async def seed_users(db, count: int, lviv_share: float, rng: random.Random) -> list[dict]:
+    users = [{
+        "user_id": FIRST_USER_ID + i,
+        "region": "lviv" if rng.random() < lviv_share else "if",
+        "queues": rng.sample(QUEUES, rng.choice([1, 1, 2])),
+        "reminders": False,
+        "reminder_intervals": [],
+    } for i in range(count)]
+    await db.users.insert_many([dict(user) for user in users])
+    return users
+
+
+async def run_level(gen: LoadGen, users: list[dict], concurrency: int, duration: float,
+                    mix: dict[str, float], think_ms: float) -> dict:
+    gen.reset()
+    gen.main.HANDLER_LATENCY.clear()
+    scenarios, weights = list(mix), list(mix.values())
+    deadline = time.monotonic() + duration
+
+    async def virtual_user(user: dict):
+        while time.monotonic() < deadline:
+            scenario = gen.rng.choices(scenarios, weights)[0]
+            await getattr(gen, scenario)(user)
+            if think_ms:
+                await asyncio.sleep(gen.rng.expovariate(1000 / think_ms))
+
+    started = time.monotonic()
+    await asyncio.gather(*(virtual_user(user) for user in users[:concurrency]))
+    elapsed = time.monotonic() - started
+
+    breakdown = gen.main.handler_latency_report()["handlers"]
+    handlers = {}
+    for name in sorted(set(gen.timings) | set(gen.errors)):
+        timings = gen.timings.get(name, [])
+        handlers[name] = {
+            "count": len(timings),
+            "p50_ms": percentile(timings, 0.50),
+            "p95_ms": percentile(timings, 0.95),
+            "p99_ms": percentile(timings, 0.99),
+            "errors": dict(gen.errors.get(name, {})),
+            "avg_parts_ms": breakdown.get(name, {}).get("avg_parts_ms", {}),
+        }
+    updates = sum(len(timings) for timings in gen.timings.values())
+    return {
+        "concurrency": concurrency,
+        "updates": updates,
+        "updates_per_sec": round(updates / elapsed, 1) if elapsed > 0 else 0,
+        "errors": sum(sum(counter.values()) for counter in gen.errors.values()),
+        "handlers": handlers,
+    }
+
+
+def print_level(level: dict):
+    print(f"\nconcurrency {level['concurrency']}: {level['updates']} updates, "
+          f"{level['updates_per_sec']} upd/s, {level['errors']} errors")
+    print(f"  {'handler':<24}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}  errors / parts")
+    for name, stats in level["handlers"].items():
+        parts = ", ".join(f"{part} {ms}" for part, ms in stats["avg_parts_ms"].items())
+        print(f"  {name:<24}{stats['count']:>7}{stats['p50_ms'] or '-':>9}{stats['p95_ms'] or '-':>9}"
+              f"{stats['p99_ms'] or '-':>9}  {stats['errors'] or ''} {parts}")
+
+
+def parse_mix(text: str) -> dict[str, float]:
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in ("check", "queue", "address"):
+            raise SystemExit(f"unknown scenario: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+async def amain(args) -> int:
+    levels = [int(level) for level in args.concurrency.split(",")]
+    mix = parse_mix(args.mix)
+    fake = FakeTelegram(latency_ms=args.latency_ms)
+    stub = UpstreamStub(args.recordings, latency_ms=args.upstream_latency_ms)
+    api_url = await fake.start(args.port)
+    os.environ.update(await stub.start(args.port + 1))
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "MONGO_URI": args.mongo_uri,
+        "DB_NAME": args.db,
+        "TELEGRAM_API_URL": api_url,
+        "SEND_RATE_LIMIT": "0",
+        "THROTTLE": "1" if args.throttle else "0",
+        "TIMELINE_IMAGES": "1" if args.images else "0",
+    })
+
+    import main  # noqa: E402 — після налаштування оточення
+    await main.init_db()
+    for name in COLLECTIONS:
+        await main.db[name].delete_many({})
+    rng = random.Random(args.seed)
+    users = await seed_users(main.db, max(levels), args.lviv_share, rng)
+    gen = LoadGen(main, fake, rng)
+
+    results = []
+    degraded_at = None
+    try:
+        for concurrency in levels:
+            level = await run_level(gen, users, concurrency, args.duration, mix, args.think_ms)
+            results.append(level)
+            print_level(level)
+            slow = [name for name, stats in level["handlers"].items() if (stats["p95_ms"] or 0) > args.slo_p95_ms]
+            if slow and degraded_at is None:
+                degraded_at = concurrency
+                print(f"  ⚠️ p95 above {args.slo_p95_ms:g}ms: {', '.join(slow)}")
+    finally:
+        for name in COLLECTIONS:
+            await main.db[name].delete_many({})
+        await main.close_db()
+        await main.bot.session.close()
+        await stub.stop()
+        await fake.stop()
+
+    print(f"\nlatency degrades at concurrency: {degraded_at or 'not reached'}")
+    if args.save:
+        Path(args.save).write_text(json.dumps({"levels": results, "degraded_at": degraded_at}, indent=2, ensure_ascii=False),
+                                   encoding="utf-8")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,5,20,50", help="рівні кількості віртуальних користувачів")
+    parser.add_argument("--duration", type=float, default=20, help="секунд на рівень")
+    parser.add_argument("--mix", default="check=6,queue=3,address=1", help="ваги сценаріїв")
+    parser.add_argument("--think-ms", type=float, default=0, help="середня пауза між сценаріями")
+    parser.add_argument("--slo-p95-ms", type=float, default=1000, help="поріг p95, після якого рівень вважається деградованим")
+    parser.add_argument("--lviv-share", type=float, default=0.3, help="частка користувачів ЛОЕ")
+    parser.add_argument("--latency-ms", type=float, default=30, help="затримка фейкового Bot API")
+    parser.add_argument("--upstream-latency-ms", type=float, default=100)
+    parser.add_argument("--recordings", help="записані відповіді API (інакше згенеровані)")
+    parser.add_argument("--images", action="store_true", help="надсилати картинки графіків")
+    parser.add_argument("--throttle", action="store_true", help="не вимикати обмеження флуду")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    parser.add_argument("--db", default="lumos_bench")
+    parser.add_argument("--port", type=int, default=8094, help="фейковий Bot API; замінник API — на port + 1")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--save", help="записати результати рівнів у JSON")
+    sys.exit(asyncio.run(amain(parser.parse_args())))
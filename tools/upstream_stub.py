@@ -0,0 +1,291 @@
+"""Замінник API ІФ та ЛОЕ для роботи без мережі: відтворює записані відповіді.
+
+Відповіді записує сам бот, якщо задати UPSTREAM_RECORD_DIR (файл на відповідь,
+із часом запиту). Стаб віддає їх через aiohttp за тими ж адресами, що й
+справжні API, з керованою затримкою, помилками та змінами графіків у часі.
+Якщо для запиту запису немає, відповідь генерується (12 черг, сьогодні й завтра).
+
+    python tools/upstream_stub.py --recordings recordings/ --latency-ms 300 --error-rate 0.05 --mutate-every 600
+
+і запустити бота з виведеними змінними APQE_PQFRTY, APSRC_PFRTY, APQE_LOE, APWR_LOE.
+
+--timeline — JSON-список подій {"at": секунди від старту, ...}, де можна задати
+latency_ms, jitter_ms, error_rate, error_status, shift_minutes (зсув усіх
+відключень) або "bump": true (наступна версія графіків).
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+from aiohttp import web
+
+KYIV_TZ = ZoneInfo("Europe/Kyiv")
+QUEUES = [f"{group}.{sub}" for group in range(1, 7) for sub in (1, 2)]
+TIME_RE = re.compile(r"\b(\d{2}):(\d{2})\b")
+ROUTES = {
+    "if_schedule": ("GET", "/if/schedule"),
+    "if_search": ("POST", "/if/search"),
+    "loe_schedule": ("GET", "/loe/schedule"),
+    "loe_power": ("GET", "/loe/power/{path:.*}"),
+}
+ENV_NAMES = {"if_schedule": "APQE_PQFRTY", "if_search": "APSRC_PFRTY", "loe_schedule": "APQE_LOE", "loe_power": "APWR_LOE"}
+
+
+# --- ЗАПИСИ ---
+def _params_key(params: dict) -> str:
+    return json.dumps({k: str(v) for k, v in sorted(params.items()) if k != "pagination"}, ensure_ascii=False)
+
+
+def load_recordings(directory: str | None) -> dict[tuple[str, str], dict[str, list[dict]]]:
+    """(api, path) → ключ параметрів → записи за часом (кожен наступний — нова версія).
+    Поспіль однакові відповіді зливаються в одну (напр. записи різних запусків бота)."""
+    index: dict[tuple[str, str], dict[str, list[dict]]] = {}
+    if not directory:
+        return index
+    for file in sorted(Path(directory).glob("*.json")):
+        snapshot = json.loads(file.read_text(encoding="utf-8"))
+        key = (snapshot["api"], snapshot.get("path", ""))
+        index.setdefault(key, {}).setdefault(_params_key(snapshot.get("params", {})), []).append(snapshot)
+    for by_params in index.values():
+        for params_key, snapshots in by_params.items():
+            snapshots.sort(key=lambda snapshot: snapshot["recorded_at"])
+            by_params[params_key] = [
+                snapshot for i, snapshot in enumerate(snapshots)
+                if i == 0 or (snapshot["status"], snapshot["body"]) != (snapshots[i - 1]["status"], snapshots[i - 1]["body"])
+            ]
+    return index
+
+
+# --- ЗГЕНЕРОВАНІ ВІДПОВІДІ ---
+def _dates() -> list[str]:
+    today = datetime.now(KYIV_TZ)
+    return [(today + timedelta(days=offset)).strftime("%d.%m.%Y") for offset in (0, 1)]
+
+
+def _synthetic_slots(queue_id: str, date_str: str, version: int) -> list[tuple[str, str]]:
+    rng = random.Random(f"{queue_id}:{date_str}:{version}")
+    slots, start = [], rng.randrange(0, 6) * 60
+    while start < 21 * 60 and len(slots) < 3:
+        end = min(24 * 60, start + rng.choice([120, 180, 240]))
+        slots.append((f"{start // 60:02d}:00", f"{end // 60 % 24:02d}:00"))
+        start = end + rng.choice([180, 240, 300])
+    return slots
+
+
+def synthetic_if_schedule(version: int) -> list[dict]:
+    return [
+        {
+            "eventDate": date_str,
+            "scheduleApprovedSince": f"{date_str} 18:{version % 60:02d}",
+            "queues": {
+                queue: [{"from": start, "to": end, "status": 1} for start, end in _synthetic_slots(queue, date_str, version)]
+                for queue in QUEUES
+            },
+        }
+        for date_str in _dates()
+    ]
+
+
+def synthetic_if_search(address: str, version: int) -> dict:
+    queue = QUEUES[int(hashlib.sha1(address.encode()).hexdigest(), 16) % len(QUEUES)]
+    group, sub = queue.split(".")
+    return {"current": {"hasQueue": "yes", "queue": int(group), "subQueue": int(sub)}, "schedule": synthetic_if_schedule(version)}
+
+
+def synthetic_loe_schedule(version: int) -> dict:
+    items = []
+    for name, date_str in zip(("Today", "Tomorrow"), _dates()):
+        groups = "".join(
+            f"<p>Група {queue}. Електроенергії немає "
+            + ", ".join(f"з {start} до {end}" for start, end in _synthetic_slots(queue, date_str, version)) + ".</p>"
+            for queue in QUEUES
+        )
+        items.append({"name": name, "rawHtml": f"<p>Графік погодинних відключень на {date_str}</p>{groups}"})
+    return {"hydra:member": [{"menuItems": items}]}
+
+
+def synthetic_loe_power(path: str, params: dict) -> dict:
+    name = params.get("name", "").lower()
+    if path.endswith("pw_cities"):
+        members = [{"id": i, "name": city, "otg": {"name": city}} for i, city in enumerate(["Львів", "Винники", "Брюховичі"], 1)]
+    elif path.endswith("pw_streets"):
+        members = [{"id": i, "name": street} for i, street in enumerate(["Городоцька", "Шевченка", "Наукова"], 1)]
+    else:
+        digest = int(hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest(), 16)
+        queue = QUEUES[digest % len(QUEUES)].replace(".", "")
+        return {"hydra:member": [{"chergGpv": queue}]}
+    return {"hydra:member": [member for member in members if name in member["name"].lower()]}
+
+
+# --- ЗМІНИ ГРАФІКІВ ---
+def _shift(text: str, minutes: int) -> str:
+    def replace(match: re.Match) -> str:
+        total = min(24 * 60, max(0, int(match.group(1)) * 60 + int(match.group(2)) + minutes))
+        return f"{total // 60 % 24:02d}:{total % 60:02d}"
+    return TIME_RE.sub(replace, text)
+
+
+def shift_schedule(data, minutes: int):
+    """Зсуває всі часи "HH:MM" у відповіді (поля from/to ІФ, rawHtml ЛОЕ)"""
+    if not minutes:
+        return data
+    if isinstance(data, dict):
+        return {key: _shift(value, minutes) if key in ("from", "to", "rawHtml") and isinstance(value, str)
+                else shift_schedule(value, minutes) for key, value in data.items()}
+    if isinstance(data, list):
+        return [shift_schedule(item, minutes) for item in data]
+    return data
+
+
+# --- СЕРВЕР ---
+class UpstreamStub:
+    def __init__(self, recordings: str | None = None, latency_ms: float = 0, jitter_ms: float = 0,
+                 use_recorded_latency: bool = False, error_rate: float = 0.0, error_status: int = 503,
+                 timeline: list[dict] | None = None, mutate_every: float = 0):
+        self.recordings = load_recordings(recordings)
+        self.settings = {
+            "latency_ms": latency_ms, "jitter_ms": jitter_ms, "error_rate": error_rate,
+            "error_status": error_status, "shift_minutes": 0,
+        }
+        self.use_recorded_latency = use_recorded_latency
+        self.timeline = sorted(timeline or [], key=lambda event: event["at"])
+        self.mutate_every = mutate_every
+        self.version = 0
+        self.stats = {"requests": 0, "errors": 0, "recorded": 0, "synthetic": 0, "by_api": {}}
+        self._started = time.monotonic()
+        self._applied = 0
+        self._runner: web.AppRunner | None = None
+
+    def bump(self):
+        """Наступна версія графіків: наступний запис або інший згенерований графік"""
+        self.version += 1
+
+    def _advance(self):
+        elapsed = time.monotonic() - self._started
+        while self._applied < len(self.timeline) and self.timeline[self._applied]["at"] <= elapsed:
+            event = self.timeline[self._applied]
+            self._applied += 1
+            if event.get("bump"):
+                self.bump()
+            self.settings.update({key: value for key, value in event.items() if key in self.settings})
+        if self.mutate_every:
+            self.version = max(self.version, int(elapsed // self.mutate_every))
+
+    def _recorded(self, api: str, path: str, params: dict) -> dict | None:
+        by_params = self.recordings.get((api, path))
+        if not by_params:
+            return None
+        snapshots = by_params.get(_params_key(params))
+        if snapshots is None:
+            if api != "if_schedule":
+                return None
+            # Відповідь ІФ містить усі черги — підійде запис для будь-якої
+            snapshots = next(iter(by_params.values()))
+        return snapshots[min(self.version, len(snapshots) - 1)]
+
+    def _synthetic(self, api: str, path: str, params: dict):
+        if api == "if_schedule":
+            return synthetic_if_schedule(self.version)
+        if api == "if_search":
+            return synthetic_if_search(params.get("address", ""), self.version)
+        if api == "loe_schedule":
+            return synthetic_loe_schedule(self.version)
+        return synthetic_loe_power(path, params)
+
+    async def handle(self, request: web.Request, api: str) -> web.Response:
+        self._advance()
+        self.stats["requests"] += 1
+        self.stats["by_api"][api] = self.stats["by_api"].get(api, 0) + 1
+        path = "/" + request.match_info.get("path", "") if api == "loe_power" else ""
+        params = dict(request.query)
+        if request.method == "POST":
+            params.update(await request.post())
+
+        snapshot = self._recorded(api, path, params)
+        delay = self.settings["latency_ms"] + random.uniform(0, self.settings["jitter_ms"])
+        if snapshot and self.use_recorded_latency:
+            delay = snapshot["elapsed_ms"]
+        await asyncio.sleep(delay / 1000)
+
+        if random.random() < self.settings["error_rate"]:
+            self.stats["errors"] += 1
+            return web.Response(status=self.settings["error_status"], text="stub error")
+
+        if snapshot:
+            self.stats["recorded"] += 1
+            status, body = snapshot["status"], snapshot["body"]
+            if api != "loe_power" and status == 200 and self.settings["shift_minutes"]:
+                body = json.dumps(shift_schedule(json.loads(body), self.settings["shift_minutes"]), ensure_ascii=False)
+            return web.Response(status=status, text=body, content_type="application/json")
+
+        self.stats["synthetic"] += 1
+        data = self._synthetic(api, path, params)
+        if api != "loe_power":
+            data = shift_schedule(data, self.settings["shift_minutes"])
+        return web.json_response(data)
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({**self.stats, "version": self.version, "settings": self.settings})
+
+    async def handle_bump(self, request: web.Request) -> web.Response:
+        self.bump()
+        return web.json_response({"version": self.version})
+
+    async def start(self, port: int) -> dict[str, str]:
+        """Запускає сервер; повертає змінні оточення для бота"""
+        app = web.Application()
+        for api, (method, route) in ROUTES.items():
+            app.router.add_route(method, route, lambda request, api=api: self.handle(request, api))
+        app.router.add_get("/_stub/stats", self.handle_stats)
+        app.router.add_post("/_stub/bump", self.handle_bump)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", port).start()
+        self._started = time.monotonic()
+        base = f"http://127.0.0.1:{port}"
+        return {ENV_NAMES[api]: base + route.split("/{")[0] for api, (_, route) in ROUTES.items()}
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+async def amain(args):
+    timeline = json.loads(Path(args.timeline).read_text(encoding="utf-8")) if args.timeline else None
+    stub = UpstreamStub(args.recordings, args.latency_ms, args.jitter_ms, args.recorded_latency,
+                        args.error_rate, args.error_status, timeline, args.mutate_every)
+    env = await stub.start(args.port)
+    recorded = sum(len(snapshots) for by_params in stub.recordings.values() for snapshots in by_params.values())
+    print(f"Loaded {recorded} recorded responses. Point the bot at the stub:", file=sys.stderr)
+    for name, url in env.items():
+        print(f"{name}={url}")
+    print(f"Stats: GET http://127.0.0.1:{args.port}/_stub/stats, next version: POST /_stub/bump", file=sys.stderr)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stub.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recordings", help="каталог, записаний з UPSTREAM_RECORD_DIR")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--recorded-latency", action="store_true", help="затримка як у записі")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="частка відповідей з помилкою")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--timeline", help="JSON-файл подій")
+    parser.add_argument("--mutate-every", type=float, default=0, help="нова версія графіків кожні N секунд")
+    try:
+        asyncio.run(amain(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass